@@ -0,0 +1,126 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class _Request:
+    __slots__ = ("items", "result", "error", "done")
+
+    def __init__(self, items: List[Any]):
+        self.items = items
+        self.result: Optional[List[Any]] = None
+        self.error: Optional[BaseException] = None
+        self.done = False
+
+
+class BatchCoalescer:
+    """
+    Объединяет вызовы run(items) -> results из разных потоков (задач) в общие батчи.
+
+    Задачи, которые сейчас на шаге этого объединителя, отмечаются через participant().
+    Первый пришедший поток становится ведущим: ждет до max_wait секунд, пока свои элементы
+    отдадут остальные отмеченные задачи (или пока не наберется max_items), выполняет один
+    общий вызов и раскладывает результаты по запросам в исходном порядке. Задачи на других
+    шагах пайплайна не ждутся; ушедшая с шага задача будит ведущего. Если общий вызов
+    упал, каждый запрос повторяется отдельно — ошибка одной задачи не валит соседние.
+    Одиночная задача не ждет вовсе; запрос больше max_items выполняется отдельно.
+    """
+
+    def __init__(self, run: Callable[[List[Any]], List[Any]], max_wait: float, max_items: int, name: str):
+        self.run = run
+        self.max_wait = max_wait
+        self.max_items = max_items
+        self.name = name
+        self._cond = threading.Condition()
+        self._pending: List[_Request] = []
+        self._leader_active = False
+        self._participants = 0
+
+    @contextmanager
+    def participant(self):
+        """Отмечает задачу как находящуюся на шаге этого объединителя."""
+        with self._cond:
+            self._participants += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._participants -= 1
+                self._cond.notify_all()
+
+    def submit(self, items: List[Any]) -> List[Any]:
+        if not items:
+            return []
+        if self.max_wait <= 0:
+            return self.run(items)
+        request = _Request(items)
+        with self._cond:
+            self._pending.append(request)
+            self._cond.notify_all()
+            while not request.done:
+                if self._leader_active:
+                    self._cond.wait()
+                    continue
+                self._leader_active = True
+                try:
+                    group = self._collect()
+                    self._cond.release()
+                    try:
+                        self._execute(group)
+                    finally:
+                        self._cond.acquire()
+                finally:
+                    self._leader_active = False
+                    self._cond.notify_all()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _pending_items(self) -> int:
+        return sum(len(r.items) for r in self._pending)
+
+    def _collect(self) -> List[_Request]:
+        """Под self._cond: ждет остальные задачи и забирает группу запросов в порядке прихода."""
+        deadline = time.monotonic() + self.max_wait
+        while self._pending_items() < self.max_items and len(self._pending) < self._participants:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._cond.wait(remaining)
+        group: List[_Request] = []
+        total = 0
+        for request in list(self._pending):
+            if group and total + len(request.items) > self.max_items:
+                break
+            group.append(request)
+            total += len(request.items)
+        del self._pending[:len(group)]
+        return group
+
+    def _execute(self, group: List[_Request]) -> None:
+        if len(group) > 1:
+            logger.info(f"[batch_coalescer] {self.name}: общий батч из {len(group)} задач, "
+                        f"{sum(len(r.items) for r in group)} элементов")
+        try:
+            results = self.run([item for request in group for item in request.items])
+        except Exception as e:
+            if len(group) == 1:
+                group[0].error = e
+            else:
+                logger.warning(f"[batch_coalescer] {self.name}: общий батч упал, повтор по задачам: {e}")
+                for request in group:
+                    try:
+                        request.result = self.run(request.items)
+                    except Exception as request_error:
+                        request.error = request_error
+        else:
+            pos = 0
+            for request in group:
+                request.result = results[pos:pos + len(request.items)]
+                pos += len(request.items)
+        for request in group:
+            request.done = True
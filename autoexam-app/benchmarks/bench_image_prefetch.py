@@ -0,0 +1,123 @@
+"""
+Бенчмарк фоновой загрузки изображений (image_prefetch.ImagePrefetcher).
+
+Поднимает локальный HTTP-сервер, который отдает картинку с искусственной задержкой,
+и имитирует генерацию подписей через sleep на батч. Сравнивает последовательную схему
+(скачать батч -> подписать) с конвейером, где загрузка идет параллельно генерации,
+и показывает, какая доля времени загрузки спрятана за генерацией.
+
+Запуск из директории autoexam-app:
+    python benchmarks/bench_image_prefetch.py --images 64 --latency 0.3 --gen-time 1.0
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+import requests
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_prefetch import ImagePrefetcher  # noqa: E402
+
+
+def _make_png() -> bytes:
+    buf = BytesIO()
+    Image.new("RGB", (640, 480), color=(120, 160, 200)).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def _start_server(latency: float, payload: bytes) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency)
+            if self.path.startswith("/missing"):
+                self.send_response(404)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _load(url: str) -> Image.Image:
+    response = requests.get(url, timeout=30)
+    response.raise_for_status()
+    return Image.open(BytesIO(response.content)).convert("RGB")
+
+
+def _fake_generate(batch_len: int, gen_time: float) -> None:
+    # Время батча на GPU почти не зависит от числа картинок в нем
+    if batch_len:
+        time.sleep(gen_time)
+
+
+def run_sequential(urls, batch_size: int, gen_time: float):
+    download = 0.0
+    start = time.time()
+    for pos in range(0, len(urls), batch_size):
+        t0 = time.time()
+        loaded = []
+        for url in urls[pos:pos + batch_size]:
+            try:
+                loaded.append(_load(url))
+            except Exception:
+                pass
+        download += time.time() - t0
+        _fake_generate(len(loaded), gen_time)
+    return time.time() - start, download
+
+
+def run_pipelined(urls, batch_size: int, gen_time: float, workers: int, depth: int):
+    start = time.time()
+    prefetcher = ImagePrefetcher(urls, loader=_load, workers=workers, depth=depth)
+    for batch in prefetcher.batches(batch_size):
+        _fake_generate(sum(1 for _, _, err in batch if err is None), gen_time)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=64)
+    parser.add_argument("--latency", type=float, default=0.3, help="задержка ответа сервера, сек")
+    parser.add_argument("--gen-time", type=float, default=1.0, help="имитация generate на батч, сек")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--depth", type=int, default=16)
+    parser.add_argument("--missing-every", type=int, default=10, help="каждый N-й URL отдает 404")
+    args = parser.parse_args()
+
+    server = _start_server(args.latency, _make_png())
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    urls = [
+        f"{base}/missing/{i}.png" if args.missing_every and i % args.missing_every == 0 else f"{base}/img/{i}.png"
+        for i in range(args.images)
+    ]
+
+    seq_total, seq_download = run_sequential(urls, args.batch_size, args.gen_time)
+    pipe_total = run_pipelined(urls, args.batch_size, args.gen_time, args.workers, args.depth)
+    server.shutdown()
+
+    hidden = max(0.0, seq_total - pipe_total)
+    print(f"images={args.images} latency={args.latency}s gen_time={args.gen_time}s/batch batch={args.batch_size}")
+    print(f"sequential: {seq_total:.2f} s (из них загрузка {seq_download:.2f} s)")
+    print(f"pipelined:  {pipe_total:.2f} s")
+    if seq_download > 0:
+        print(f"спрятано загрузки за генерацией: {hidden:.2f} s ({100 * min(1.0, hidden / seq_download):.0f}%)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Бенчмарк загрузки CSV в _background_process: прежний путь (python-движок pandas и
+пересохранение копии {job_id}_original.csv) против ingest.load_upload (диалект и заголовок
+определяются один раз, тело читается pyarrow или C-движком, копия не пишется).
+
+Генерирует синтетическую выгрузку заданного размера, печатает время обоих путей и
+проверяет, что получены одинаковые таблицы.
+
+Запуск из директории autoexam-app:
+    python benchmarks/bench_ingest.py --mb 100 250
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ingest  # noqa: E402
+
+
+def write_csv(path: str, target_mb: int, seed: int = 0) -> int:
+    rng = np.random.default_rng(seed)
+    words = np.array("я думаю что мой город очень красивый и там много парков музеев людей".split(), dtype=object)
+    rows_per_block = 20_000
+    rows = 0
+    header = True
+    while not os.path.exists(path) or os.path.getsize(path) < target_mb * 1024 * 1024:
+        lengths = rng.integers(20, 80, rows_per_block)
+        transcriptions = [" ".join(words[rng.integers(0, len(words), n)]) for n in lengths]
+        links = np.where(rng.random(rows_per_block) < 0.5, "", "https://example.com/img/1.png")
+        block = pd.DataFrame({
+            "Id экзамена": rng.integers(1, 100_000, rows_per_block),
+            "Id вопроса": rng.integers(1, 100, rows_per_block),
+            "№ вопроса": rng.integers(1, 5, rows_per_block),
+            "Текст вопроса": "<p>Расскажите о своем городе</p>",
+            "Картинка из вопроса": links,
+            "Оценка экзаменатора": rng.integers(0, 3, rows_per_block),
+            "Транскрибация ответа": transcriptions,
+        })
+        block.to_csv(path, sep=";", index=False, mode="w" if header else "a", header=header, encoding="utf-8")
+        header = False
+        rows += rows_per_block
+    return rows
+
+
+def legacy_load(path: str, original_path: str) -> pd.DataFrame:
+    """Прежний путь: python-движок и пересохранение исходного файла."""
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        sample = f.read(2048)
+    sep = ingest.detect_delimiter(sample)
+    df = pd.read_csv(path, sep=sep, encoding="utf-8", on_bad_lines="skip", engine="python")
+    df.to_csv(original_path, index=False, sep=sep, encoding="utf-8")
+    return df
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mb", type=int, nargs="+", default=[100])
+    args = parser.parse_args()
+
+    print(f"pyarrow: {'да' if ingest._HAS_PYARROW else 'нет'}")
+    print(f"{'MB':>6} {'rows':>9} {'legacy, s':>10} {'ingest, s':>10} {'speedup':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for mb in args.mb:
+            path = os.path.join(tmp, f"upload_{mb}.csv")
+            rows = write_csv(path, mb)
+            size_mb = os.path.getsize(path) / 1024 / 1024
+            legacy_df, t_legacy = timed(legacy_load, path, os.path.join(tmp, "original.csv"))
+            (new_df, _), t_new = timed(ingest.load_upload, path)
+            assert len(new_df) == len(legacy_df) == rows, "число строк не совпадает"
+            assert list(new_df.columns) == list(legacy_df.columns), "колонки не совпадают"
+            assert (new_df["Транскрибация ответа"] == legacy_df["Транскрибация ответа"]).all(), "данные не совпадают"
+            print(f"{size_mb:>6.0f} {rows:>9} {t_legacy:>10.2f} {t_new:>10.2f} {t_legacy / t_new:>7.1f}x")
+            del legacy_df, new_df
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Микро-бенчмарк немодельной части пайплайна: шаг 1 run_inference (preprocessing.normalize_inputs)
+и сборка промптов скоринга (preprocessing.build_inference_prompts).
+
+Генерирует синтетическую выгрузку нужного размера и печатает время и мкс/строку — при
+линейном масштабировании мкс/строку почти не меняется. На малых размерах для сравнения
+прогоняется прежняя построчная реализация и проверяется, что промпты совпадают.
+
+Запуск из директории autoexam-app:
+    python benchmarks/bench_preprocessing.py --rows 10000 100000 1000000
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from preprocessing import (  # noqa: E402
+    build_inference_prompt,
+    build_inference_prompts,
+    filter_text,
+    normalize_inputs,
+)
+
+
+def make_frame(rows: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    questions = [f"<p>Вопрос {i}: расскажите о <b>своем</b> городе (city {i})</p>" for i in range(40)]
+    distinct_links = max(1, rows // 10)
+    links = np.array([f"https://example.com/img/{i}.png" for i in range(distinct_links)], dtype=object)
+    link_col = links[rng.integers(0, distinct_links, rows)]
+    link_col[rng.random(rows) < 0.5] = None
+    transcriptions = np.array([f"Ответ кандидата номер {i}" for i in range(rows)], dtype=object)
+    # Пустые ячейки выгрузки: NaN, None и пустая строка должны давать те же промпты, что и прежде
+    blanks = rng.random(rows)
+    transcriptions[blanks < 0.03] = np.nan
+    transcriptions[(blanks >= 0.03) & (blanks < 0.06)] = None
+    transcriptions[(blanks >= 0.06) & (blanks < 0.09)] = ""
+    question_col = np.array(questions, dtype=object)[rng.integers(0, len(questions), rows)]
+    question_col[rng.random(rows) < 0.03] = np.nan
+    return pd.DataFrame({
+        "Id экзамена": rng.integers(1, 10_000, rows),
+        "Id вопроса": rng.integers(1, 100, rows),
+        "№ вопроса": rng.integers(1, 5, rows),
+        "Текст вопроса": question_col,
+        "Картинка из вопроса": link_col,
+        "Транскрибация ответа": transcriptions,
+        "Схожесть описания картинки": rng.random(rows),
+    })
+
+
+def legacy_pipeline(df: pd.DataFrame):
+    """Прежняя реализация шага 1 и сборки промптов (для сравнения)."""
+    df["Картинка из вопроса"] = df["Картинка из вопроса"].fillna("no image")
+    df["Тип теста"] = 0
+    for idx in range(len(df)):
+        link = str(df.loc[idx, "Картинка из вопроса"])
+        df.loc[idx, "Тип теста"] = 0 if (not link or link == "no image") else 1
+    df["Текст вопроса"] = df["Текст вопроса"].apply(filter_text)
+    saved_links = []
+    for v in df["Картинка из вопроса"].values:
+        if isinstance(v, str) and v != "no image" and v not in saved_links:
+            saved_links.append(v)
+    prompts = df.apply(build_inference_prompt, axis=1).tolist()
+    return saved_links, prompts
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--legacy-max-rows", type=int, default=10_000, help="прежняя реализация квадратична — только на малых размерах")
+    args = parser.parse_args()
+
+    print(f"{'rows':>10} {'normalize, s':>13} {'prompts, s':>11} {'us/row':>8} {'legacy, s':>10}")
+    for rows in args.rows:
+        df = make_frame(rows)
+        links, t_norm = timed(normalize_inputs, df)
+        prompts, t_prompts = timed(build_inference_prompts, df)
+        legacy = ""
+        if rows <= args.legacy_max_rows:
+            (legacy_links, legacy_prompts), t_legacy = timed(legacy_pipeline, make_frame(rows))
+            assert legacy_links == links, "ссылки не совпадают с прежней реализацией"
+            assert legacy_prompts == prompts, "промпты не совпадают с прежней реализацией"
+            legacy = f"{t_legacy:.2f}"
+        per_row = (t_norm + t_prompts) / rows * 1e6
+        print(f"{rows:>10} {t_norm:>13.3f} {t_prompts:>11.3f} {per_row:>8.2f} {legacy:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import Optional
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.join(ROOT_DIR, "storage", "cache")
+CAPTION_CACHE_PATH = os.path.join(CACHE_DIR, "captions.sqlite")
+# Максимум записей; при превышении удаляются давно не использованные (LRU)
+CAPTION_CACHE_MAX_ENTRIES = 100_000
+# Поиск по перцептивному хешу: пережатые копии той же картинки под другими URL
+CAPTION_CACHE_PHASH = False
+# Максимальное расстояние Хэмминга между dHash; до 3 включительно поиск идет по индексу
+CAPTION_CACHE_PHASH_DISTANCE = 3
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def perceptual_hash(img: Image.Image) -> int:
+    """64-битный dHash: знак разности соседних пикселей уменьшенной серой копии."""
+    small = img.convert("L").resize((9, 8), Image.LANCZOS)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+
+def _to_signed(value: int) -> int:
+    # SQLite хранит INTEGER как знаковое 64-битное
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _bands(value: int) -> list:
+    return [(value >> shift) & 0xFFFF for shift in (48, 32, 16, 0)]
+
+
+class CaptionCache:
+    """
+    Персистентный кеш подписей к изображениям между задачами.
+
+    Ключ — SHA-256 байтов картинки плюс версия (модель, адаптер, версия промпта), поэтому
+    та же картинка под другим URL тоже попадает в кеш, а смена модели или промпта его
+    инвалидирует. Хранилище — SQLite, переживает перезапуск сервера.
+    """
+
+    def __init__(self, path: str = CAPTION_CACHE_PATH, max_entries: int = CAPTION_CACHE_MAX_ENTRIES,
+                 use_phash: bool = CAPTION_CACHE_PHASH, phash_distance: int = CAPTION_CACHE_PHASH_DISTANCE):
+        self.path = path
+        self.max_entries = max_entries
+        self.use_phash = use_phash
+        self.phash_distance = phash_distance
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS captions (
+                version TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                caption TEXT NOT NULL,
+                phash INTEGER,
+                b0 INTEGER, b1 INTEGER, b2 INTEGER, b3 INTEGER,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (version, content_hash)
+            );
+            CREATE INDEX IF NOT EXISTS idx_captions_access ON captions(last_access);
+            CREATE INDEX IF NOT EXISTS idx_captions_b0 ON captions(version, b0);
+            CREATE INDEX IF NOT EXISTS idx_captions_b1 ON captions(version, b1);
+            CREATE INDEX IF NOT EXISTS idx_captions_b2 ON captions(version, b2);
+            CREATE INDEX IF NOT EXISTS idx_captions_b3 ON captions(version, b3);
+            """
+        )
+        self._conn.commit()
+
+    def get(self, version: str, digest: str, phash: Optional[int] = None) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT caption, content_hash FROM captions WHERE version = ? AND content_hash = ?",
+                (version, digest),
+            ).fetchone()
+            if row is None and self.use_phash and phash is not None:
+                row = self._find_similar(version, phash)
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE captions SET last_access = ? WHERE version = ? AND content_hash = ?",
+                (time.time(), version, row[1]),
+            )
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def _find_similar(self, version: str, phash: int):
+        # Если хеши различаются не более чем в 3 битах, хотя бы одна из 4 полос по 16 бит
+        # совпадает точно — кандидатов выбираем по индексу, а не перебором всей таблицы
+        bands = _bands(phash)
+        candidates = self._conn.execute(
+            "SELECT caption, content_hash, phash FROM captions WHERE version = ? AND phash IS NOT NULL "
+            "AND (b0 = ? OR b1 = ? OR b2 = ? OR b3 = ?)",
+            (version, *bands),
+        ).fetchall()
+        best = None
+        best_distance = self.phash_distance + 1
+        for caption, digest, stored in candidates:
+            distance = bin((stored & ((1 << 64) - 1)) ^ phash).count("1")
+            if distance < best_distance:
+                best, best_distance = (caption, digest), distance
+        return best
+
+    def put(self, version: str, digest: str, caption: str, phash: Optional[int] = None) -> None:
+        bands = _bands(phash) if phash is not None else [None] * 4
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO captions (version, content_hash, caption, phash, b0, b1, b2, b3, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (version, digest, caption, _to_signed(phash) if phash is not None else None, *bands, time.time()),
+            )
+            self._conn.commit()
+
+    def evict(self) -> int:
+        """Удаляет давно не использованные записи сверх max_entries."""
+        with self._lock:
+            total = self._conn.execute("SELECT COUNT(*) FROM captions").fetchone()[0]
+            excess = total - self.max_entries
+            if excess <= 0:
+                return 0
+            self._conn.execute(
+                "DELETE FROM captions WHERE rowid IN (SELECT rowid FROM captions ORDER BY last_access LIMIT ?)",
+                (excess,),
+            )
+            self._conn.commit()
+            return excess
+
+
+_cache_lock = threading.Lock()
+_cache: Optional[CaptionCache] = None
+
+
+def get_caption_cache() -> CaptionCache:
+    global _cache
+    if _cache is not None:
+        return _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = CaptionCache()
+            logger.info(f"[caption_cache] Кеш подписей открыт: {_cache.path}")
+    return _cache
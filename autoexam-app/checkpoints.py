@@ -0,0 +1,59 @@
+import os
+import shutil
+import logging
+from typing import Dict, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+CHECKPOINTS_DIR = os.path.join(ROOT_DIR, "storage", "checkpoints")
+
+
+class JobCheckpoint:
+    """
+    Чекпоинты одной задачи: выходы завершенных шагов пайплайна в .npz. Каждый шаг хранит
+    версию — модель, адаптер, промпты и отпечаток входных строк; при несовпадении
+    чекпоинт игнорируется.
+    """
+
+    def __init__(self, job_id: str, root: str = CHECKPOINTS_DIR):
+        self.job_id = job_id
+        self.dir = os.path.join(root, job_id)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.dir, name)
+
+    def _atomic_write(self, name: str, write) -> None:
+        os.makedirs(self.dir, exist_ok=True)
+        tmp_path = self._path(name) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            write(f)
+        os.replace(tmp_path, self._path(name))
+
+    def save_stage(self, stage: str, version: str, **arrays: np.ndarray) -> None:
+        self._atomic_write(f"{stage}.npz", lambda f: np.savez_compressed(f, __version__=np.array(version), **arrays))
+        logger.info(f"[checkpoints] {self.job_id}: шаг {stage} сохранен")
+
+    def load_stage(self, stage: str, version: str) -> Optional[Dict[str, np.ndarray]]:
+        path = self._path(f"{stage}.npz")
+        if not os.path.exists(path):
+            return None
+        try:
+            # allow_pickle=False: в чекпоинтах только числовые и строковые массивы
+            with np.load(path, allow_pickle=False) as data:
+                if str(data["__version__"]) != version:
+                    logger.info(f"[checkpoints] {self.job_id}: чекпоинт шага {stage} устарел, пересчитываем")
+                    return None
+                arrays = {name: data[name] for name in data.files if name != "__version__"}
+        except Exception as e:
+            logger.warning(f"[checkpoints] {self.job_id}: не удалось прочитать чекпоинт шага {stage}: {e}")
+            return None
+        logger.info(f"[checkpoints] {self.job_id}: шаг {stage} восстановлен из чекпоинта")
+        return arrays
+
+    def clear(self) -> None:
+        shutil.rmtree(self.dir, ignore_errors=True)
+
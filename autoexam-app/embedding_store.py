@@ -0,0 +1,208 @@
+import os
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: межпроцессной блокировки нет, только внутри процесса
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+EMBEDDING_STORE_DIR = os.path.join(ROOT_DIR, "storage", "cache", "embeddings")
+EMBEDDING_STORE_DTYPE = np.float32
+# Компакция, когда сегментов становится больше этого числа
+EMBEDDING_STORE_MAX_SEGMENTS = 64
+
+# Запись индекса: sha1 текста, номер сегмента, строка в сегменте. Ключ — V20, а не S20:
+# S-строки numpy отрезают нулевые байты в конце, и такой дайджест не находился бы в индексе.
+# Раскладка на диске у них одна, старые индексы читаются как есть
+INDEX_DTYPE = np.dtype([("key", "V20"), ("segment", "<u4"), ("row", "<u4")])
+
+
+def text_key(text: str) -> bytes:
+    return hashlib.sha1(text.encode("utf-8")).digest()
+
+
+class EmbeddingStore:
+    """
+    Персистентное хранилище эмбеддингов по хешу текста.
+
+    Векторы лежат в неизменяемых сегментах .npy, которые открываются через memmap только
+    на чтение: несколько процессов сервера делят одни и те же страницы page cache, а не
+    держат свои копии в RAM. Новые векторы дописываются новым сегментом, индекс — журнал
+    фиксированных записей (ключ, сегмент, строка), в котором побеждает последняя запись.
+    compact() сливает сегменты в один.
+    """
+
+    def __init__(self, root: str, dim: int, dtype=EMBEDDING_STORE_DTYPE):
+        self.root = root
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self._index_path = os.path.join(root, "index.bin")
+        self._lock_path = os.path.join(root, ".lock")
+        self._lock = threading.Lock()
+        self._index: Dict[bytes, Tuple[int, int]] = {}
+        self._segments: Dict[int, np.ndarray] = {}
+        self._index_offset = 0
+        self._index_inode: Optional[int] = None
+        os.makedirs(root, exist_ok=True)
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._refresh()
+            return len(self._index)
+
+    @contextmanager
+    def _file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(self._lock_path, "a+") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.root, f"seg-{segment:06d}.npy")
+
+    def _refresh(self) -> None:
+        """Дочитывает новые записи индекса; после компакции другим процессом перечитывает целиком."""
+        try:
+            stat = os.stat(self._index_path)
+        except FileNotFoundError:
+            return
+        if self._index_inode != stat.st_ino:
+            self._index.clear()
+            self._segments.clear()
+            self._index_offset = 0
+            self._index_inode = stat.st_ino
+        usable = (stat.st_size // INDEX_DTYPE.itemsize) * INDEX_DTYPE.itemsize
+        if usable <= self._index_offset:
+            return
+        with open(self._index_path, "rb") as f:
+            f.seek(self._index_offset)
+            records = np.frombuffer(f.read(usable - self._index_offset), dtype=INDEX_DTYPE)
+        for key, segment, row in zip(records["key"].tolist(), records["segment"].tolist(), records["row"].tolist()):
+            self._index[key] = (segment, row)
+        self._index_offset = usable
+
+    def _segment(self, segment: int) -> np.ndarray:
+        arr = self._segments.get(segment)
+        if arr is None:
+            arr = np.load(self._segment_path(segment), mmap_mode="r")
+            self._segments[segment] = arr
+        return arr
+
+    def get_many(self, texts: List[str]) -> Tuple[np.ndarray, List[int]]:
+        """Возвращает матрицу (len(texts), dim) и позиции текстов, которых нет в хранилище."""
+        result = np.zeros((len(texts), self.dim), dtype=np.float32)
+        missing: List[int] = []
+        with self._lock:
+            self._refresh()
+            for pos, text in enumerate(texts):
+                location = self._index.get(text_key(text))
+                if location is None:
+                    missing.append(pos)
+                    continue
+                try:
+                    result[pos] = self._segment(location[0])[location[1]]
+                except (FileNotFoundError, IndexError):
+                    missing.append(pos)
+        return result, missing
+
+    def put_many(self, texts: List[str], vectors: np.ndarray) -> None:
+        if not texts:
+            return
+        vectors = np.ascontiguousarray(vectors, dtype=self.dtype).reshape(len(texts), self.dim)
+        with self._lock, self._file_lock():
+            self._refresh()
+            segment = self._next_segment_id()
+            self._write_segment(segment, vectors)
+            records = np.empty(len(texts), dtype=INDEX_DTYPE)
+            records["key"] = [text_key(t) for t in texts]
+            records["segment"] = segment
+            records["row"] = np.arange(len(texts), dtype=np.uint32)
+            with open(self._index_path, "ab") as f:
+                f.write(records.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            self._refresh()
+            segments_count = len(set(seg for seg, _ in self._index.values()))
+        if segments_count > EMBEDDING_STORE_MAX_SEGMENTS:
+            self.compact()
+
+    def _next_segment_id(self) -> int:
+        existing = [int(name[4:10]) for name in os.listdir(self.root) if name.startswith("seg-") and name.endswith(".npy")]
+        return max(existing, default=-1) + 1
+
+    def _write_segment(self, segment: int, vectors: np.ndarray) -> None:
+        tmp_path = self._segment_path(segment) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, vectors)
+        os.replace(tmp_path, self._segment_path(segment))
+
+    def compact(self) -> None:
+        """Сливает живые векторы всех сегментов в один и переписывает индекс."""
+        with self._lock, self._file_lock():
+            self._refresh()
+            if not self._index:
+                return
+            keys = list(self._index.keys())
+            vectors = np.empty((len(keys), self.dim), dtype=self.dtype)
+            for pos, key in enumerate(keys):
+                segment, row = self._index[key]
+                vectors[pos] = self._segment(segment)[row]
+            old_segments = set(seg for seg, _ in self._index.values())
+            segment = self._next_segment_id()
+            self._write_segment(segment, vectors)
+
+            records = np.empty(len(keys), dtype=INDEX_DTYPE)
+            records["key"] = keys
+            records["segment"] = segment
+            records["row"] = np.arange(len(keys), dtype=np.uint32)
+            tmp_index = self._index_path + ".tmp"
+            with open(tmp_index, "wb") as f:
+                f.write(records.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_index, self._index_path)
+
+            self._segments.clear()
+            for old in old_segments:
+                try:
+                    os.remove(self._segment_path(old))
+                except OSError:
+                    # Windows не дает удалить файл, открытый через memmap в другом процессе
+                    pass
+            self._index_inode = None
+            self._refresh()
+        logger.info(f"[embedding_store] Компакция: {len(keys)} векторов в сегменте {segment}")
+
+
+_stores_lock = threading.Lock()
+_stores: Dict[str, EmbeddingStore] = {}
+
+
+def get_embedding_store(model_name: str, dim: int) -> EmbeddingStore:
+    """Хранилище на модель: векторы разных моделей не смешиваются."""
+    slug = model_name.replace("/", "__")
+    store = _stores.get(slug)
+    if store is not None:
+        return store
+    with _stores_lock:
+        store = _stores.get(slug)
+        if store is None:
+            store = EmbeddingStore(os.path.join(EMBEDDING_STORE_DIR, slug), dim)
+            _stores[slug] = store
+            logger.info(f"[embedding_store] Хранилище эмбеддингов открыто: {store.root}")
+    return store
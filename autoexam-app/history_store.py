@@ -0,0 +1,154 @@
+import os
+import json
+import sqlite3
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+HISTORY_DB_PATH = os.path.join(ROOT_DIR, "data", "history.sqlite")
+HISTORY_JSON_PATH = os.path.join(ROOT_DIR, "data", "history.json")
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 500
+
+# Колонка таблицы -> ключ записи в API (как было в history.json)
+_FIELDS = {
+    "id": "id",
+    "user_id": "userId",
+    "filename": "filename",
+    "uploaded_at": "uploadedAt",
+    "status": "status",
+    "total_records": "totalRecords",
+    "average_score": "averageScore",
+    "results_url": "resultsUrl",
+}
+
+
+class HistoryStore:
+    """
+    История обработок в SQLite (WAL). Запись — одна вставка вместо перезаписи всего файла,
+    одновременные завершения задач из разных процессов не теряют записи. Чтение — страницы
+    от новых к старым с курсором (seq последней отданной записи) и фильтрами.
+    """
+
+    def __init__(self, path: str = HISTORY_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS history (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                id TEXT NOT NULL UNIQUE,
+                user_id INTEGER,
+                filename TEXT,
+                uploaded_at TEXT,
+                status TEXT,
+                total_records INTEGER,
+                average_score REAL,
+                results_url TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_history_uploaded ON history(uploaded_at);
+            CREATE INDEX IF NOT EXISTS idx_history_status ON history(status, seq);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            """
+        )
+        self._conn.commit()
+
+    def add(self, entry: Dict[str, Any]) -> None:
+        row = {column: entry.get(key) for column, key in _FIELDS.items()}
+        columns = ", ".join(row)
+        placeholders = ", ".join("?" * len(row))
+        with self._lock:
+            # Повтор той же задачи (resume) заменяет запись и поднимает ее наверх
+            self._conn.execute("DELETE FROM history WHERE id = ?", (row["id"],))
+            self._conn.execute(f"INSERT INTO history ({columns}) VALUES ({placeholders})", tuple(row.values()))
+            self._conn.commit()
+
+    def page(
+        self,
+        limit: int = HISTORY_PAGE_SIZE,
+        cursor: Optional[str] = None,
+        status: Optional[str] = None,
+        filename: Optional[str] = None,
+        date_from: Optional[str] = None,
+        date_to: Optional[str] = None,
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """Страница записей от новых к старым и курсор следующей страницы (None — это последняя)."""
+        limit = max(1, min(int(limit), HISTORY_MAX_PAGE_SIZE))
+        conditions, params = [], []
+        if cursor:
+            conditions.append("seq < ?")
+            params.append(int(cursor))
+        if status:
+            conditions.append("status = ?")
+            params.append(status)
+        if filename:
+            conditions.append("filename LIKE ? ESCAPE '\\'")
+            escaped = filename.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            params.append(f"%{escaped}%")
+        if date_from:
+            conditions.append("uploaded_at >= ?")
+            params.append(date_from)
+        if date_to:
+            # uploadedAt — ISO-строка: '~' больше любого символа времени, дата включается целиком
+            conditions.append("uploaded_at <= ?")
+            params.append(date_to + "~")
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT * FROM history {where} ORDER BY seq DESC LIMIT ?", (*params, limit + 1)
+            ).fetchall()
+        next_cursor = str(rows[limit - 1]["seq"]) if len(rows) > limit else None
+        items = [{key: row[column] for column, key in _FIELDS.items()} for row in rows[:limit]]
+        return items, next_cursor
+
+    def migrate_json(self, json_path: str = HISTORY_JSON_PATH) -> int:
+        """Однократный перенос записей из history.json (сам файл не трогаем)."""
+        with self._lock:
+            done = self._conn.execute("SELECT value FROM meta WHERE key = 'json_migrated'").fetchone()
+        if done is not None:
+            return 0
+        entries: List[Dict[str, Any]] = []
+        if os.path.exists(json_path):
+            try:
+                with open(json_path, "r", encoding="utf-8") as f:
+                    entries = json.load(f).get("history", [])
+            except Exception as e:
+                logger.warning(f"[history_store] Не удалось прочитать {json_path}: {e}")
+        rows = [tuple(entry.get(key) for key in _FIELDS.values()) for entry in entries if entry.get("id")]
+        placeholders = ", ".join("?" * len(_FIELDS))
+        with self._lock:
+            # В history.json новые записи в начале: вставляем с конца, чтобы seq рос со временем
+            self._conn.executemany(
+                f"INSERT OR IGNORE INTO history ({', '.join(_FIELDS)}) VALUES ({placeholders})", rows[::-1]
+            )
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migrated', ?)", (json_path,))
+            self._conn.commit()
+        if rows:
+            logger.info(f"[history_store] Перенесено {len(rows)} записей истории из {json_path}")
+        return len(rows)
+
+
+_store_lock = threading.Lock()
+_store: Optional[HistoryStore] = None
+
+
+def get_history_store() -> HistoryStore:
+    global _store
+    if _store is not None:
+        return _store
+    with _store_lock:
+        if _store is None:
+            store = HistoryStore()
+            store.migrate_json()
+            _store = store
+            logger.info(f"[history_store] История открыта: {store.path}")
+    return _store
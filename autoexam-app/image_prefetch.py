@@ -0,0 +1,66 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, Future
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class ImagePrefetcher:
+    """
+    Фоновая загрузка изображений пулом потоков (producer/consumer).
+
+    Пока потребитель (VL модель) подписывает текущий батч, пул скачивает и декодирует
+    следующие изображения. Одновременно в работе и в очереди готовых держится не больше
+    depth загрузок, поэтому память ограничена. Результаты отдаются в порядке готовности:
+    медленный хост не задерживает остальные картинки, исходный порядок восстанавливается
+    по индексу.
+    """
+
+    def __init__(self, urls: List[str], loader: Callable[[str], Any], workers: int = 8, depth: int = 16):
+        self._urls = urls
+        self._loader = loader
+        self._workers = max(1, workers)
+        self._depth = max(1, depth)
+
+    def __iter__(self) -> Iterator[Tuple[int, Any, Optional[Exception]]]:
+        """Выдает (индекс, изображение, None) или (индекс, None, ошибка)."""
+        if not self._urls:
+            return
+        executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="image-prefetch")
+        pending: Dict[Future, int] = {}
+        next_idx = 0
+        try:
+            while next_idx < len(self._urls) or pending:
+                while next_idx < len(self._urls) and len(pending) < self._depth:
+                    pending[executor.submit(self._loader, self._urls[next_idx])] = next_idx
+                    next_idx += 1
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    idx = pending.pop(future)
+                    error = future.exception()
+                    if error is not None:
+                        yield idx, None, error
+                    else:
+                        yield idx, future.result(), None
+        finally:
+            # Потребитель мог остановиться раньше — не ждем оставшиеся загрузки
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def batches(self, batch_size: int) -> Iterator[List[Tuple[int, Any, Optional[Exception]]]]:
+        """
+        Группирует готовые результаты в батчи по batch_size успешно загруженных изображений.
+        Ошибки загрузки попадают в ближайший батч и места в нем не занимают.
+        """
+        batch: List[Tuple[int, Any, Optional[Exception]]] = []
+        loaded = 0
+        for item in self:
+            batch.append(item)
+            if item[2] is None:
+                loaded += 1
+            if loaded >= batch_size:
+                yield batch
+                batch, loaded = [], 0
+        if batch:
+            yield batch
@@ -1,15 +1,17 @@
 import os
 import re
 import gc
+import hashlib
+import copy
 import random
 import logging
 import time
-from typing import Tuple, List
+import threading
+from typing import Any, Callable, Dict, Iterable, Iterator, Tuple, List, Optional
 
 import numpy as np
 import pandas as pd
 import torch
-from sklearn.metrics.pairwise import cosine_similarity
 
 from PIL import Image
 import requests
@@ -17,31 +19,82 @@ from io import BytesIO
 
 from transformers import BitsAndBytesConfig
 
+from image_prefetch import ImagePrefetcher
+from preprocessing import (
+    MAX_SCORE,
+    SCORING_PROMPT_PREFIX,
+    max_score_for,
+    normalize_inputs,
+    question_numbers,
+    build_inference_prompts,
+)
+from embedding_store import get_embedding_store
+from score_memo import get_score_memo, row_key
+from checkpoints import JobCheckpoint
+from batch_coalescer import BatchCoalescer
+from job_progress import report_done, report_extra, report_stage
+from caption_cache import get_caption_cache, content_hash, perceptual_hash, CAPTION_CACHE_PHASH
+from versions import (
+    MODEL_NAME,
+    ADAPTER_PATH,
+    SCORING_MODE,
+    CAPTION_PROMPT_VERSION,
+    pipeline_version,
+)
+
 # Локальные модели (ленивая загрузка)
 from models import (
     get_vl_model_and_processor,
     get_text_model_and_tokenizer,
     get_rubert_model_and_tokenizer,
+    base_model_mode,
+    adapter_mode,
+    RUBERT_MODEL_NAME,
 )
 
 logger = logging.getLogger(__name__)
 
 
-MODEL_NAME = "Qwen/Qwen2.5-VL-3B-Instruct"
-ADAPTER_PATH = "qwen_sft_exam"
-
 MAX_SEQ_LENGTH = 512
 MAX_NEW_TOKENS = 512
-REQUEST_TIMEOUT = 3600
-
-
-def _filter_text(text: str) -> str:
-    if not isinstance(text, str):
-        return ""
-    no_html = re.sub(r"<[^>]+>", "", text)
-    # Удаляем латиницу
-    result = re.sub(r"[a-zA-Z]", "", no_html)
-    return result
+# Сколько изображений подписывается одним вызовом generate
+CAPTION_BATCH_SIZE = 8
+# Фоновая загрузка изображений: число потоков и сколько картинок держим наготове
+IMAGE_PREFETCH_WORKERS = 8
+IMAGE_PREFETCH_DEPTH = 2 * CAPTION_BATCH_SIZE
+# Загрузка одной картинки, сек: таймаут соединения, таймаут ожидания очередной порции данных
+# и общий предел — хост, отдающий байты по капле, не держит задачу дольше IMAGE_DOWNLOAD_DEADLINE
+IMAGE_CONNECT_TIMEOUT = 10
+IMAGE_READ_TIMEOUT = 60
+IMAGE_DOWNLOAD_DEADLINE = 120
+IMAGE_DOWNLOAD_CHUNK = 64 * 1024
+# Сколько транскрибаций сжимается одним вызовом generate
+SUMMARY_BATCH_SIZE = 16
+# Скоринг: микробатчи ограничены числом токенов с паддингом и числом строк
+SCORING_TOKEN_BUDGET = 16384
+SCORING_MAX_BATCH_SIZE = 64
+# Переиспользовать KV-кеш общего префикса промпта (только для режима "logits")
+SCORING_PREFIX_CACHE = True
+# Сколько текстов эмбеддится одним прогоном ruBERT
+EMBED_BATCH_SIZE = 64
+# Персистентное хранилище эмбеддингов (memmap), общее для задач и процессов сервера
+EMBEDDING_STORE_ENABLED = True
+# Кеш подписей между задачами (версия промпта подписей — в versions.py)
+CAPTION_CACHE_ENABLED = True
+# Мемоизация результатов по строкам между задачами (повторные загрузки того же CSV)
+SCORE_MEMO_ENABLED = True
+# Окно ожидания строк других задач для общего GPU-батча, сек (0 — без объединения)
+COALESCE_MAX_WAIT = float(os.environ.get("AUTOEXAM_COALESCE_MAX_WAIT", "0.5"))
+# Задачи крупнее этого числа строк скоринга не ждут соседей
+SCORING_COALESCE_MAX_ITEMS = 4 * SCORING_MAX_BATCH_SIZE
+
+# Размер батча скоринга, уменьшенный после нехватки памяти; действует до конца процесса
+_scoring_lock = threading.Lock()
+_scoring_batch_cap: Optional[int] = None
+
+# KV-кеш SCORING_PROMPT_PREFIX: {id(model): (токены префикса, past_key_values)}
+_prefix_cache_lock = threading.Lock()
+_prefix_cache: Dict[int, Tuple[List[int], Any]] = {}
 
 
 def _ensure_columns(df: pd.DataFrame) -> pd.DataFrame:
@@ -49,20 +102,51 @@ def _ensure_columns(df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
-def _load_image_from_url(url: str, timeout: int) -> Image.Image:
-    response = requests.get(url, timeout=timeout)
-    response.raise_for_status()
-    image = Image.open(BytesIO(response.content)).convert("RGB")
-    return image
+def _download_image_bytes(url: str, deadline: float = IMAGE_DOWNLOAD_DEADLINE) -> bytes:
+    started = time.monotonic()
+    chunks = []
+    with requests.get(url, timeout=(IMAGE_CONNECT_TIMEOUT, IMAGE_READ_TIMEOUT), stream=True) as response:
+        response.raise_for_status()
+        # read1 отдает то, что уже пришло, не дожидаясь полного буфера: срок проверяется после
+        # каждого ответа сокета (в urllib3 1.x read1 нет — тогда читаем обычными порциями)
+        read = getattr(response.raw, "read1", None) or response.raw.read
+        while chunk := read(IMAGE_DOWNLOAD_CHUNK, decode_content=True):
+            chunks.append(chunk)
+            if time.monotonic() - started > deadline:
+                raise requests.Timeout(f"Картинка не скачалась за {deadline:.0f} сек: {url}")
+    return b"".join(chunks)
 
 
-def _generate_image_caption(model, processor, prefix_words: str, url: str) -> str:
-    try:
-        img = _load_image_from_url(url, timeout=REQUEST_TIMEOUT)
-    except Exception as e:
-        return f"[Ошибка загрузки: {str(e)}]"
+def _fetch_image_for_caption(url: str) -> Tuple[str, Optional[int], Image.Image]:
+    """Скачивает картинку и считает ключи кеша подписей: SHA-256 байтов и (опционально) dHash."""
+    content = _download_image_bytes(url)
+    image = Image.open(BytesIO(content)).convert("RGB")
+    phash = perceptual_hash(image) if CAPTION_CACHE_PHASH else None
+    return content_hash(content), phash, image
+
+
+def _caption_cache_version() -> str:
+    return f"{MODEL_NAME}|{ADAPTER_PATH}|caption-{CAPTION_PROMPT_VERSION}|{MAX_NEW_TOKENS}"
+
 
-    messages = [
+def _is_oom_error(error: BaseException) -> bool:
+    """Нехватка памяти на GPU или CPU — такие ошибки лечатся уменьшением батча."""
+    if isinstance(error, MemoryError):
+        return True
+    if hasattr(torch.cuda, "OutOfMemoryError") and isinstance(error, torch.cuda.OutOfMemoryError):
+        return True
+    message = str(error).lower()
+    return isinstance(error, RuntimeError) and ("out of memory" in message or "not enough memory" in message)
+
+
+def _free_cuda_memory() -> None:
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    gc.collect()
+
+
+def _build_caption_messages(img: Image.Image, prefix_words: str) -> list:
+    return [
         {
             "role": "user",
             "content": [
@@ -72,30 +156,70 @@ def _generate_image_caption(model, processor, prefix_words: str, url: str) -> st
         }
     ]
 
+
+def _generate_image_captions_batch(model, processor, images: List[Image.Image], prefix_words: List[str]) -> List[str]:
+    """Один padded-вызов generate на несколько изображений. Порядок подписей совпадает с images."""
+    conversations = [_build_caption_messages(img, word) for img, word in zip(images, prefix_words)]
+    # Для батчевой генерации паддинг обязан быть слева
+    processor.tokenizer.padding_side = "left"
     inputs = processor.apply_chat_template(
-        messages,
+        conversations,
         add_generation_prompt=True,
         tokenize=True,
         return_dict=True,
         return_tensors="pt",
+        padding=True,
     ).to(model.device)
 
-    outputs = model.generate(**inputs, max_new_tokens=MAX_NEW_TOKENS)
-    caption = processor.decode(outputs[0][inputs["input_ids"].shape[-1]:])
-    
+    with torch.inference_mode(), base_model_mode(model):
+        outputs = model.generate(
+            **inputs,
+            max_new_tokens=MAX_NEW_TOKENS,
+            pad_token_id=processor.tokenizer.pad_token_id,
+        )
+    prompt_len = inputs["input_ids"].shape[-1]
+    captions = processor.batch_decode(outputs[:, prompt_len:], skip_special_tokens=True)
+
     # Освобождаем память от тензоров
     del inputs, outputs
-    if torch.cuda.is_available():
-        torch.cuda.empty_cache()
-    
-    return caption
+    return captions
+
+
+def _run_batches_with_oom_backoff(items: list, batch_size: int, run_batch: Callable[[list], list], stage: str) -> Tuple[list, int]:
+    """
+    Прогоняет items через run_batch батчами по batch_size. При нехватке памяти батч делится
+    пополам и повторяется. Возвращает результаты в порядке items и размер батча, который прошел успешно.
+    """
+    results: list = []
+    pos = 0
+    while pos < len(items):
+        size = min(batch_size, len(items) - pos)
+        try:
+            results.extend(run_batch(items[pos:pos + size]))
+            pos += size
+        except Exception as e:
+            if size == 1 or not _is_oom_error(e):
+                raise
+            batch_size = max(1, size // 2)
+            logger.warning(f"[inference] Нехватка памяти ({stage}, батч {size}), уменьшаем батч до {batch_size}")
+            _free_cuda_memory()
+    return results, batch_size
+
+
+def _caption_loaded_images(model, processor, images: List[Image.Image], prefix_words: List[str], batch_size: int) -> Tuple[List[str], int]:
+    return _run_batches_with_oom_backoff(
+        list(zip(images, prefix_words)),
+        batch_size,
+        lambda chunk: _generate_image_captions_batch(model, processor, [img for img, _ in chunk], [w for _, w in chunk]),
+        "подписи к изображениям",
+    )
 
 
-def _caption_images(unique_links: List[str]) -> List[str]:
+def _caption_images(unique_links: List[str], batch_size: int = CAPTION_BATCH_SIZE) -> List[str]:
     if len(unique_links) == 0:
         logger.info("[inference] Нет изображений для обработки")
         return []
-    logger.info(f"[inference] Начинаем генерацию подписей к {len(unique_links)} изображениям")
+    logger.info(f"[inference] Начинаем генерацию подписей к {len(unique_links)} изображениям (батч {batch_size})")
     start = time.time()
     model, processor = get_vl_model_and_processor()
     replaces = [
@@ -106,21 +230,58 @@ def _caption_images(unique_links: List[str]) -> List[str]:
         "На изображении вы можете увидеть",
         "На данной картинке вы можете увидеть",
     ]
-    results = []
-    for idx, url in enumerate(unique_links):
-        # Логируем каждое изображение
-        logger.info(f"[inference] Генерация подписи {idx+1}/{len(unique_links)}: {url[:50]}...")
-        word = random.choice(replaces)
-        caption = _generate_image_caption(model, processor, word, url)
-        results.append(caption)
-        
-        # Периодическая очистка памяти каждые 5 изображений
-        if (idx + 1) % 5 == 0:
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-            gc.collect()
-            if (idx + 1) % 10 == 0:  # Логируем очистку каждые 10 изображений
-                logger.debug(f"[inference] Периодическая очистка памяти после {idx + 1} изображений")
+    results: List[str] = [""] * len(unique_links)
+    cache = get_caption_cache() if CAPTION_CACHE_ENABLED else None
+    version = _caption_cache_version()
+    cache_hits = 0
+    # Не скачавшиеся картинки в кеш не ходили: в промахи их не считаем
+    download_errors = 0
+    # Изображения скачиваются пулом потоков, пока модель подписывает предыдущий батч
+    prefetcher = ImagePrefetcher(
+        unique_links,
+        loader=_fetch_image_for_caption,
+        workers=IMAGE_PREFETCH_WORKERS,
+        depth=max(IMAGE_PREFETCH_DEPTH, batch_size),
+    )
+    done = 0
+    for batch in prefetcher.batches(batch_size):
+        indices: List[int] = []
+        images: List[Image.Image] = []
+        keys: List[Tuple[str, Optional[int]]] = []
+        for idx, fetched, error in batch:
+            if error is not None:
+                results[idx] = f"[Ошибка загрузки: {str(error)}]"
+                download_errors += 1
+                continue
+            digest, phash, img = fetched
+            cached = cache.get(version, digest, phash) if cache is not None else None
+            if cached is not None:
+                results[idx] = cached
+                cache_hits += 1
+                continue
+            indices.append(idx)
+            images.append(img)
+            keys.append((digest, phash))
+
+        if images:
+            words = [random.choice(replaces) for _ in images]
+            captions, batch_size = _caption_loaded_images(model, processor, images, words, batch_size)
+            for idx, caption, (digest, phash) in zip(indices, captions, keys):
+                results[idx] = caption
+                if cache is not None:
+                    cache.put(version, digest, caption, phash)
+        done += len(batch)
+        logger.info(f"[inference] Подписи к изображениям: {done}/{len(unique_links)}")
+        report_done(done)
+        del images
+        _free_cuda_memory()
+
+    if cache is not None:
+        evicted = cache.evict()
+        misses = len(unique_links) - cache_hits - download_errors
+        logger.info(f"[inference] Кеш подписей: попаданий {cache_hits}, промахов {misses}"
+                    + (f", ошибок загрузки {download_errors}" if download_errors else "")
+                    + (f", вытеснено {evicted}" if evicted else ""))
 
     elapsed = time.time() - start
     logger.info(f"[inference] Подписи к изображениям сгенерированы: {len(results)} за {elapsed:.1f} сек ({elapsed/len(unique_links):.1f} сек/изображение)")
@@ -128,185 +289,237 @@ def _caption_images(unique_links: List[str]) -> List[str]:
     # Агрессивная очистка памяти CUDA после завершения цикла
     # Очищаем ссылки на модель и процессор (они глобальные, но освобождаем локальные ссылки)
     del model, processor
-    if torch.cuda.is_available():
-        torch.cuda.empty_cache()
-    gc.collect()
+    _free_cuda_memory()
     logger.info("[inference] Память CUDA очищена после генерации подписей, модель и процессор освобождены")
     
     return results
 
 
-def _summarize_transcription_for_image_tasks(df: pd.DataFrame) -> None:
-    # Преобразует поле "Транскрибация ответа" в краткое описание картинки для строк с Тип теста == 1
-    if "Тип теста" not in df.columns:
-        return
+def _build_summary_messages(text_value: str) -> list:
+    return [
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": (
+                    "На вход тебе дана запись экзамена по русскому языку — описание картинки. "
+                    "В качестве ответа верни ТОЛЬКО описание самой картинки. "
+                    "Это очень важно для моей карьеры.\n"
+                    f"Транскрибация: {text_value}"
+                )}
+            ],
+        }
+    ]
+
+
+def _generate_summaries_batch(model, processor, chat_texts: List[str]) -> List[str]:
+    """Один left-padded вызов generate на бакет промптов близкой длины."""
+    tokenizer = processor.tokenizer
+    tokenizer.padding_side = "left"
+    inputs = tokenizer(
+        chat_texts,
+        return_tensors="pt",
+        padding=True,
+        add_special_tokens=False,
+    ).to(model.device)
+
+    with torch.inference_mode(), base_model_mode(model):
+        outputs = model.generate(
+            **inputs,
+            max_new_tokens=MAX_NEW_TOKENS,
+            do_sample=False,
+            use_cache=True,
+            pad_token_id=tokenizer.pad_token_id,
+            eos_token_id=tokenizer.eos_token_id,
+        )
+
+    prompt_len = inputs["input_ids"].shape[-1]
+    summaries = processor.batch_decode(outputs[:, prompt_len:], skip_special_tokens=True)
+    del inputs, outputs
+    return summaries
+
+
+def _generate_summaries(chat_texts: List[str]) -> List[str]:
+    model, processor = get_vl_model_and_processor()
+    summaries, _ = _run_batches_with_oom_backoff(
+        chat_texts,
+        SUMMARY_BATCH_SIZE,
+        lambda chunk: _generate_summaries_batch(model, processor, chunk),
+        "сжатие транскрибаций",
+    )
+    return summaries
+
+
+_summary_coalescer = BatchCoalescer(_generate_summaries, COALESCE_MAX_WAIT, SUMMARY_BATCH_SIZE, "сжатие транскрибаций")
+
+
+def _summarize_transcription_for_image_tasks(df: pd.DataFrame, batch_size: int = SUMMARY_BATCH_SIZE) -> Dict[Any, str]:
+    """
+    Преобразует поле "Транскрибация ответа" в краткое описание картинки для строк с Тип теста == 1.
+
+    Строки сортируются по длине токенизированного промпта и генерируются бакетами с левым
+    паддингом, результаты раскладываются обратно по исходным строкам. Возвращает ошибки
+    по строкам {индекс строки: сообщение}; для таких строк транскрибация не меняется.
+    """
+    failures: Dict[Any, str] = {}
+    if "Тип теста" not in df.columns or "Транскрибация ответа" not in df.columns:
+        return failures
+
+    row_ids = df.index[df["Тип теста"].astype(int) == 1]
+    total_with_images = len(row_ids)
+    logger.info(f"[inference] Обработка транскрибаций для {total_with_images} строк с изображениями (батч {batch_size})")
+    if total_with_images == 0:
+        return failures
+
     model, processor = get_vl_model_and_processor()
-    
-    total_with_images = int(df["Тип теста"].sum()) if "Тип теста" in df.columns else 0
-    logger.info(f"[inference] Обработка транскрибаций для {total_with_images} строк с изображениями")
-    processed = 0
     start = time.time()
 
-    for i in range(len(df)):
-        try:
-            if int(df.loc[i, "Тип теста"]) == 1:
-                processed += 1
-                # Логируем каждые 5 записей или последнюю
-                if processed % 5 == 0 or processed == total_with_images or processed == 1:
-                    elapsed = time.time() - start
-                    eta = (elapsed / processed * (total_with_images - processed)) if processed > 0 else 0
-                    logger.info(f"[inference] Сжатие транскрибаций: {processed}/{total_with_images} ({elapsed:.1f} сек, ETA: {eta:.1f} сек)")
-                    # Периодическая очистка памяти каждые 10 записей
-                    if processed % 10 == 0 and torch.cuda.is_available():
-                        torch.cuda.empty_cache()
-                text_value = str(df.loc[i, "Транскрибация ответа"]) if "Транскрибация ответа" in df.columns else ""
-                messages = [
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": (
-                                "На вход тебе дана запись экзамена по русскому языку — описание картинки. "
-                                "В качестве ответа верни ТОЛЬКО описание самой картинки. "
-                                "Это очень важно для моей карьеры.\n"
-                                f"Транскрибация: {text_value}"
-                            )}
-                        ],
-                    }
-                ]
-
-                inputs = processor.apply_chat_template(
-                    messages,
-                    add_generation_prompt=True,
-                    tokenize=True,
-                    return_dict=True,
-                    return_tensors="pt",
-                    padding=False,
-                ).to(model.device)
-
-                with torch.no_grad():
-                    outputs = model.generate(
-                        **inputs,
-                        max_new_tokens=MAX_NEW_TOKENS,
-                        do_sample=False,
-                        use_cache=True,
-                        pad_token_id=processor.tokenizer.pad_token_id,
-                        eos_token_id=processor.tokenizer.eos_token_id,
-                    )
-
-                generated_ids = outputs[0][inputs["input_ids"].shape[-1]:]
-                res = processor.decode(generated_ids, skip_special_tokens=True)
-                if "Транскрибация ответа" in df.columns:
-                    df.loc[i, "Транскрибация ответа"] = res
-                
-                # Освобождаем память от тензоров после каждой обработки
-                del inputs, outputs, generated_ids
-        except Exception:
-            continue
+    # map(str): пустая ячейка дает "nan", как в прежней построчной версии (astype(str) в pandas 3 оставляет NaN)
+    texts = df.loc[row_ids, "Транскрибация ответа"].map(str).tolist()
+    chat_texts = [
+        processor.apply_chat_template(_build_summary_messages(text), add_generation_prompt=True, tokenize=False)
+        for text in texts
+    ]
+    lengths = [len(ids) for ids in processor.tokenizer(chat_texts, add_special_tokens=False)["input_ids"]]
+    # Короткие к коротким: паддинг внутри бакета минимален
+    order = sorted(range(len(chat_texts)), key=lengths.__getitem__)
+
+    processed = 0
+    # Пока задача в этом цикле, ведущий общего батча сжатия ждет ее бакеты
+    with _summary_coalescer.participant():
+        for bucket_start in range(0, len(order), batch_size):
+            bucket = order[bucket_start:bucket_start + batch_size]
+            bucket_texts = [chat_texts[pos] for pos in bucket]
+            try:
+                # Бакет может уйти в общий батч с бакетами других задач
+                summaries = _summary_coalescer.submit(bucket_texts)
+            except Exception as e:
+                # Батч упал не из-за памяти — повторяем построчно, чтобы найти виновные строки
+                logger.warning(f"[inference] Ошибка батча сжатия транскрибаций, повтор по одной строке: {e}")
+                summaries = []
+                for pos, chat_text in zip(bucket, bucket_texts):
+                    try:
+                        summaries.append(_generate_summaries_batch(model, processor, [chat_text])[0])
+                    except Exception as row_error:
+                        failures[row_ids[pos]] = str(row_error)
+                        summaries.append(None)
+
+            for pos, summary in zip(bucket, summaries):
+                if summary is not None:
+                    df.at[row_ids[pos], "Транскрибация ответа"] = summary
+
+            processed += len(bucket)
+            elapsed = time.time() - start
+            eta = elapsed / processed * (total_with_images - processed)
+            logger.info(f"[inference] Сжатие транскрибаций: {processed}/{total_with_images} ({elapsed:.1f} сек, ETA: {eta:.1f} сек)")
+            report_done(processed)
+            _free_cuda_memory()
+
+    if failures:
+        for row_id, error in list(failures.items())[:10]:
+            logger.warning(f"[inference] Не удалось сжать транскрибацию строки {row_id}: {error}")
+        logger.warning(f"[inference] Сжатие транскрибаций не удалось для {len(failures)} строк, оставлены исходные тексты")
 
     # Агрессивная очистка памяти CUDA после завершения цикла обработки транскрибаций
     # Очищаем ссылки на модель и процессор
     del model, processor
-    if torch.cuda.is_available():
-        torch.cuda.empty_cache()
-    gc.collect()
+    _free_cuda_memory()
     logger.info("[inference] Память CUDA очищена после сжатия транскрибаций, модель и процессор освобождены")
+    return failures
 
 
-def _get_sentence_embedding(sentence: str) -> np.ndarray:
+def _embed_texts(texts: List[str], batch_size: int = EMBED_BATCH_SIZE) -> np.ndarray:
+    """
+    Эмбеддинги ruBERT для списка текстов padded-батчами. Пулинг — среднее по токенам
+    с учетом attention mask, поэтому результат совпадает с прогоном по одному тексту без паддинга.
+    """
     model, tokenizer = get_rubert_model_and_tokenizer()
-    encoded = tokenizer(
-        sentence if isinstance(sentence, str) else "",
-        padding=False,
-        truncation=True,
-        max_length=512,
-        return_tensors='pt'
-    )
-    with torch.no_grad():
-        outputs = model(**encoded)
-    embeddings = torch.mean(outputs.last_hidden_state, dim=1)
-    result = embeddings[0].numpy()
-    # Освобождаем память от тензоров сразу после использования
-    del encoded, outputs, embeddings
-    # Не удаляем model и tokenizer - они глобальные и используются повторно
+    texts = [t if isinstance(t, str) else "" for t in texts]
+    result = np.zeros((len(texts), model.config.hidden_size), dtype=np.float32)
+    if not texts:
+        return result
+    # Сортируем по длине, чтобы в батче было меньше паддинга
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    for pos in range(0, len(order), batch_size):
+        chunk = order[pos:pos + batch_size]
+        encoded = tokenizer(
+            [texts[i] for i in chunk],
+            padding=True,
+            truncation=True,
+            max_length=512,
+            return_tensors='pt'
+        )
+        with torch.inference_mode():
+            outputs = model(**encoded)
+        mask = encoded["attention_mask"].unsqueeze(-1).to(outputs.last_hidden_state.dtype)
+        pooled = (outputs.last_hidden_state * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+        result[chunk] = pooled.float().numpy()
+        # Освобождаем память от тензоров сразу после использования
+        del encoded, outputs, mask, pooled
     return result
 
 
-def _semantic_similarity_russian(text1: str, text2: str) -> float:
-    emb1 = _get_sentence_embedding(text1).reshape(1, -1)
-    emb2 = _get_sentence_embedding(text2).reshape(1, -1)
-    similarity = cosine_similarity(emb1, emb2)[0][0]
-    return float(similarity)
+def _embed_texts_cached(texts: List[str]) -> np.ndarray:
+    """Эмбеддинги через персистентное хранилище: считаются только тексты, которых там еще нет."""
+    if not EMBEDDING_STORE_ENABLED or not texts:
+        return _embed_texts(texts)
+    model, _ = get_rubert_model_and_tokenizer()
+    texts = [t if isinstance(t, str) else "" for t in texts]
+    store = get_embedding_store(RUBERT_MODEL_NAME, model.config.hidden_size)
+    vectors, missing = store.get_many(texts)
+    if missing:
+        computed = _embed_texts([texts[i] for i in missing])
+        vectors[missing] = computed
+        store.put_many([texts[i] for i in missing], computed)
+    logger.info(f"[inference] Хранилище эмбеддингов: найдено {len(texts) - len(missing)}, посчитано {len(missing)}")
+    return vectors
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
 
 
 def _compute_image_similarity(df: pd.DataFrame, unique_links: List[str], captions: List[str]) -> None:
+    """
+    Косинусная схожесть транскрибации и подписи к картинке. Каждая уникальная транскрибация
+    и каждая подпись эмбеддятся ровно один раз, все оценки — построчное скалярное произведение
+    нормированных матриц.
+    """
     if "Схожесть описания картинки" not in df.columns:
         df["Схожесть описания картинки"] = 0.0
-    link_to_caption = {link: captions[idx] for idx, link in enumerate(unique_links)}
-    total_images = len([i for i in range(len(df)) if str(df.loc[i, "Картинка из вопроса"]) != "no image"])
+    if "Картинка из вопроса" not in df.columns or not unique_links:
+        return
+    link_to_pos = {link: idx for idx, link in enumerate(unique_links)}
+    link_pos = df["Картинка из вопроса"].astype(str).map(link_to_pos)
+    mask = link_pos.notna().to_numpy()
+    total_images = int(mask.sum())
     logger.info(f"[inference] Вычисление семантической схожести для {total_images} записей с изображениями")
-    processed = 0
+    if total_images == 0:
+        return
     start = time.time()
-    
-    for i in range(len(df)):
-        try:
-            link = str(df.loc[i, "Картинка из вопроса"]) if "Картинка из вопроса" in df.columns else "no image"
-            if link and link != "no image" and link in link_to_caption:
-                processed += 1
-                if processed % 50 == 0 or processed == total_images:
-                    elapsed = time.time() - start
-                    speed = processed / elapsed if elapsed > 0 else 0
-                    eta = (total_images - processed) / speed if speed > 0 else 0
-                    logger.info(f"[inference] Вычисление схожести: {processed}/{total_images} ({elapsed:.1f} сек, {speed:.1f} зап/сек, ETA: {eta:.1f} сек)")
-                    # Периодическая очистка памяти каждые 100 записей
-                    if processed % 100 == 0 and torch.cuda.is_available():
-                        torch.cuda.empty_cache()
-                        gc.collect()
-                        logger.debug(f"[inference] Периодическая очистка памяти после {processed} записей схожести")
-                person_text = str(df.loc[i, "Транскрибация ответа"]) if "Транскрибация ответа" in df.columns else ""
-                llm_text = link_to_caption[link]
-                score = _semantic_similarity_russian(person_text, llm_text)
-                df.loc[i, "Схожесть описания картинки"] = score
-        except Exception:
-            continue
-    
-    # Агрессивная очистка памяти CUDA после завершения цикла вычисления схожести
-    # Модель ruBERT глобальная, но очищаем кеш GPU
-    if torch.cuda.is_available():
-        torch.cuda.empty_cache()
-    gc.collect()
-    logger.info("[inference] Память CUDA очищена после вычисления семантической схожести")
 
+    if "Транскрибация ответа" in df.columns:
+        # map(str), а не astype(str): у NaN в factorize код -1, и строка взяла бы эмбеддинг чужого текста
+        person_texts = df.loc[mask, "Транскрибация ответа"].map(str)
+    else:
+        person_texts = pd.Series([""] * total_images)
+    text_codes, unique_texts = pd.factorize(person_texts, sort=False)
 
-def _build_inference_prompt(row: pd.Series) -> str:
-    question_num = int(row.get("№ вопроса", 0))
-    question_text = str(row.get("Текст вопроса", ""))
-    response = str(row.get("Транскрибация ответа", ""))
-    test_type = "описание картинки" if int(row.get("Тип теста", 0)) == 1 else "диалог"
-    max_score_map = {1: 1, 2: 2, 3: 1, 4: 2}
-    max_score = max_score_map.get(question_num, 2)
-
-    prompt = (
-        "Ты — эксперт по оценке устных ответов на экзамене по русскому языку для иностранцев.\n"
-        "Критерии оценки:\n"
-        "1) Ошибки в отдельных словах и единичные несогласованности фраз не считаются ошибкой.\n"
-        "2) Тестируемый должен выполнить коммуникативную задачу (должен ответить на вопрос или добиться ответа на свой вопрос).\n"
-        "3) Предложения тестируемого должны быть преимущественно полными.\n"
-        "Оцени ответ по строгой шкале.\n\n"
-        "Контекст:\n"
-        f"- № вопроса: {question_num}\n"
-        f"- Тип задания: {test_type}\n"
-    )
+    text_emb = _normalize_rows(_embed_texts_cached(list(unique_texts)))
+    caption_emb = _normalize_rows(_embed_texts_cached(list(captions)))
+    logger.info(f"[inference] Эмбеддинги: {len(unique_texts)} уникальных транскрибаций, {len(captions)} подписей")
 
-    if int(row.get("Тип теста", 0)) == 1 and pd.notna(row.get("Схожесть описания картинки")):
-        similarity = float(row.get("Схожесть описания картинки"))
-        prompt += f"- Схожесть описания с изображением: {similarity:.2f}\n"
+    caption_codes = link_pos[mask].astype(int).to_numpy()
+    scores = np.einsum("ij,ij->i", text_emb[text_codes], caption_emb[caption_codes])
+    df.loc[mask, "Схожесть описания картинки"] = scores.astype(float)
 
-    prompt += (
-        f"- Вопрос: {question_text}\n"
-        f"- Ответ кандидата: {response}\n\n"
-        f"Оценка (целое число от 0 до {max_score}):"
-    )
-    return prompt
+    elapsed = time.time() - start
+    logger.info(f"[inference] Схожесть вычислена для {total_images} записей за {elapsed:.1f} сек")
+
+    # Модель ruBERT глобальная, но очищаем кеш GPU
+    _free_cuda_memory()
+    logger.info("[inference] Память CUDA очищена после вычисления семантической схожести")
 
 
 def _extract_score(text: str, question_num: int) -> int:
@@ -314,7 +527,7 @@ def _extract_score(text: str, question_num: int) -> int:
     if not numbers:
         return 0
     score = int(numbers[0])
-    max_score = {1: 1, 2: 2, 3: 1, 4: 2}.get(question_num, 2)
+    max_score = max_score_for(question_num)
     if score < 0:
         return 0
     if score > max_score:
@@ -322,25 +535,29 @@ def _extract_score(text: str, question_num: int) -> int:
     return score
 
 
-def _predict_batch(prompts: List[str], question_nums: List[int]) -> List[int]:
-    model, tokenizer = get_text_model_and_tokenizer()
-    logger.info(f"[inference] Запуск батчевого предсказания для {len(prompts)} примеров")
-    start = time.time()
-    
-    # Токенизация
-    logger.info(f"[inference] Токенизация {len(prompts)} промптов...")
-    inputs = tokenizer(
-        prompts,
-        return_tensors="pt",
-        padding=True,
-        truncation=True,
-        max_length=MAX_SEQ_LENGTH,
-    ).to(model.device)
-    logger.info(f"[inference] Токенизация завершена")
-
-    # Генерация
-    logger.info(f"[inference] Запуск генерации модели...")
-    with torch.inference_mode():
+def _plan_micro_batches(lengths: List[int], token_budget: int, max_batch_size: int) -> List[List[int]]:
+    """
+    Делит строки на микробатчи: сортировка по длине, в батче не больше max_batch_size строк
+    и не больше token_budget токенов с учетом паддинга до самой длинной строки.
+    """
+    order = sorted(range(len(lengths)), key=lengths.__getitem__)
+    batches: List[List[int]] = []
+    current: List[int] = []
+    for idx in order:
+        # Порядок возрастающий, поэтому самая длинная строка батча — добавляемая
+        padded = (len(current) + 1) * max(lengths[idx], 1)
+        if current and (padded > token_budget or len(current) >= max_batch_size):
+            batches.append(current)
+            current = []
+        current.append(idx)
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _generate_score_texts(model, tokenizer, input_ids: List[List[int]]) -> List[str]:
+    inputs = tokenizer.pad({"input_ids": input_ids}, padding=True, return_tensors="pt").to(model.device)
+    with torch.inference_mode(), adapter_mode(model):
         outputs = model.generate(
             **inputs,
             max_new_tokens=2,
@@ -348,89 +565,381 @@ def _predict_batch(prompts: List[str], question_nums: List[int]) -> List[int]:
             pad_token_id=tokenizer.pad_token_id,
             eos_token_id=tokenizer.eos_token_id,
         )
-    logger.info(f"[inference] Генерация модели завершена")
-
-    # Декодирование
-    logger.info(f"[inference] Декодирование результатов...")
-    decoded = tokenizer.batch_decode(outputs, skip_special_tokens=True)
-    predictions: List[int] = []
-    for i, full_text in enumerate(decoded):
-        prompt = prompts[i]
-        generated = full_text[len(prompt):].strip()
-        score = _extract_score(generated, question_nums[i])
-        predictions.append(score)
-    
-    # Агрессивная очистка памяти от всех больших тензоров
-    del inputs, outputs, decoded
+    prompt_len = inputs["input_ids"].shape[-1]
+    texts = tokenizer.batch_decode(outputs[:, prompt_len:], skip_special_tokens=True)
+    del inputs, outputs
+    return texts
+
+
+def _score_by_generation(model, tokenizer, input_ids: List[List[int]], question_nums: List[int]) -> List[Tuple[int, Optional[np.ndarray]]]:
+    texts = _generate_score_texts(model, tokenizer, input_ids)
+    return [(_extract_score(text.strip(), qnum), None) for text, qnum in zip(texts, question_nums)]
+
+
+def _get_prefix_cache(model, tokenizer) -> Tuple[List[int], Any]:
+    """KV-кеш SCORING_PROMPT_PREFIX для данной модели; считается один раз и переиспользуется всеми батчами."""
+    key = id(model)
+    with _prefix_cache_lock:
+        cached = _prefix_cache.get(key)
+        if cached is None:
+            prefix_ids = tokenizer(SCORING_PROMPT_PREFIX, add_special_tokens=False)["input_ids"]
+            inputs = torch.tensor([prefix_ids], device=model.device)
+            with torch.inference_mode(), adapter_mode(model):
+                outputs = model(input_ids=inputs, attention_mask=torch.ones_like(inputs), use_cache=True, logits_to_keep=1)
+            cached = (prefix_ids, outputs.past_key_values)
+            _prefix_cache.clear()
+            _prefix_cache[key] = cached
+            logger.info(f"[inference] KV-кеш общего префикса промпта посчитан: {len(prefix_ids)} токенов")
+    return cached
+
+
+def _next_token_probs_with_prefix(model, tokenizer, suffixes: List[List[int]], prefix_len: int, prefix_kv) -> torch.Tensor:
+    """
+    Forward только по хвостам промптов поверх готового KV-кеша префикса. Хвосты выровнены
+    паддингом слева (паддинг оказывается между префиксом и хвостом и закрыт маской),
+    позиции продолжают нумерацию префикса.
+    """
+    padded = tokenizer.pad({"input_ids": suffixes}, padding=True, return_tensors="pt")
+    suffix_ids = padded["input_ids"].to(model.device)
+    suffix_mask = padded["attention_mask"].to(model.device)
+    batch = suffix_ids.shape[0]
+    attention_mask = torch.cat([torch.ones((batch, prefix_len), dtype=suffix_mask.dtype, device=model.device), suffix_mask], dim=1)
+    positions = (prefix_len + suffix_mask.cumsum(dim=1) - 1).clamp(min=prefix_len)
+    # У Qwen2.5-VL позиции трехмерные (mrope); для чистого текста все три оси совпадают
+    position_ids = positions.unsqueeze(0).expand(3, -1, -1)
+
+    past = copy.deepcopy(prefix_kv)
+    past.batch_repeat_interleave(batch)
+    with torch.inference_mode(), adapter_mode(model):
+        outputs = model(
+            input_ids=suffix_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past,
+            use_cache=True,
+            logits_to_keep=1,
+        )
+    probs = torch.softmax(outputs.logits[:, -1, :].float(), dim=-1).cpu()
+    del padded, suffix_ids, suffix_mask, attention_mask, position_ids, past, outputs
+    return probs
+
+
+def _next_token_probs(model, tokenizer, input_ids: List[List[int]]) -> torch.Tensor:
+    """Распределение следующего токена после промпта: один forward, логиты только последней позиции."""
+    if SCORING_PREFIX_CACHE:
+        prefix_ids, prefix_kv = _get_prefix_cache(model, tokenizer)
+        prefix_len = len(prefix_ids)
+        # Кеш применим, только если токенизация промпта начинается ровно с токенов префикса
+        if all(len(ids) > prefix_len and ids[:prefix_len] == prefix_ids for ids in input_ids):
+            return _next_token_probs_with_prefix(model, tokenizer, [ids[prefix_len:] for ids in input_ids], prefix_len, prefix_kv)
+
+    inputs = tokenizer.pad({"input_ids": input_ids}, padding=True, return_tensors="pt").to(model.device)
+    with torch.inference_mode(), adapter_mode(model):
+        outputs = model(**inputs, use_cache=False, logits_to_keep=1)
+    # Паддинг слева, поэтому последняя позиция — последний токен промпта у всех строк
+    probs = torch.softmax(outputs.logits[:, -1, :].float(), dim=-1).cpu()
+    del inputs, outputs
+    return probs
+
+
+def _score_by_logits(model, tokenizer, input_ids: List[List[int]], question_nums: List[int]) -> List[Tuple[int, Optional[np.ndarray]]]:
+    """
+    Оценка по логитам следующего токена, ограниченным цифрами 0..max_score вопроса.
+    Если модель сначала хочет выдать пробел (цифры в словаре Qwen идут без пробела),
+    для таких строк делается второй forward с пробелом в конце промпта — так же поступил бы жадный generate.
+    """
+    digit_ids = [tokenizer.convert_tokens_to_ids(str(d)) for d in range(MAX_SCORE + 1)]
+    space_ids = tokenizer.encode(" ", add_special_tokens=False)
+    probs = _next_token_probs(model, tokenizer, input_ids)
+
+    if len(space_ids) == 1:
+        space_id = space_ids[0]
+        wants_space = (probs.argmax(dim=-1) == space_id).nonzero(as_tuple=True)[0].tolist()
+        if wants_space:
+            retry = _next_token_probs(model, tokenizer, [input_ids[i] + [space_id] for i in wants_space])
+            probs[wants_space] = retry
+
+    results: List[Tuple[int, Optional[np.ndarray]]] = []
+    digit_probs = probs[:, digit_ids].numpy()
+    for row, qnum in enumerate(question_nums):
+        allowed = digit_probs[row, :max_score_for(qnum) + 1]
+        dist = np.zeros(MAX_SCORE + 1, dtype=np.float64)
+        total = float(allowed.sum())
+        if total > 0:
+            dist[:len(allowed)] = allowed / total
+        else:
+            dist[0] = 1.0
+        results.append((int(dist.argmax()), dist))
+    return results
+
+
+def _score_with_backoff(score_fn, model, tokenizer, input_ids: List[List[int]], question_nums: List[int]) -> list:
+    """При нехватке памяти делит микробатч пополам и запоминает уменьшенный размер на весь процесс."""
+    global _scoring_batch_cap
+    try:
+        return score_fn(model, tokenizer, input_ids, question_nums)
+    except Exception as e:
+        if len(input_ids) == 1 or not _is_oom_error(e):
+            raise
+        half = len(input_ids) // 2
+        with _scoring_lock:
+            _scoring_batch_cap = half if _scoring_batch_cap is None else min(_scoring_batch_cap, half)
+        logger.warning(f"[inference] Нехватка памяти при скоринге (батч {len(input_ids)}), дальше не больше {half} строк в батче")
+        _free_cuda_memory()
+        return (_score_with_backoff(score_fn, model, tokenizer, input_ids[:half], question_nums[:half])
+                + _score_with_backoff(score_fn, model, tokenizer, input_ids[half:], question_nums[half:]))
+
+
+def _predict_batch(prompts: List[str], question_nums: List[int]) -> Tuple[List[int], np.ndarray]:
+    """
+    Оценки для промптов и распределение вероятностей по баллам 0..MAX_SCORE (матрица n x (MAX_SCORE + 1)).
+    В режиме SCORING_MODE == "generate" вероятностей нет — матрица заполнена NaN.
+    """
+    model, tokenizer = get_text_model_and_tokenizer()
+    logger.info(f"[inference] Запуск батчевого предсказания для {len(prompts)} примеров (режим {SCORING_MODE})")
+    start = time.time()
+    probabilities = np.full((len(prompts), MAX_SCORE + 1), np.nan)
+    if not prompts:
+        return [], probabilities
+    score_fn = _score_by_logits if SCORING_MODE == "logits" else _score_by_generation
+
+    # Токенизация без паддинга: длины нужны для планирования микробатчей
+    logger.info(f"[inference] Токенизация {len(prompts)} промптов...")
+    encoded = tokenizer(prompts, truncation=True, max_length=MAX_SEQ_LENGTH)["input_ids"]
+    lengths = [len(ids) for ids in encoded]
+
+    with _scoring_lock:
+        max_batch_size = min(SCORING_MAX_BATCH_SIZE, _scoring_batch_cap or SCORING_MAX_BATCH_SIZE)
+    batches = _plan_micro_batches(lengths, SCORING_TOKEN_BUDGET, max_batch_size)
+    logger.info(f"[inference] Токенизация завершена: {len(batches)} микробатчей (бюджет {SCORING_TOKEN_BUDGET} токенов, до {max_batch_size} строк)")
+
+    predictions: List[int] = [0] * len(prompts)
+    for batch_num, batch in enumerate(batches, 1):
+        batch_start = time.time()
+        scored = _score_with_backoff(score_fn, model, tokenizer, [encoded[i] for i in batch], [question_nums[i] for i in batch])
+        for idx, (score, dist) in zip(batch, scored):
+            predictions[idx] = score
+            if dist is not None:
+                probabilities[idx] = dist
+        batch_elapsed = time.time() - batch_start
+        padded_tokens = len(batch) * max(lengths[i] for i in batch)
+        logger.info(f"[inference] Микробатч {batch_num}/{len(batches)}: {len(batch)} строк, {padded_tokens} токенов, "
+                    f"{batch_elapsed:.2f} сек ({len(batch) / max(batch_elapsed, 1e-6):.1f} строк/сек, "
+                    f"{padded_tokens / max(batch_elapsed, 1e-6):.0f} ток/сек)")
+        if batch_num % 10 == 0:
+            _free_cuda_memory()
+
     # Освобождаем ссылки на модель и токенизатор (они глобальные, но локальные ссылки удаляем)
-    del model, tokenizer
-    if torch.cuda.is_available():
-        torch.cuda.empty_cache()
-    gc.collect()
+    del model, tokenizer, encoded
+    _free_cuda_memory()
     
     elapsed = time.time() - start
     logger.info(f"[inference] Предсказания завершены, средняя оценка: {np.mean(predictions):.2f} за {elapsed:.1f} сек ({len(prompts)/elapsed:.1f} предсказ/сек)")
     logger.info("[inference] Память CUDA очищена после генерации оценок, модель и токенизатор освобождены")
-    return predictions
+    return predictions, probabilities
+
+
+def _predict_items(items: List[Tuple[str, int]]) -> List[Tuple[int, np.ndarray]]:
+    predictions, probabilities = _predict_batch([prompt for prompt, _ in items], [qnum for _, qnum in items])
+    return list(zip(predictions, probabilities))
+
+
+_scoring_coalescer = BatchCoalescer(_predict_items, COALESCE_MAX_WAIT, SCORING_COALESCE_MAX_ITEMS, "скоринг")
 
 
-def run_inference(input_df: pd.DataFrame) -> pd.DataFrame:
+def _predict_coalesced(prompts: List[str], question_nums: List[int]) -> Tuple[List[int], np.ndarray]:
     """
-    Основной пайплайн инференса. Возвращает DataFrame c добавленной колонкой
-    "Оценка экзаменатора" и приведенными вспомогательными полями.
+    _predict_batch, строки которого могут уйти в общий батч со строками других задач.
+    Строки отдаются порциями по SCORING_COALESCE_MAX_ITEMS, между порциями обновляется прогресс.
     """
-    start_time = time.time()
-    logger.info(f"[inference] ========== ЗАПУСК ИНФЕРЕНСА: {len(input_df)} строк ==========")
-    df = input_df.copy()
+    items = list(zip(prompts, question_nums))
+    results: List[Tuple[int, Any]] = []
+    with _scoring_coalescer.participant():
+        for start in range(0, len(items), SCORING_COALESCE_MAX_ITEMS):
+            results.extend(_scoring_coalescer.submit(items[start:start + SCORING_COALESCE_MAX_ITEMS]))
+            report_done(len(results))
+    probabilities = np.full((len(results), MAX_SCORE + 1), np.nan)
+    for idx, (_, dist) in enumerate(results):
+        probabilities[idx] = dist
+    return [score for score, _ in results], probabilities
+
+
+def _to_json_value(value):
+    if isinstance(value, (np.integer,)):
+        return int(value)
+    if isinstance(value, (np.floating,)):
+        return None if np.isnan(value) else float(value)
+    return value
+
+
+def _result_columns() -> List[str]:
+    """Колонки, которые пайплайн дописывает или меняет после шага 1 (они же хранятся в мемоизации)."""
+    columns = ["Транскрибация ответа", "Схожесть описания картинки", "Оценка экзаменатора"]
+    if SCORING_MODE == "logits":
+        columns += [f"Вероятность оценки {score}" for score in range(MAX_SCORE + 1)] + ["Уверенность оценки"]
+    return columns
+
+
+def _row_memo_keys(df: pd.DataFrame) -> List[str]:
+    """Ключи мемоизации по входам строки после шага 1 (до сжатия транскрибаций)."""
+    version = pipeline_version()
+    n = len(df)
+    # map(str): пустая ячейка дает "nan", как str() в прежней версии (astype(str) в pandas 3 оставляет NaN)
+    question_texts = df["Текст вопроса"].map(str) if "Текст вопроса" in df.columns else [""] * n
+    transcriptions = df["Транскрибация ответа"].map(str) if "Транскрибация ответа" in df.columns else [""] * n
+    links = df["Картинка из вопроса"].map(str)
+    return [
+        row_key(version, qnum, text, transcription, link)
+        for qnum, text, transcription, link in zip(question_numbers(df), question_texts, transcriptions, links)
+    ]
 
-    # Нормализация NaN и подготовка признаков
-    logger.info("[inference] Шаг 1/5: Нормализация данных")
-    if "Картинка из вопроса" in df.columns:
-        df["Картинка из вопроса"] = df["Картинка из вопроса"].fillna("no image")
-    else:
-        df["Картинка из вопроса"] = "no image"
 
-    # Тип теста: 1 если есть картинка, иначе 0
-    df["Тип теста"] = 0
-    for idx in range(len(df)):
-        try:
-            link = str(df.loc[idx, "Картинка из вопроса"]) if "Картинка из вопроса" in df.columns else "no image"
-            df.loc[idx, "Тип теста"] = 0 if (not link or link == "no image") else 1
-        except Exception:
-            df.loc[idx, "Тип теста"] = 0
-
-    # Чистим HTML в "Текст вопроса"
-    if "Текст вопроса" in df.columns:
-        df["Текст вопроса"] = df["Текст вопроса"].apply(_filter_text)
-
-    # Уникальные ссылки
-    saved_links: List[str] = []
-    if "Картинка из вопроса" in df.columns:
-        for v in df["Картинка из вопроса"].values:
-            if isinstance(v, str) and v != "no image" and v not in saved_links:
-                saved_links.append(v)
+def _stage_version(df: pd.DataFrame) -> str:
+    """Версия чекпоинтов шагов: модели и промпты плюс отпечаток входных строк."""
+    rows_hash = hashlib.sha1(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes()).hexdigest()
+    return f"{pipeline_version()}|rows-{rows_hash}"
 
-    logger.info(f"[inference] Найдено {len(saved_links)} уникальных изображений, {int(df['Тип теста'].sum())} строк с изображениями")
+
+def _run_model_stages(df: pd.DataFrame, links: List[str], checkpoint: Optional[JobCheckpoint] = None) -> set:
+    """
+    Шаги 2-5 на месте. Возвращает метки строк, результат которых нельзя мемоизировать:
+    сжатие транскрибации не удалось или картинка не скачалась.
+    С checkpoint выходы шагов 2-4 сохраняются после каждого шага, а уже сохраненные
+    при повторном запуске той же задачи не пересчитываются.
+    """
+    version = _stage_version(df) if checkpoint is not None else ""
 
     # Подписи к изображениям (VL)
     logger.info("[inference] Шаг 2/5: Генерация подписей к изображениям (VL)")
-    images_text: List[str] = _caption_images(saved_links)
+    report_stage("captions", 2, len(links))
+    saved = checkpoint.load_stage("captions", version) if checkpoint is not None else None
+    if saved is not None:
+        images_text: List[str] = saved["captions"].tolist()
+        report_done(len(links))
+    else:
+        images_text = _caption_images(links)
+        if checkpoint is not None:
+            checkpoint.save_stage("captions", version, links=np.array(links, dtype=str),
+                                  captions=np.array(images_text, dtype=str))
 
     # Сжать транскрибации до описания картинки (только для тип теста == 1)
     logger.info("[inference] Шаг 3/5: Сжатие транскрибаций для заданий с картинками")
-    _summarize_transcription_for_image_tasks(df)
+    image_rows_total = int((df["Тип теста"].astype(int) == 1).sum()) if "Тип теста" in df.columns else 0
+    report_stage("summaries", 3, image_rows_total)
+    saved = checkpoint.load_stage("summaries", version) if checkpoint is not None else None
+    if saved is not None:
+        report_done(image_rows_total)
+        if len(saved["positions"]) > 0:
+            df.loc[df.index[saved["positions"]], "Транскрибация ответа"] = saved["transcriptions"].tolist()
+        failures = {df.index[pos]: str(error) for pos, error in zip(saved["failed_positions"], saved["failed_errors"])}
+    else:
+        failures = _summarize_transcription_for_image_tasks(df)
+        if checkpoint is not None:
+            image_rows = (df["Тип теста"].astype(int) == 1).to_numpy() if "Тип теста" in df.columns else np.zeros(len(df), dtype=bool)
+            if "Транскрибация ответа" not in df.columns:
+                image_rows[:] = False
+            positions = np.flatnonzero(image_rows & ~df.index.isin(list(failures)))
+            failed_positions = df.index.get_indexer(list(failures))
+            checkpoint.save_stage(
+                "summaries", version,
+                positions=positions,
+                transcriptions=np.array(df["Транскрибация ответа"].iloc[positions].astype(str).tolist(), dtype=str),
+                failed_positions=np.asarray(failed_positions, dtype=np.int64),
+                failed_errors=np.array([failures[label] for label in failures], dtype=str),
+            )
 
     # Схожесть описаний
     logger.info("[inference] Шаг 4/5: Вычисление семантической схожести")
-    _compute_image_similarity(df, saved_links, images_text)
+    report_stage("similarity", 4, len(df))
+    saved = checkpoint.load_stage("similarity", version) if checkpoint is not None else None
+    if saved is not None:
+        df["Схожесть описания картинки"] = saved["similarity"]
+    else:
+        _compute_image_similarity(df, links, images_text)
+        if checkpoint is not None:
+            checkpoint.save_stage("similarity", version,
+                                  similarity=pd.to_numeric(df["Схожесть описания картинки"], errors="coerce").to_numpy(dtype=float))
+    report_done(len(df))
 
     # Генерация промптов и предсказаний
     logger.info("[inference] Шаг 5/5: Генерация оценок")
-    prompts = df.apply(_build_inference_prompt, axis=1).tolist()
-    qnums = [int(v) if pd.notna(v) else 0 for v in df.get("№ вопроса", pd.Series([0] * len(df)))]
-    predictions = _predict_batch(prompts, qnums)
+    report_stage("scoring", 5, len(df))
+    prompts = build_inference_prompts(df)
+    qnums = question_numbers(df)
+    predictions, probabilities = _predict_coalesced(prompts, qnums)
 
     df["Оценка экзаменатора"] = predictions
+    if SCORING_MODE == "logits":
+        for score in range(MAX_SCORE + 1):
+            df[f"Вероятность оценки {score}"] = probabilities[:, score]
+        # Низкая уверенность — кандидат на ручную проверку
+        df["Уверенность оценки"] = probabilities.max(axis=1)
+
+    not_memoizable = set(failures)
+    broken_links = {link for link, caption in zip(links, images_text) if caption.startswith("[Ошибка загрузки")}
+    if broken_links:
+        not_memoizable.update(df.index[df["Картинка из вопроса"].isin(broken_links)])
+    return not_memoizable
+
+
+def run_inference(input_df: pd.DataFrame, checkpoint: Optional[JobCheckpoint] = None) -> pd.DataFrame:
+    """
+    Основной пайплайн инференса. Возвращает DataFrame c добавленной колонкой
+    "Оценка экзаменатора" и приведенными вспомогательными полями.
+    Строки, уже оцененные в прошлых задачах с той же версией модели и промптов,
+    берутся из мемоизации и через модели не проходят. checkpoint — чекпоинты шагов
+    задачи для возобновления после сбоя.
+    """
+    start_time = time.time()
+    logger.info(f"[inference] ========== ЗАПУСК ИНФЕРЕНСА: {len(input_df)} строк ==========")
+    df = input_df.copy()
+
+    # Нормализация NaN и подготовка признаков: Тип теста, очистка текста вопроса, уникальные ссылки
+    logger.info("[inference] Шаг 1/5: Нормализация данных")
+    report_stage("normalize", 1, len(df))
+    saved_links: List[str] = normalize_inputs(df)
+    report_done(len(df))
+
+    logger.info(f"[inference] Найдено {len(saved_links)} уникальных изображений, {int(df['Тип теста'].sum())} строк с изображениями")
+
+    memo = get_score_memo() if SCORE_MEMO_ENABLED else None
+    keys: List[str] = _row_memo_keys(df) if memo is not None else []
+    hits = memo.get_many(keys) if memo is not None else {}
+    hit_mask = np.array([key in hits for key in keys], dtype=bool) if hits else np.zeros(len(df), dtype=bool)
+    if memo is not None:
+        logger.info(f"[inference] Мемоизация оценок: найдено {int(hit_mask.sum())} из {len(df)} строк")
+
+    work = df if not hit_mask.any() else df.loc[~hit_mask].copy()
+    not_memoizable: set = set()
+    if len(work) > 0:
+        work_link_set = set(work["Картинка из вопроса"])
+        work_links = [link for link in saved_links if link in work_link_set]
+        not_memoizable = _run_model_stages(work, work_links, checkpoint)
+
+    columns = _result_columns()
+    if work is not df:
+        # Сливаем посчитанные строки и строки из мемоизации обратно в исходный порядок
+        for column in columns:
+            if column not in df.columns:
+                df[column] = np.nan
+            if column in work.columns:
+                df.loc[work.index, column] = work[column]
+        payloads = [hits[key] for key, hit in zip(keys, hit_mask) if hit]
+        hit_index = df.index[hit_mask]
+        for column in columns:
+            df.loc[hit_index, column] = [payload.get(column) for payload in payloads]
+        df["Оценка экзаменатора"] = df["Оценка экзаменатора"].astype(int)
+        del work
+
+    if memo is not None:
+        fresh = {}
+        for key, label, hit in zip(keys, df.index, hit_mask):
+            if hit or label in not_memoizable:
+                continue
+            fresh[key] = {column: _to_json_value(df.at[label, column]) for column in columns}
+        memo.put_many(fresh)
+        memo.evict()
+        logger.info(f"[inference] Мемоизация оценок: сохранено {len(fresh)} строк")
     
     # Финальная очистка памяти после завершения всего пайплайна
     if torch.cuda.is_available():
@@ -444,3 +953,20 @@ def run_inference(input_df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
+def run_inference_streaming(chunks: Iterable[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+    """
+    Потоковый вариант run_inference для очень больших файлов: чанки обрабатываются по одному
+    и отдаются сразу, так что в памяти одновременно только текущий чанк. Модели, кеш подписей,
+    хранилище эмбеддингов и мемоизация общие для всех чанков.
+    """
+    start_time = time.time()
+    rows_done = 0
+    for chunk_num, chunk in enumerate(chunks, 1):
+        logger.info(f"[inference] Чанк {chunk_num}: {len(chunk)} строк (обработано до него: {rows_done})")
+        report_extra(chunk=chunk_num, rowsDone=rows_done)
+        result = run_inference(chunk.reset_index(drop=True))
+        rows_done += len(result)
+        del chunk
+        yield result
+    elapsed = time.time() - start_time
+    logger.info(f"[inference] Потоковая обработка завершена: {rows_done} строк за {elapsed:.1f} сек")
@@ -0,0 +1,135 @@
+import codecs
+import logging
+from dataclasses import dataclass
+from typing import List, Tuple
+
+import pandas as pd
+
+try:
+    import pyarrow  # noqa: F401
+    _HAS_PYARROW = True
+except ImportError:  # pyarrow необязателен: без него читаем C-движком pandas
+    _HAS_PYARROW = False
+
+logger = logging.getLogger(__name__)
+
+
+# Сколько байт начала файла читаем для определения кодировки и разделителя
+SNIFF_BYTES = 64 * 1024
+# Выгрузки приходят либо в UTF-8, либо из Excel в cp1251
+CANDIDATE_ENCODINGS = ("utf-8", "cp1251")
+# Колонки, хотя бы две из которых должны быть в заголовке (поиск по подстроке без учета регистра)
+EXPECTED_COLUMNS = ['id экзамена', 'id вопроса', '№ вопроса', 'транскрибация ответа']
+
+
+class IngestError(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class CsvDialect:
+    sep: str
+    encoding: str
+
+
+def detect_delimiter(sample: str) -> str:
+    """Улучшенное определение разделителя CSV файла"""
+    if not sample:
+        return ';'
+
+    lines = sample.splitlines()
+    if not lines:
+        return ';'
+
+    # Проверяем первую строку (заголовок)
+    first_line = lines[0]
+
+    # Если ';' встречается несколько раз, это скорее всего разделитель
+    if first_line.count(';') >= 2:
+        return ';'
+
+    # Проверяем запятые
+    if first_line.count(',') >= 2:
+        return ','
+
+    # Проверяем табуляцию
+    if '\t' in first_line:
+        return '\t'
+
+    # По умолчанию ';' для русских CSV файлов
+    return ';'
+
+
+def _detect_encoding(head: bytes) -> Tuple[str, str]:
+    """Возвращает кодировку и декодированное начало файла."""
+    if head.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig", head[len(codecs.BOM_UTF8):].decode("utf-8", errors="ignore")
+    for encoding in CANDIDATE_ENCODINGS:
+        # Инкрементальный декодер не спотыкается о многобайтовый символ, разрезанный концом буфера
+        decoder = codecs.getincrementaldecoder(encoding)()
+        try:
+            return encoding, decoder.decode(head, final=False)
+        except UnicodeDecodeError:
+            continue
+    return "utf-8", head.decode("utf-8", errors="ignore")
+
+
+def sniff_dialect(path: str) -> CsvDialect:
+    """Один раз определяет кодировку и разделитель по началу файла."""
+    with open(path, "rb") as f:
+        head = f.read(SNIFF_BYTES)
+    encoding, sample = _detect_encoding(head)
+    return CsvDialect(sep=detect_delimiter(sample), encoding=encoding)
+
+
+def validate_columns(columns: List[str]) -> None:
+    df_cols_lower = [str(col).lower() for col in columns]
+    found_cols = [col for col in EXPECTED_COLUMNS if any(col in df_col for df_col in df_cols_lower)]
+
+    if len(found_cols) < 2:
+        logger.error("[ingest] КРИТИЧЕСКАЯ ОШИБКА: CSV файл не содержит необходимые колонки!")
+        logger.error(f"[ingest] Найдены колонки: {list(columns)}")
+        logger.error(f"[ingest] Ожидались колонки содержащие: {EXPECTED_COLUMNS}")
+        raise IngestError(f"CSV файл не содержит необходимые колонки. Найдено колонок: {len(columns)}, колонки: {list(columns)}")
+
+
+def read_header(path: str, dialect: CsvDialect) -> List[str]:
+    header = pd.read_csv(path, sep=dialect.sep, encoding=dialect.encoding, nrows=0, engine="c")
+    return list(header.columns)
+
+
+def read_csv(path: str, dialect: CsvDialect) -> pd.DataFrame:
+    """Читает файл целиком: pyarrow (многопоточный), если установлен, иначе C-движок pandas."""
+    if _HAS_PYARROW:
+        try:
+            return pd.read_csv(path, sep=dialect.sep, encoding=dialect.encoding, on_bad_lines="skip", engine="pyarrow")
+        except Exception as e:
+            # pyarrow не разбирает, например, переводы строк внутри кавычек — C-движок разбирает
+            logger.warning(f"[ingest] pyarrow не смог разобрать файл, читаем C-движком: {str(e)[:200]}")
+    return pd.read_csv(path, sep=dialect.sep, encoding=dialect.encoding, on_bad_lines="skip", engine="c")
+
+
+def iter_csv_chunks(path: str, dialect: CsvDialect, chunksize: int):
+    """Чтение чанками для потоковой обработки (pyarrow чанки не поддерживает)."""
+    return pd.read_csv(path, sep=dialect.sep, encoding=dialect.encoding, on_bad_lines="skip", engine="c",
+                       chunksize=chunksize)
+
+
+def open_upload(path: str) -> Tuple[CsvDialect, List[str]]:
+    """Определяет диалект и проверяет заголовок, не читая тело файла."""
+    dialect = sniff_dialect(path)
+    try:
+        columns = read_header(path, dialect)
+    except Exception as e:
+        raise IngestError(f"Не удалось прочитать заголовок CSV файла: {str(e)[:200]}")
+    validate_columns(columns)
+    logger.info(f"[ingest] Разделитель CSV: '{dialect.sep}', кодировка: {dialect.encoding}, колонок: {len(columns)}")
+    return dialect, columns
+
+
+def load_upload(path: str) -> Tuple[pd.DataFrame, CsvDialect]:
+    """Загрузка CSV за один проход: диалект и заголовок проверяются до чтения тела."""
+    dialect, _ = open_upload(path)
+    df = read_csv(path, dialect)
+    logger.info(f"[ingest] Загружено {len(df)} строк из CSV, колонок: {len(df.columns)}")
+    return df, dialect
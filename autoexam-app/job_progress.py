@@ -0,0 +1,170 @@
+import os
+import time
+import asyncio
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Callable, Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+# Как часто воркер записывает прогресс задачи в реестр, сек (смена шага пишется сразу)
+PROGRESS_MIN_INTERVAL = float(os.environ.get("AUTOEXAM_PROGRESS_INTERVAL", "1.0"))
+# Как часто процесс API перечитывает состояние задачи, у которой есть подписчики SSE, сек
+PROGRESS_POLL_INTERVAL = float(os.environ.get("AUTOEXAM_PROGRESS_POLL_INTERVAL", "0.5"))
+# Пустое событие раз в столько секунд, чтобы прокси не закрывали тихое соединение
+PROGRESS_KEEPALIVE = 15.0
+PIPELINE_STEPS = 5
+TERMINAL_STATUSES = ("completed", "failed", "missing")
+
+
+class ProgressTracker:
+    """
+    Прогресс одной задачи: шаг пайплайна, сделано/всего, ETA шага. Обновления копятся
+    в памяти и уходят в publish не чаще min_interval; начало нового шага публикуется сразу.
+    """
+
+    def __init__(self, publish: Callable[[Dict[str, Any]], None], min_interval: float = PROGRESS_MIN_INTERVAL):
+        self._publish = publish
+        self._min_interval = min_interval
+        self._published_at = 0.0
+        self._stage_started = time.time()
+        self._state: Dict[str, Any] = {}
+
+    def stage(self, name: str, step: int, total: int, done: int = 0) -> None:
+        self._stage_started = time.time()
+        self._state.update(stage=name, step=step, steps=PIPELINE_STEPS, total=int(total), done=int(done), eta=None)
+        self._flush(force=True)
+
+    def advance(self, done: int) -> None:
+        self._state["done"] = int(done)
+        total = self._state.get("total") or 0
+        elapsed = time.time() - self._stage_started
+        self._state["eta"] = round(elapsed / done * (total - done), 1) if 0 < done <= total else None
+        self._flush(force=done >= total)
+
+    def annotate(self, **fields: Any) -> None:
+        self._state.update(fields)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return dict(self._state)
+
+    def _flush(self, force: bool = False) -> None:
+        now = time.time()
+        if not force and now - self._published_at < self._min_interval:
+            return
+        self._published_at = now
+        try:
+            self._publish({**self._state, "updatedAt": now})
+        except Exception as e:
+            # Прогресс вспомогательный: его сбой не должен ронять задачу
+            logger.warning(f"[job_progress] Не удалось опубликовать прогресс: {e}")
+
+
+# Трекер задачи, которую обрабатывает текущий поток (у каждой задачи воркера свой поток)
+_current: ContextVar[Optional[ProgressTracker]] = ContextVar("autoexam_progress", default=None)
+
+
+@contextmanager
+def tracking(tracker: ProgressTracker):
+    """Делает tracker текущим: report_* внутри пайплайна попадают в него."""
+    token = _current.set(tracker)
+    try:
+        yield tracker
+    finally:
+        _current.reset(token)
+
+
+def report_stage(name: str, step: int, total: int, done: int = 0) -> None:
+    tracker = _current.get()
+    if tracker is not None:
+        tracker.stage(name, step, total, done)
+
+
+def report_done(done: int) -> None:
+    tracker = _current.get()
+    if tracker is not None:
+        tracker.advance(done)
+
+
+def report_extra(**fields: Any) -> None:
+    tracker = _current.get()
+    if tracker is not None:
+        tracker.annotate(**fields)
+
+
+class _Subscription:
+    __slots__ = ("latest", "changed")
+
+    def __init__(self):
+        self.latest: Optional[Dict[str, Any]] = None
+        self.changed = asyncio.Event()
+
+
+class ProgressHub:
+    """
+    Раздает состояние задач подписчикам SSE внутри процесса API. На задачу — один опрос
+    реестра, сколько бы вкладок ее ни слушали. Подписчик хранит только последнее состояние:
+    если клиент не успевает читать, промежуточные обновления схлопываются.
+    fetch(job_id) — синхронное чтение состояния, для удаленной задачи — {"status": "missing"}.
+    """
+
+    def __init__(self, fetch: Callable[[str], Dict[str, Any]], interval: float = PROGRESS_POLL_INTERVAL):
+        self._fetch = fetch
+        self._interval = interval
+        self._subscribers: Dict[str, Set[_Subscription]] = {}
+        self._pollers: Dict[str, asyncio.Task] = {}
+        self._last: Dict[str, Dict[str, Any]] = {}
+
+    async def subscribe(self, job_id: str, keepalive: float = PROGRESS_KEEPALIVE) -> AsyncIterator[Optional[Dict[str, Any]]]:
+        """Состояния задачи по мере изменения, до конечного включительно; None — пора слать keepalive."""
+        subscription = _Subscription()
+        self._subscribers.setdefault(job_id, set()).add(subscription)
+        if job_id in self._last:
+            subscription.latest = self._last[job_id]
+            subscription.changed.set()
+        poller = self._pollers.get(job_id)
+        if poller is None or poller.done():
+            self._pollers[job_id] = asyncio.create_task(self._poll(job_id))
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(subscription.changed.wait(), keepalive)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                subscription.changed.clear()
+                state = subscription.latest
+                yield state
+                if state["status"] in TERMINAL_STATUSES:
+                    return
+        finally:
+            subscribers = self._subscribers.get(job_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[job_id]
+                    self._last.pop(job_id, None)
+                    poller = self._pollers.pop(job_id, None)
+                    if poller is not None:
+                        poller.cancel()
+
+    async def _poll(self, job_id: str) -> None:
+        last = None
+        while job_id in self._subscribers:
+            try:
+                state = await asyncio.to_thread(self._fetch, job_id)
+            except Exception as e:
+                logger.warning(f"[job_progress] Не удалось прочитать состояние {job_id}: {e}")
+                await asyncio.sleep(self._interval)
+                continue
+            if state != last:
+                last = state
+                self._last[job_id] = state
+                for subscription in self._subscribers.get(job_id, ()):
+                    subscription.latest = state
+                    subscription.changed.set()
+            if state["status"] in TERMINAL_STATUSES:
+                return
+            await asyncio.sleep(self._interval)
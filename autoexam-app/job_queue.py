@@ -0,0 +1,402 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+JOB_QUEUE_PATH = os.path.join(ROOT_DIR, "storage", "queue.sqlite")
+# Воркер, не обновлявший heartbeat дольше этого, считается мертвым, его задачи возвращаются в очередь
+WORKER_STALE_SECONDS = 60
+# Задача, которая столько раз роняла воркер, помечается упавшей, а не берется снова
+MAX_ATTEMPTS = 3
+# Завершенные и упавшие задачи старше этого удаляются из реестра
+JOB_TTL_SECONDS = float(os.environ.get("AUTOEXAM_JOB_TTL_DAYS", "30")) * 24 * 3600
+# Реализация реестра: sqlite — общий для любого числа процессов API и воркеров,
+# memory — в памяти одного процесса (только с AUTOEXAM_WORKER=inline)
+JOB_BACKEND = os.environ.get("AUTOEXAM_JOB_BACKEND", "sqlite")
+
+_JOB_FIELDS = ("id", "filename", "upload_path", "status", "error", "result_path", "csv_path",
+               "enqueued_at", "started_at", "finished_at", "worker_id", "attempts", "content_key",
+               "progress")
+
+
+def _reusable(job: Dict[str, Any]) -> bool:
+    """Результат задачи еще можно отдать: задача в работе или CSV завершенной задачи на месте."""
+    if job["status"] != "completed":
+        return True
+    return bool(job["csv_path"] and os.path.exists(job["csv_path"]))
+
+
+class JobQueue(ABC):
+    """
+    Очередь и реестр задач. Запись задачи — и элемент очереди, и ее состояние
+    (queued | processing | completed | failed); воркеры регистрируются через heartbeat.
+    """
+
+    @abstractmethod
+    def enqueue(self, job_id: str, filename: str, upload_path: str,
+                content_key: Optional[str] = None) -> Dict[str, Any]:
+        ...
+
+    @abstractmethod
+    def enqueue_unique(self, job_id: str, filename: str, upload_path: str,
+                       content_key: str) -> Tuple[Dict[str, Any], bool]:
+        """
+        Ставит задачу, если нет задачи с тем же ключом содержимого (файл + версия моделей),
+        результат которой еще можно отдать; иначе возвращает ту. Поиск и вставка атомарны:
+        из одновременных одинаковых загрузок в очередь попадает одна. Второе значение — создана ли задача.
+        """
+
+    @abstractmethod
+    def requeue(self, job_id: str) -> None:
+        ...
+
+    @abstractmethod
+    def claim(self, worker_id: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def update(self, job_id: str, **fields) -> None:
+        ...
+
+    @abstractmethod
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def position(self, job_id: str) -> Optional[int]:
+        ...
+
+    @abstractmethod
+    def heartbeat(self, worker_id: str, info: Dict[str, Any]) -> None:
+        ...
+
+    @abstractmethod
+    def remove_worker(self, worker_id: str) -> None:
+        ...
+
+    @abstractmethod
+    def live_workers(self, max_age: float = WORKER_STALE_SECONDS) -> List[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def requeue_orphaned(self, max_age: float = WORKER_STALE_SECONDS) -> int:
+        ...
+
+    @abstractmethod
+    def evict_expired(self, ttl: float = JOB_TTL_SECONDS) -> int:
+        ...
+
+
+class SqliteJobQueue(JobQueue):
+    """
+    Долговечная очередь задач в SQLite (WAL): ее делят любое число процессов API и воркеров,
+    поиск по id и статусу идет по индексам. Статус переживает перезапуск.
+    """
+
+    def __init__(self, path: str = JOB_QUEUE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # isolation_level=None: транзакциями управляем сами (BEGIN IMMEDIATE в claim)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                filename TEXT NOT NULL,
+                upload_path TEXT NOT NULL,
+                status TEXT NOT NULL,
+                error TEXT,
+                result_path TEXT,
+                csv_path TEXT,
+                enqueued_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                worker_id TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                content_key TEXT,
+                progress TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, enqueued_at);
+            CREATE INDEX IF NOT EXISTS idx_jobs_finished ON jobs(finished_at);
+            CREATE TABLE IF NOT EXISTS workers (
+                id TEXT PRIMARY KEY,
+                pid INTEGER,
+                heartbeat REAL NOT NULL,
+                info TEXT
+            );
+            """
+        )
+        # Реестры, созданные раньше, получают добавленные позже колонки
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        for column in ("content_key", "progress"):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_content ON jobs(content_key, enqueued_at)")
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def enqueue(self, job_id: str, filename: str, upload_path: str,
+                content_key: Optional[str] = None) -> Dict[str, Any]:
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, filename, upload_path, status, enqueued_at, content_key) "
+                "VALUES (?, ?, ?, 'queued', ?, ?)",
+                (job_id, filename, upload_path, time.time(), content_key),
+            )
+        return self.get(job_id)
+
+    def enqueue_unique(self, job_id: str, filename: str, upload_path: str,
+                       content_key: str) -> Tuple[Dict[str, Any], bool]:
+        # BEGIN IMMEDIATE держит блокировку записи от поиска до вставки — и между процессами API
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE content_key = ? AND status != 'failed' ORDER BY enqueued_at DESC LIMIT 1",
+                (content_key,),
+            ).fetchone()
+            if row is not None and _reusable(dict(row)):
+                return dict(row), False
+            conn.execute(
+                "INSERT INTO jobs (id, filename, upload_path, status, enqueued_at, content_key) "
+                "VALUES (?, ?, ?, 'queued', ?, ?)",
+                (job_id, filename, upload_path, time.time(), content_key),
+            )
+        return self.get(job_id), True
+
+    def requeue(self, job_id: str) -> None:
+        """Ставит задачу в конец очереди заново (ручной повтор упавшей задачи)."""
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', error = NULL, worker_id = NULL, attempts = 0, "
+                "enqueued_at = ?, started_at = NULL, finished_at = NULL, progress = NULL WHERE id = ?",
+                (time.time(), job_id),
+            )
+
+    def claim(self, worker_id: str) -> Optional[Dict[str, Any]]:
+        """Атомарно забирает самую старую задачу из очереди."""
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE status = 'queued' ORDER BY enqueued_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'processing', worker_id = ?, started_at = ?, attempts = attempts + 1 "
+                "WHERE id = ?",
+                (worker_id, time.time(), row["id"]),
+            )
+        return self.get(row["id"])
+
+    def update(self, job_id: str, **fields) -> None:
+        fields = {k: v for k, v in fields.items() if k in _JOB_FIELDS and k != "id"}
+        if not fields:
+            return
+        if fields.get("status") in ("completed", "failed"):
+            fields.setdefault("finished_at", time.time())
+        assignments = ", ".join(f"{k} = ?" for k in fields)
+        with self._transaction() as conn:
+            conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def position(self, job_id: str) -> Optional[int]:
+        """Место задачи в очереди (1 — следующая на обработку) или None, если она не ждет."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*) AS ahead FROM jobs AS other, jobs AS job "
+                "WHERE job.id = ? AND job.status = 'queued' "
+                "AND other.status = 'queued' AND other.enqueued_at <= job.enqueued_at",
+                (job_id,),
+            ).fetchone()
+        return row["ahead"] or None
+
+    def heartbeat(self, worker_id: str, info: Dict[str, Any]) -> None:
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO workers (id, pid, heartbeat, info) VALUES (?, ?, ?, ?)",
+                (worker_id, os.getpid(), time.time(), json.dumps(info, ensure_ascii=False)),
+            )
+
+    def remove_worker(self, worker_id: str) -> None:
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM workers WHERE id = ?", (worker_id,))
+
+    def live_workers(self, max_age: float = WORKER_STALE_SECONDS) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, pid, heartbeat, info FROM workers WHERE heartbeat >= ?", (time.time() - max_age,)
+            ).fetchall()
+        return [{**dict(row), "info": json.loads(row["info"] or "{}")} for row in rows]
+
+    def requeue_orphaned(self, max_age: float = WORKER_STALE_SECONDS) -> int:
+        """
+        Задачи в processing у воркеров без свежего heartbeat возвращаются в очередь (с начала
+        очереди — они ждали дольше всех); после MAX_ATTEMPTS попыток помечаются упавшими.
+        """
+        with self._transaction() as conn:
+            cutoff = time.time() - max_age
+            alive = "SELECT id FROM workers WHERE heartbeat >= ?"
+            failed = conn.execute(
+                f"UPDATE jobs SET status = 'failed', finished_at = ?, "
+                f"error = 'Обработка прерывалась {MAX_ATTEMPTS} раза, задача снята с очереди' "
+                f"WHERE status = 'processing' AND attempts >= ? AND (worker_id IS NULL OR worker_id NOT IN ({alive}))",
+                (time.time(), MAX_ATTEMPTS, cutoff),
+            ).rowcount
+            requeued = conn.execute(
+                f"UPDATE jobs SET status = 'queued', worker_id = NULL, progress = NULL "
+                f"WHERE status = 'processing' AND (worker_id IS NULL OR worker_id NOT IN ({alive}))",
+                (cutoff,),
+            ).rowcount
+        if failed or requeued:
+            logger.warning(f"[job_queue] Задачи прерванных воркеров: {requeued} возвращено в очередь, {failed} снято")
+        return requeued
+
+    def evict_expired(self, ttl: float = JOB_TTL_SECONDS) -> int:
+        """Удаляет завершенные задачи старше ttl и давно молчащих воркеров."""
+        now = time.time()
+        with self._transaction() as conn:
+            evicted = conn.execute(
+                "DELETE FROM jobs WHERE status IN ('completed', 'failed') AND finished_at < ?", (now - ttl,)
+            ).rowcount
+            conn.execute("DELETE FROM workers WHERE heartbeat < ?", (now - 10 * WORKER_STALE_SECONDS,))
+        if evicted:
+            logger.info(f"[job_queue] Из реестра удалено {evicted} старых задач")
+        return evicted
+
+
+class MemoryJobQueue(JobQueue):
+    """Очередь в памяти процесса: для разработки, когда API и воркер — один процесс."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._workers: Dict[str, Dict[str, Any]] = {}
+
+    def enqueue(self, job_id: str, filename: str, upload_path: str,
+                content_key: Optional[str] = None) -> Dict[str, Any]:
+        job = {field: None for field in _JOB_FIELDS}
+        job.update(id=job_id, filename=filename, upload_path=upload_path, status="queued",
+                   enqueued_at=time.time(), attempts=0, content_key=content_key)
+        with self._lock:
+            self._jobs[job_id] = job
+            return dict(job)
+
+    def enqueue_unique(self, job_id: str, filename: str, upload_path: str,
+                       content_key: str) -> Tuple[Dict[str, Any], bool]:
+        with self._lock:
+            matches = [job for job in self._jobs.values()
+                       if job["content_key"] == content_key and job["status"] != "failed"]
+            latest = max(matches, key=lambda j: j["enqueued_at"]) if matches else None
+            if latest is not None and _reusable(latest):
+                return dict(latest), False
+            job = {field: None for field in _JOB_FIELDS}
+            job.update(id=job_id, filename=filename, upload_path=upload_path, status="queued",
+                       enqueued_at=time.time(), attempts=0, content_key=content_key)
+            self._jobs[job_id] = job
+            return dict(job), True
+
+    def requeue(self, job_id: str) -> None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(status="queued", error=None, worker_id=None, attempts=0,
+                           enqueued_at=time.time(), started_at=None, finished_at=None, progress=None)
+
+    def claim(self, worker_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            queued = [job for job in self._jobs.values() if job["status"] == "queued"]
+            if not queued:
+                return None
+            job = min(queued, key=lambda j: j["enqueued_at"])
+            job.update(status="processing", worker_id=worker_id, started_at=time.time(), attempts=job["attempts"] + 1)
+            return dict(job)
+
+    def update(self, job_id: str, **fields) -> None:
+        fields = {k: v for k, v in fields.items() if k in _JOB_FIELDS and k != "id"}
+        if fields.get("status") in ("completed", "failed"):
+            fields.setdefault("finished_at", time.time())
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def position(self, job_id: str) -> Optional[int]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job["status"] != "queued":
+                return None
+            return sum(1 for other in self._jobs.values()
+                       if other["status"] == "queued" and other["enqueued_at"] <= job["enqueued_at"])
+
+    def heartbeat(self, worker_id: str, info: Dict[str, Any]) -> None:
+        with self._lock:
+            self._workers[worker_id] = {"id": worker_id, "pid": os.getpid(), "heartbeat": time.time(), "info": info}
+
+    def remove_worker(self, worker_id: str) -> None:
+        with self._lock:
+            self._workers.pop(worker_id, None)
+
+    def live_workers(self, max_age: float = WORKER_STALE_SECONDS) -> List[Dict[str, Any]]:
+        cutoff = time.time() - max_age
+        with self._lock:
+            return [dict(worker) for worker in self._workers.values() if worker["heartbeat"] >= cutoff]
+
+    def requeue_orphaned(self, max_age: float = WORKER_STALE_SECONDS) -> int:
+        # Воркер живет в том же процессе: брошенных задач не бывает
+        return 0
+
+    def evict_expired(self, ttl: float = JOB_TTL_SECONDS) -> int:
+        cutoff = time.time() - ttl
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job["status"] in ("completed", "failed") and (job["finished_at"] or 0) < cutoff]
+            for job_id in expired:
+                del self._jobs[job_id]
+        return len(expired)
+
+
+_queue_lock = threading.Lock()
+_queue: Optional[JobQueue] = None
+
+
+def get_job_queue() -> JobQueue:
+    global _queue
+    if _queue is not None:
+        return _queue
+    with _queue_lock:
+        if _queue is None:
+            if JOB_BACKEND == "memory":
+                _queue = MemoryJobQueue()
+                logger.info("[job_queue] Очередь задач в памяти процесса")
+            else:
+                _queue = SqliteJobQueue()
+                logger.info(f"[job_queue] Очередь задач открыта: {_queue.path}")
+    return _queue
@@ -0,0 +1,524 @@
+"""
+Обработка задач: реестр (JobStore поверх job_queue) и прогон одной задачи через пайплайн
+с сохранением результата. Используется воркером (worker.py) и API (server.py) — без FastAPI,
+чтобы процесс воркера не поднимал приложение.
+"""
+import os
+import json
+import uuid
+import logging
+from datetime import datetime
+from typing import Dict, Any
+
+import pandas as pd
+from pydantic import BaseModel
+
+from ingest import load_upload, open_upload, iter_csv_chunks
+from checkpoints import JobCheckpoint
+from job_queue import JobQueue, get_job_queue
+from history_store import get_history_store
+from result_store import ResultWriter, parquet_available, write_result_table
+from job_progress import ProgressTracker, tracking
+
+logger = logging.getLogger(__name__)
+
+# Максимальный размер данных для безопасной сериализации (10MB)
+MAX_SAFE_PAYLOAD_SIZE = 10 * 1024 * 1024  # 10MB
+# Больше стольких записей records в ответ не включаем
+MAX_RECORDS_IN_RESPONSE = 1000
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+STORAGE_DIR = os.path.join(ROOT_DIR, "storage")
+UPLOADS_DIR = os.path.join(STORAGE_DIR, "uploads")
+RESULTS_DIR = os.path.join(STORAGE_DIR, "results")
+
+# Файлы от STREAMING_MIN_BYTES обрабатываются чанками по STREAM_CHUNK_ROWS строк (0 — выключено)
+STREAM_CHUNK_ROWS = int(os.environ.get("AUTOEXAM_STREAM_CHUNK_ROWS", "5000"))
+STREAMING_MIN_BYTES = int(os.environ.get("AUTOEXAM_STREAMING_MIN_BYTES", str(20 * 1024 * 1024)))
+
+os.makedirs(UPLOADS_DIR, exist_ok=True)
+os.makedirs(RESULTS_DIR, exist_ok=True)
+
+
+class JobState(BaseModel):
+    id: str
+    filename: str
+    status: str  # queued | processing | completed | failed
+    error: str | None = None
+    result_path: str | None = None
+    csv_path: str | None = None
+    # Меняется при каждом завершении (в т.ч. после resume) — входит в ключ кэша ответов
+    finished_at: float | None = None
+    progress: Dict[str, Any] | None = None
+
+
+class JobStore:
+    """Реестр задач поверх долговечной очереди (job_queue): состояние видят API и воркеры."""
+
+    def __init__(self, queue: JobQueue):
+        self._queue = queue
+
+    @staticmethod
+    def new_id() -> str:
+        return f"result-{uuid.uuid4().hex[:12]}"
+
+    def create(self, job_id: str, filename: str, upload_path: str, content_key: str | None = None) -> JobState:
+        return self._to_state(self._queue.enqueue(job_id, filename, upload_path, content_key))
+
+    def create_unique(self, job_id: str, filename: str, upload_path: str, content_key: str) -> tuple[JobState, bool]:
+        row, created = self._queue.enqueue_unique(job_id, filename, upload_path, content_key)
+        return self._to_state(row), created
+
+    def update(self, job_id: str, **kwargs):
+        self._queue.update(job_id, **kwargs)
+
+    def get(self, job_id: str) -> JobState | None:
+        row = self._queue.get(job_id)
+        return self._to_state(row) if row is not None else None
+
+    def requeue(self, job_id: str) -> None:
+        self._queue.requeue(job_id)
+
+    def position(self, job_id: str) -> int | None:
+        return self._queue.position(job_id)
+
+    def set_progress(self, job_id: str, progress: Dict[str, Any]) -> None:
+        self._queue.update(job_id, progress=json.dumps(progress, ensure_ascii=False))
+
+    @staticmethod
+    def _to_state(row: Dict[str, Any]) -> JobState:
+        fields = {field: row.get(field) for field in JobState.model_fields}
+        if fields["progress"] is not None:
+            fields["progress"] = json.loads(fields["progress"])
+        return JobState(**fields)
+
+
+jobs = JobStore(get_job_queue())
+
+
+def _find_col(df: pd.DataFrame, cands: list[str]) -> str | None:
+    cols_lower = {c.lower(): c for c in df.columns}
+    for c in cands:
+        if c.lower() in cols_lower:
+            return cols_lower[c.lower()]
+    return None
+
+
+def result_columns_of(df: pd.DataFrame) -> tuple:
+    # Ожидаемые колонки входа: Id экзамена / ID экзамена, Id вопроса / ID вопроса, Транскрибация ответа, Оценка экзаменатора
+    exam_col = _find_col(df, ["Id экзамена", "ID экзамена"])
+    q_col = _find_col(df, ["Id вопроса", "ID вопроса"])
+    trans_col = _find_col(df, ["Транскрибация ответа"])
+    score_col = _find_col(df, ["Оценка экзаменатора"])  # обязательно после инференса
+
+    if not all([exam_col, q_col, score_col]):
+        raise ValueError("Не найдены необходимые колонки для сборки ответа")
+    return exam_col, q_col, trans_col, score_col
+
+
+def frame_records(df: pd.DataFrame, exam_col: str, q_col: str, trans_col: str | None, score_col: str) -> list:
+    records = []
+    for _, row in df.iterrows():
+        records.append({
+            "examId": str(row[exam_col]),
+            "questionId": str(row[q_col]),
+            "score": int(row[score_col]),
+            "transcription": str(row[trans_col]) if trans_col and pd.notna(row.get(trans_col)) else ""
+        })
+    return records
+
+
+def _finalize_summary(total: int, avg: float, distr: Dict[str, int], records: list | None,
+                      avg_transcription_length: float) -> Dict[str, Any]:
+    # МНОЖЕСТВЕННЫЕ ЗАЩИТЫ от ошибки "header too large"
+    # 1. По количеству записей
+    # 2. По размеру транскрибаций (если они очень длинные)
+    should_include_records = (
+        records is not None and
+        total <= MAX_RECORDS_IN_RESPONSE and 
+        avg_transcription_length < 5000  # Если средняя транскрибация меньше 5KB
+    )
+    
+    # Проверка размера по байтам — при сохранении JSON, где payload все равно сериализуется
+    if not should_include_records:
+        # Для больших файлов не возвращаем records - они доступны в CSV
+        logger.info(f"[job_runner] Файл большой ({total} записей, avg_transcription={avg_transcription_length:.0f} символов), records не включены в ответ (доступны в CSV)")
+        records = None
+    
+    return {
+        "totalRecords": total,
+        "averageScore": avg,
+        "distribution": distr,
+        "records": records,  # None для больших файлов
+    }
+
+
+def _summarize_results(df: pd.DataFrame) -> Dict[str, Any]:
+    exam_col, q_col, trans_col, score_col = result_columns_of(df)
+
+    total = int(len(df))
+    avg = float(df[score_col].astype(float).mean()) if total > 0 else 0.0
+    # Для совместимости с UI отдаем только score1 и score2
+    distr = {
+        "score1": int((df[score_col] == 1).sum()),
+        "score2": int((df[score_col] == 2).sum()),
+    }
+
+    avg_transcription_length = 0
+    if trans_col and total > 0:
+        try:
+            avg_transcription_length = df[trans_col].astype(str).str.len().mean()
+        except:
+            avg_transcription_length = 0
+
+    # Для маленьких файлов собираем records; итоговое решение — в _finalize_summary
+    records = frame_records(df, exam_col, q_col, trans_col, score_col) if total <= MAX_RECORDS_IN_RESPONSE else None
+    return _finalize_summary(total, avg, distr, records, avg_transcription_length)
+
+
+class _RunningSummary:
+    """Сводка, которая копится по чанкам потоковой обработки: память не растет с размером файла."""
+
+    def __init__(self):
+        self.total = 0
+        self.score_sum = 0.0
+        self.distribution = {"score1": 0, "score2": 0}
+        self.transcription_chars = 0
+        self.records: list | None = []
+
+    def add(self, df: pd.DataFrame) -> None:
+        exam_col, q_col, trans_col, score_col = result_columns_of(df)
+        scores = df[score_col].astype(float)
+        self.total += int(len(df))
+        self.score_sum += float(scores.sum())
+        self.distribution["score1"] += int((scores == 1).sum())
+        self.distribution["score2"] += int((scores == 2).sum())
+        if trans_col:
+            self.transcription_chars += int(df[trans_col].astype(str).str.len().sum())
+        # records нужны только маленьким файлам — как только строк больше лимита, перестаем их копить
+        if self.records is not None:
+            if self.total <= MAX_RECORDS_IN_RESPONSE:
+                self.records.extend(frame_records(df, exam_col, q_col, trans_col, score_col))
+            else:
+                self.records = None
+
+    def finalize(self) -> Dict[str, Any]:
+        avg = self.score_sum / self.total if self.total > 0 else 0.0
+        avg_transcription_length = self.transcription_chars / self.total if self.total > 0 else 0
+        return _finalize_summary(self.total, avg, dict(self.distribution), self.records, avg_transcription_length)
+
+
+def _save_intermediate_result(job_id: str, stage: str, data: Dict[str, Any]) -> None:
+    """Сохраняет промежуточные результаты для возможности восстановления"""
+    intermediate_dir = os.path.join(RESULTS_DIR, "intermediate")
+    os.makedirs(intermediate_dir, exist_ok=True)
+    intermediate_path = os.path.join(intermediate_dir, f"{job_id}_{stage}.json")
+    try:
+        with open(intermediate_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "job_id": job_id,
+                "stage": stage,
+                "timestamp": datetime.utcnow().isoformat() + "Z",
+                "data": data
+            }, f, ensure_ascii=False, indent=2)
+        logger.debug(f"[job_runner] Промежуточный результат сохранен: {stage}")
+    except Exception as e:
+        logger.warning(f"[job_runner] Не удалось сохранить промежуточный результат {stage}: {e}")
+
+
+def columnar_path(job_id: str) -> str:
+    """Parquet-копия результата рядом с CSV: по ней /records отдает страницы без чтения всего файла."""
+    return os.path.join(RESULTS_DIR, f"{job_id}.parquet")
+
+
+def _process_streaming(job_id: str, upload_path: str) -> tuple[Dict[str, Any], str]:
+    """
+    Потоковый режим для больших файлов: CSV читается чанками по STREAM_CHUNK_ROWS строк,
+    каждый чанк проходит пайплайн и сразу дописывается в выходной CSV, сводка копится
+    инкрементально. Пиковая память определяется размером чанка, а не файла.
+    """
+    # Импорт здесь: инференс (torch, модели) нужен только воркеру, процесс API его не загружает
+    from inference import run_inference_streaming
+
+    # Заголовок проверяем до запуска моделей, чтобы битый файл падал сразу
+    dialect, _ = open_upload(upload_path)
+    logger.info(f"[job_runner] Потоковая обработка: чанки по {STREAM_CHUNK_ROWS} строк")
+
+    csv_path = os.path.join(RESULTS_DIR, f"{job_id}.csv")
+    # Пока задача идет, готовые строки копятся в .part; под итоговым именем файл появляется целиком
+    partial_path = csv_path + ".part"
+    summary = _RunningSummary()
+    # Колоночная копия для постраничного /records пишется теми же чанками
+    columnar = ResultWriter(columnar_path(job_id)) if parquet_available() else None
+    reader = iter_csv_chunks(upload_path, dialect, STREAM_CHUNK_ROWS)
+    try:
+        for chunk_num, result_chunk in enumerate(run_inference_streaming(reader), 1):
+            result_chunk.to_csv(partial_path, mode='w' if chunk_num == 1 else 'a', header=chunk_num == 1,
+                                index=False, sep=';', encoding='utf-8')
+            if columnar is not None:
+                try:
+                    columnar.write(result_chunk)
+                except Exception as e:
+                    logger.warning(f"[job_runner] Колоночный результат не записан, /records соберет его из CSV: {e}")
+                    columnar.abort()
+                    columnar = None
+            summary.add(result_chunk)
+            logger.info(f"[job_runner] Чанк {chunk_num} обработан и записан, всего строк: {summary.total}")
+            del result_chunk
+    except BaseException:
+        if columnar is not None:
+            columnar.abort()
+        raise
+    os.replace(partial_path, csv_path)
+    if columnar is not None:
+        try:
+            columnar.close()
+        except Exception as e:
+            logger.warning(f"[job_runner] Колоночный результат не записан: {e}")
+            columnar.abort()
+
+    _save_intermediate_result(job_id, "inference_completed", {
+        "rows_count": summary.total,
+        "streaming": True,
+    })
+    return summary.finalize(), csv_path
+
+
+def process_job(job_id: str, upload_path: str, filename: str) -> None:
+    """Обработка задачи воркером; прогресс шагов пайплайна уходит в реестр задач."""
+    tracker = ProgressTracker(lambda state: jobs.set_progress(job_id, state))
+    with tracking(tracker):
+        _process_job(job_id, upload_path, filename)
+
+
+def _process_job(job_id: str, upload_path: str, filename: str) -> None:
+    """
+    Фоновая обработка задачи. ВАЖНО: функция должна быть полностью изолирована,
+    не передавать большие объекты через исключения или возвращаемые значения.
+    """
+    # Импорт здесь: инференс (torch, модели) нужен только воркеру, процесс API его не загружает
+    from inference import run_inference
+
+    checkpoint = JobCheckpoint(job_id)
+    # Внешний try-except для перехвата ВСЕХ ошибок, включая ошибки сериализации
+    try:
+        try:
+            logger.info(f"[job_runner] Начало обработки задачи {job_id}: {filename}")
+            jobs.update(job_id, status="processing", error=None, progress=None)
+        except Exception as init_error:
+            # Если даже обновление статуса не удалось - логируем но продолжаем
+            logger.error(f"[job_runner] Ошибка при инициализации задачи {job_id}: {init_error}")
+            # Не падаем, продолжаем обработку
+
+        # Читаем CSV с авто-детектом разделителя
+        logger.info(f"[job_runner] Чтение CSV {filename}")
+        if STREAM_CHUNK_ROWS > 0 and os.path.getsize(upload_path) >= STREAMING_MIN_BYTES:
+            summary, csv_path = _process_streaming(job_id, upload_path)
+        else:
+            df, dialect = load_upload(upload_path)
+
+            # Исходный файл не пересохраняем: загруженные байты остаются в uploads для восстановления
+            _save_intermediate_result(job_id, "csv_loaded", {
+                "rows_count": len(df),
+                "columns": list(df.columns),
+                "original_path": upload_path,
+                "sep": dialect.sep,
+                "encoding": dialect.encoding,
+            })
+
+            # Запускаем инференс в отдельном try-except для изоляции ошибок
+            try:
+                logger.info(f"[job_runner] Запуск ML-инференса")
+                result_df = run_inference(df, checkpoint=checkpoint)
+                logger.info(f"[job_runner] Инференс завершен")
+            except Exception as inference_error:
+                # Обрабатываем ошибки инференса отдельно
+                error_msg = str(inference_error)
+                if len(error_msg) > 500:
+                    error_msg = error_msg[:500] + "... [обрезано]"
+                logger.error(f"[job_runner] Ошибка инференса для {job_id}: {error_msg}")
+                # Освобождаем память от DataFrame
+                del df
+                import gc
+                gc.collect()
+                # Чекпоинты шагов остаются: задачу можно возобновить через /resume
+                # Обновляем статус с коротким сообщением
+                try:
+                    jobs.update(job_id, status="failed", error=error_msg)
+                except:
+                    try:
+                        jobs.update(job_id, status="failed", error="Ошибка инференса")
+                    except:
+                        pass
+                return  # Выходим из функции
+
+            # Сохраняем промежуточный результат после инференса
+            _save_intermediate_result(job_id, "inference_completed", {
+                "rows_count": len(result_df),
+                "has_score_column": "Оценка экзаменатора" in result_df.columns
+            })
+
+            # ВАЖНО: Сначала сохраняем CSV файл (критически важно - он должен быть на сервере)
+            # Сохраняем ПОЛНЫЙ файл со ВСЕМИ колонками и данными
+            csv_path = os.path.join(RESULTS_DIR, f"{job_id}.csv")
+            try:
+                logger.info(f"[job_runner] Сохранение ПОЛНОГО CSV файла со всеми данными: {csv_path}")
+                # Сохраняем ВЕСЬ DataFrame со всеми колонками и данными
+                # Используем тот же разделитель что и в исходном файле
+                result_df.to_csv(csv_path, index=False, sep=';', encoding='utf-8')
+                logger.info(f"[job_runner] ✅ ПОЛНЫЙ CSV файл успешно сохранен на сервере: {csv_path} ({len(result_df)} записей, {len(result_df.columns)} колонок)")
+            except Exception as e:
+                logger.error(f"[job_runner] КРИТИЧЕСКАЯ ОШИБКА: Не удалось сохранить CSV файл: {e}")
+                csv_path = None
+                # Продолжаем выполнение, но CSV не будет доступен для скачивания
+
+            if parquet_available():
+                try:
+                    write_result_table(result_df, columnar_path(job_id))
+                except Exception as e:
+                    logger.warning(f"[job_runner] Колоночный результат не записан, /records соберет его из CSV: {e}")
+
+            summary = _summarize_results(result_df)
+
+        # Сводка + упаковка результата для API (без records для больших файлов)
+        logger.info(f"[job_runner] Формирование результатов для API")
+        result_payload = {
+            "id": job_id,
+            "filename": filename,
+            "status": "completed",
+            **summary,
+        }
+        logger.info(f"[job_runner] Средняя оценка: {summary['averageScore']:.2f}, всего записей: {summary['totalRecords']}")
+
+        # Сохраняем результат (JSON) - для больших файлов сохраняем без records
+        result_path = os.path.join(RESULTS_DIR, f"{job_id}.json")
+        try:
+            # ГАРАНТИРУЕМ что records не будут в JSON для больших файлов
+            json_payload = result_payload.copy()
+            
+            # Множественные проверки перед сохранением
+            total_records = json_payload.get("totalRecords", 0)
+            records = json_payload.get("records")
+            
+            # Если records есть и файл большой - удаляем их
+            if records is not None and total_records > 1000:
+                json_payload["records"] = None
+                json_payload["_note"] = "Records доступны в CSV файле из-за большого размера"
+            
+            # Сериализуем один раз: эти же байты и проверяются по размеру, и пишутся на диск
+            json_text = json.dumps(json_payload, ensure_ascii=False, indent=2)
+            payload_size = len(json_text.encode('utf-8'))
+            if payload_size > MAX_SAFE_PAYLOAD_SIZE and json_payload.get("records") is not None:
+                logger.warning(f"[job_runner] JSON payload слишком большой ({payload_size} байт), удаляем records")
+                json_payload["records"] = None
+                json_payload["_note"] = "Records доступны в CSV файле из-за большого размера"
+                json_text = json.dumps(json_payload, ensure_ascii=False, indent=2)
+                payload_size = len(json_text.encode('utf-8'))
+
+            # Сохраняем JSON
+            with open(result_path, "w", encoding="utf-8") as f:
+                f.write(json_text)
+            logger.info(f"[job_runner] JSON сохранен: {result_path} (размер: {payload_size} байт)")
+        except Exception as e:
+            logger.error(f"[job_runner] Ошибка сохранения JSON: {e}")
+            # Пробуем сохранить минимальную версию без records
+            try:
+                minimal_payload = {
+                    "id": job_id,
+                    "filename": filename,
+                    "status": "completed",
+                    "totalRecords": result_payload.get("totalRecords"),
+                    "averageScore": result_payload.get("averageScore"),
+                    "distribution": result_payload.get("distribution"),
+                    "records": None,
+                    "_note": "Records доступны в CSV файле",
+                    "_error": f"Ошибка сохранения полного JSON: {str(e)}"
+                }
+                with open(result_path, "w", encoding="utf-8") as f:
+                    json.dump(minimal_payload, f, ensure_ascii=False, indent=2)
+                logger.info(f"[job_runner] Сохранен минимальный JSON: {result_path}")
+            except Exception as e2:
+                logger.error(f"[job_runner] Не удалось сохранить даже минимальный JSON: {e2}")
+                result_path = None
+
+        # Обновляем историю
+        history_entry = {
+            "id": job_id,
+            "userId": 0,
+            "filename": filename,
+            "uploadedAt": datetime.utcnow().isoformat() + "Z",
+            "status": "completed",
+            "totalRecords": result_payload["totalRecords"],
+            "averageScore": result_payload["averageScore"],
+            "resultsUrl": f"/results/{job_id}",
+        }
+        get_history_store().add(history_entry)
+
+        jobs.update(job_id, status="completed", result_path=result_path, csv_path=csv_path)
+        checkpoint.clear()
+        logger.info(f"[job_runner] Задача {job_id} выполнена успешно")
+        
+        # КРИТИЧЕСКИ ВАЖНО: очищаем большие объекты перед выходом из функции
+        # чтобы они не попали в сериализацию при обработке исключений
+        try:
+            del result_df, df, summary, result_payload, json_payload
+            import gc
+            gc.collect()
+        except:
+            pass
+            
+    except Exception as e:
+        # КРИТИЧЕСКИ ВАЖНО: очищаем все большие объекты ПЕРЕД обработкой ошибки
+        # чтобы они не попали в сериализацию исключения
+        try:
+            if 'df' in locals():
+                del df
+            if 'result_df' in locals():
+                del result_df
+            if 'summary' in locals():
+                del summary
+            if 'result_payload' in locals():
+                del result_payload
+            import gc
+            gc.collect()
+        except:
+            pass
+        
+        # КРИТИЧЕСКИ ВАЖНО: обрезаем сообщение об ошибке чтобы избежать "header too large"
+        error_msg = str(e)
+        # Ограничиваем длину сообщения об ошибке (макс 200 символов для безопасности)
+        if len(error_msg) > 200:
+            error_msg = error_msg[:200] + "... [обрезано]"
+        
+        # Убираем большие объекты из traceback если они есть
+        error_type = type(e).__name__
+        
+        # Логируем только тип ошибки и короткое сообщение
+        logger.error(f"[job_runner] Ошибка в задаче {job_id}: {error_type}: {error_msg}")
+        
+        # Сохраняем информацию об ошибке как промежуточный результат
+        try:
+            _save_intermediate_result(job_id, "error", {
+                "error": error_msg,
+                "error_type": error_type
+            })
+        except Exception as save_error:
+            # Если даже сохранение не удалось - просто логируем
+            logger.error(f"[job_runner] Не удалось сохранить информацию об ошибке: {save_error}")
+        
+        # Обновляем статус с обрезанным сообщением об ошибке
+        # Используем несколько уровней fallback
+        update_success = False
+        for attempt_msg in [error_msg, "Ошибка обработки", "Ошибка"]:
+            try:
+                jobs.update(job_id, status="failed", error=attempt_msg)
+                update_success = True
+                break
+            except Exception as update_error:
+                # Пробуем следующий вариант
+                continue
+        
+        if not update_success:
+            # Если даже обновление не удалось - логируем но не падаем
+            logger.error(f"[job_runner] КРИТИЧЕСКАЯ ОШИБКА: Не удалось обновить статус задачи {job_id}")
+            # Не делаем ничего больше - функция завершается без исключения
@@ -1,6 +1,8 @@
+import time
 import threading
 import logging
-from typing import Tuple
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Tuple
 
 import torch
 from transformers import (
@@ -12,25 +14,34 @@ from transformers import (
 )
 from peft import PeftModel
 
+from versions import MODEL_NAME, ADAPTER_PATH
+
 logger = logging.getLogger(__name__)
 
 
-MODEL_NAME = "Qwen/Qwen2.5-VL-3B-Instruct"
-ADAPTER_PATH = "qwen_sft_exam"
+RUBERT_MODEL_NAME = "cointegrated/rubert-tiny2"
+
 
+# Базовая модель с LoRA — одна на процесс, общая для подписей, сжатия и скоринга
+_shared_lock = threading.Lock()
+_shared_model = None
+# Включение/выключение адаптера меняет состояние общей модели, поэтому вызовы сериализуются
+_adapter_lock = threading.RLock()
 
 _vl_lock = threading.Lock()
-_vl_model = None
 _vl_processor = None
 
 _text_lock = threading.Lock()
-_text_model = None
 _text_tokenizer = None
 
 _ru_lock = threading.Lock()
 _ru_model = None
 _ru_tokenizer = None
 
+# Состояние предзагрузки моделей: {имя: {"state": ..., "load_seconds": ..., ...}}
+_status_lock = threading.Lock()
+_models_status: Dict[str, Dict[str, Any]] = {}
+
 
 def _bnb_config() -> BitsAndBytesConfig:
     return BitsAndBytesConfig(
@@ -67,81 +78,82 @@ def _load_qwen_vl_with_fallback() -> Qwen2_5_VLForConditionalGeneration:
     )
 
 
-def get_vl_model_and_processor() -> Tuple[Qwen2_5_VLForConditionalGeneration, AutoProcessor]:
-    global _vl_model, _vl_processor
-    if _vl_model is not None and _vl_processor is not None:
-        return _vl_model, _vl_processor
+def _get_shared_model() -> PeftModel:
+    """
+    Одна базовая Qwen2.5-VL на процесс с подключенным LoRA-адаптером. Подписи и сжатие
+    транскрибаций идут через base_model_mode (адаптер выключен), скоринг — через adapter_mode.
+    """
+    global _shared_model
+    if _shared_model is not None:
+        return _shared_model
 
-    with _vl_lock:
-        if _vl_model is not None and _vl_processor is not None:
-            return _vl_model, _vl_processor
+    with _shared_lock:
+        if _shared_model is not None:
+            return _shared_model
 
-        logger.info("[models] Загрузка VL модели и процессора...")
-        _vl_processor = AutoProcessor.from_pretrained(
-            MODEL_NAME,
-            use_fast=False,
-            trust_remote_code=True,
-        )
-
-        _vl_model = _load_qwen_vl_with_fallback()
-        _vl_model.eval()
-        for p in _vl_model.parameters():
+        logger.info("[models] Загрузка базовой модели...")
+        base_model = _load_qwen_vl_with_fallback()
+        logger.info(f"[models] Загрузка LoRA адаптера из {ADAPTER_PATH}...")
+        model = PeftModel.from_pretrained(base_model, ADAPTER_PATH)
+        model.eval()
+        for p in model.parameters():
             p.requires_grad = False
-        logger.info("[models] VL модель загружена успешно")
+        _shared_model = model
+        logger.info("[models] Общая модель с LoRA загружена успешно")
 
-    return _vl_model, _vl_processor
+    return _shared_model
 
 
-def get_text_model_and_tokenizer():
-    global _text_model, _text_tokenizer
-    if _text_model is not None and _text_tokenizer is not None:
-        return _text_model, _text_tokenizer
-
-    with _text_lock:
-        if _text_model is not None and _text_tokenizer is not None:
-            return _text_model, _text_tokenizer
-
-        logger.info("[models] Загрузка токенизатора и текстовой модели...")
-        _text_tokenizer = AutoTokenizer.from_pretrained(
-            MODEL_NAME,
-            trust_remote_code=True,
-            padding_side="left",
-            use_fast=False,
-        )
-        if _text_tokenizer.pad_token is None:
-            _text_tokenizer.pad_token = _text_tokenizer.eos_token
+@contextmanager
+def base_model_mode(model):
+    """Вызовы модели без LoRA. Пока блок выполняется, другие потоки модель не используют."""
+    with _adapter_lock:
+        if isinstance(model, PeftModel):
+            with model.disable_adapter():
+                yield model
+        else:
+            yield model
 
-        logger.info("[models] Загрузка базовой модели...")
-        try:
-            if torch.cuda.is_available():
-                base_model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
+
+@contextmanager
+def adapter_mode(model):
+    """Вызовы модели с LoRA. Адаптер включен всегда, когда _adapter_lock свободен."""
+    with _adapter_lock:
+        yield model
+
+
+def get_vl_model_and_processor() -> Tuple[PeftModel, AutoProcessor]:
+    global _vl_processor
+    if _vl_processor is None:
+        with _vl_lock:
+            if _vl_processor is None:
+                logger.info("[models] Загрузка VL процессора...")
+                _vl_processor = AutoProcessor.from_pretrained(
                     MODEL_NAME,
-                    quantization_config=_bnb_config(),
-                    device_map="auto",
+                    use_fast=False,
                     trust_remote_code=True,
-                    dtype=torch.float16,
-                    low_cpu_mem_usage=True,
                 )
-            else:
-                raise RuntimeError("CUDA недоступна, используем fp16/32")
-        except Exception as e:
-            logger.warning(f"[models] 4-bit загрузка базовой модели не удалась, fallback на fp16: {e}")
-            base_model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
-                MODEL_NAME,
-                device_map="auto",
-                trust_remote_code=True,
-                dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
-                low_cpu_mem_usage=True,
-            )
 
-        logger.info(f"[models] Загрузка LoRA адаптера из {ADAPTER_PATH}...")
-        _text_model = PeftModel.from_pretrained(base_model, ADAPTER_PATH)
-        _text_model.eval()
-        for p in _text_model.parameters():
-            p.requires_grad = False
-        logger.info("[models] Текстовая модель с LoRA загружена успешно")
+    return _get_shared_model(), _vl_processor
 
-    return _text_model, _text_tokenizer
+
+def get_text_model_and_tokenizer():
+    global _text_tokenizer
+    if _text_tokenizer is None:
+        with _text_lock:
+            if _text_tokenizer is None:
+                logger.info("[models] Загрузка токенизатора...")
+                tokenizer = AutoTokenizer.from_pretrained(
+                    MODEL_NAME,
+                    trust_remote_code=True,
+                    padding_side="left",
+                    use_fast=False,
+                )
+                if tokenizer.pad_token is None:
+                    tokenizer.pad_token = tokenizer.eos_token
+                _text_tokenizer = tokenizer
+
+    return _get_shared_model(), _text_tokenizer
 
 
 def get_rubert_model_and_tokenizer():
@@ -154,8 +166,8 @@ def get_rubert_model_and_tokenizer():
             return _ru_model, _ru_tokenizer
 
         logger.info("[models] Загрузка RuBERT модели...")
-        _ru_tokenizer = AutoTokenizer.from_pretrained("cointegrated/rubert-tiny2", trust_remote_code=True, use_fast=False)
-        _ru_model = AutoModel.from_pretrained("cointegrated/rubert-tiny2", trust_remote_code=True)
+        _ru_tokenizer = AutoTokenizer.from_pretrained(RUBERT_MODEL_NAME, trust_remote_code=True, use_fast=False)
+        _ru_model = AutoModel.from_pretrained(RUBERT_MODEL_NAME, trust_remote_code=True)
         _ru_model.eval()
         for p in _ru_model.parameters():
             p.requires_grad = False
@@ -164,3 +176,63 @@ def get_rubert_model_and_tokenizer():
     return _ru_model, _ru_tokenizer
 
 
+def _set_status(name: str, **fields) -> None:
+    with _status_lock:
+        _models_status.setdefault(name, {"state": "not_loaded"}).update(fields)
+
+
+def get_models_status() -> Dict[str, Dict[str, Any]]:
+    """Состояние моделей для /api/health/ready: not_loaded | loading | warming | ready | failed и тайминги."""
+    with _status_lock:
+        status = {name: dict(fields) for name, fields in _models_status.items()}
+    # Модели, загруженные лениво (без прогрева), тоже считаются рабочими
+    if "qwen" not in status and _shared_model is not None:
+        status["qwen"] = {"state": "ready", "warmed_up": False}
+    if "rubert" not in status and _ru_model is not None:
+        status["rubert"] = {"state": "ready", "warmed_up": False}
+    return status
+
+
+def _warmup_qwen() -> None:
+    # Крошечный generate в обоих режимах: инициализация CUDA-ядер, аллокатора и LoRA-слоев
+    model, tokenizer = get_text_model_and_tokenizer()
+    get_vl_model_and_processor()
+    inputs = tokenizer(["Оценка:"], return_tensors="pt").to(model.device)
+    with torch.inference_mode():
+        for mode in (adapter_mode, base_model_mode):
+            with mode(model):
+                model.generate(**inputs, max_new_tokens=1, do_sample=False, pad_token_id=tokenizer.pad_token_id)
+    del inputs
+
+
+def _warmup_rubert() -> None:
+    model, tokenizer = get_rubert_model_and_tokenizer()
+    encoded = tokenizer(["Проверка"], return_tensors="pt")
+    with torch.inference_mode():
+        model(**encoded)
+
+
+_LOADERS = {
+    "qwen": (lambda: (get_vl_model_and_processor(), get_text_model_and_tokenizer()), _warmup_qwen),
+    "rubert": (get_rubert_model_and_tokenizer, _warmup_rubert),
+}
+
+
+def preload_models(names: Iterable[str] = ("qwen", "rubert")) -> None:
+    """Загружает и прогревает модели заранее; состояние и тайминги — в get_models_status()."""
+    for name in names:
+        load, warmup = _LOADERS[name]
+        _set_status(name, state="loading", error=None)
+        try:
+            start = time.time()
+            load()
+            _set_status(name, state="warming", load_seconds=round(time.time() - start, 2))
+            start = time.time()
+            warmup()
+            _set_status(name, state="ready", warmed_up=True, warmup_seconds=round(time.time() - start, 2))
+            logger.info(f"[models] Модель {name} загружена и прогрета")
+        except Exception as e:
+            logger.error(f"[models] Не удалось загрузить модель {name}: {e}")
+            _set_status(name, state="failed", error=str(e)[:200])
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
@@ -0,0 +1,66 @@
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Hashable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+# Сколько байт готовых ответов держать в памяти процесса API
+PAYLOAD_CACHE_MAX_BYTES = int(float(os.environ.get("AUTOEXAM_PAYLOAD_CACHE_MB", "64")) * 1024 * 1024)
+
+
+def make_etag(body: bytes) -> str:
+    """Сильный ETag по содержимому ответа."""
+    return '"' + hashlib.sha1(body).hexdigest() + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+class PayloadCache:
+    """
+    LRU готовых к отправке ответов (сериализованные байты + ETag), ограниченный по суммарному
+    размеру. Ключ должен меняться вместе с содержимым — тогда инвалидация не нужна.
+    """
+
+    def __init__(self, max_bytes: int = PAYLOAD_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._items: "OrderedDict[Hashable, Tuple[bytes, str]]" = OrderedDict()
+        self._size = 0
+
+    def get(self, key: Hashable) -> Optional[Tuple[bytes, str]]:
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is not None:
+                self._items.move_to_end(key)
+            return entry
+
+    def put(self, key: Hashable, body: bytes) -> Tuple[bytes, str]:
+        entry = (body, make_etag(body))
+        if len(body) > self.max_bytes:
+            # Ответ больше всего кэша: отдаем без кэширования
+            return entry
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= len(old[0])
+            self._items[key] = entry
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                _, (evicted, _) = self._items.popitem(last=False)
+                self._size -= len(evicted)
+        return entry
+
+    def discard(self, key_prefix: Hashable) -> None:
+        """Удаляет все записи, ключ которых — кортеж, начинающийся с key_prefix."""
+        with self._lock:
+            for key in [k for k in self._items if isinstance(k, tuple) and k and k[0] == key_prefix]:
+                self._size -= len(self._items.pop(key)[0])
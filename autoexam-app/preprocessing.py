@@ -0,0 +1,141 @@
+import re
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+
+# Максимальный балл по номеру вопроса
+MAX_SCORE_MAP = {1: 1, 2: 2, 3: 1, 4: 2}
+MAX_SCORE = max(MAX_SCORE_MAP.values())
+
+# Версию повышаем при любом изменении текста промпта скоринга: она входит в ключи мемоизации
+SCORING_PROMPT_VERSION = "v1"
+# Постоянное начало каждого промпта скоринга; его KV-кеш считается один раз на модель
+SCORING_PROMPT_PREFIX = (
+    "Ты — эксперт по оценке устных ответов на экзамене по русскому языку для иностранцев.\n"
+    "Критерии оценки:\n"
+    "1) Ошибки в отдельных словах и единичные несогласованности фраз не считаются ошибкой.\n"
+    "2) Тестируемый должен выполнить коммуникативную задачу (должен ответить на вопрос или добиться ответа на свой вопрос).\n"
+    "3) Предложения тестируемого должны быть преимущественно полными.\n"
+    "Оцени ответ по строгой шкале.\n\n"
+    "Контекст:\n"
+)
+
+NO_IMAGE = "no image"
+
+_HTML_TAG_RE = re.compile(r"<[^>]+>")
+_LATIN_RE = re.compile(r"[a-zA-Z]")
+
+
+def filter_text(text: str) -> str:
+    if not isinstance(text, str):
+        return ""
+    no_html = _HTML_TAG_RE.sub("", text)
+    # Удаляем латиницу
+    return _LATIN_RE.sub("", no_html)
+
+
+def max_score_for(question_num: int) -> int:
+    return MAX_SCORE_MAP.get(question_num, 2)
+
+
+def _filter_column(values: pd.Series) -> pd.Series:
+    # Текст вопроса сильно повторяется: регулярки гоняем только по уникальным значениям
+    codes, uniques = pd.factorize(values)
+    filtered = np.array([filter_text(u) for u in uniques] + [""], dtype=object)
+    # У NaN код -1 — он попадает на последний элемент ""
+    return pd.Series(filtered[codes], index=values.index)
+
+
+def normalize_inputs(df: pd.DataFrame) -> List[str]:
+    """
+    Шаг 1 пайплайна (на месте): "no image" вместо пустых ссылок, колонка "Тип теста",
+    очистка "Текст вопроса" от HTML и латиницы. Возвращает уникальные ссылки на картинки
+    в порядке первого появления.
+    """
+    if "Картинка из вопроса" in df.columns:
+        df["Картинка из вопроса"] = df["Картинка из вопроса"].fillna(NO_IMAGE)
+    else:
+        df["Картинка из вопроса"] = NO_IMAGE
+
+    links = df["Картинка из вопроса"]
+    as_text = links.astype(str)
+    # Тип теста: 1 если есть картинка, иначе 0
+    df["Тип теста"] = ((as_text != NO_IMAGE) & (as_text != "")).astype(int)
+
+    if "Текст вопроса" in df.columns:
+        df["Текст вопроса"] = _filter_column(df["Текст вопроса"])
+
+    # pd.unique — хеш-дедупликация с сохранением порядка появления
+    candidates = pd.unique(links[as_text != NO_IMAGE].to_numpy())
+    return [v for v in candidates if isinstance(v, str)]
+
+
+def question_numbers(df: pd.DataFrame) -> List[int]:
+    if "№ вопроса" not in df.columns:
+        return [0] * len(df)
+    return pd.to_numeric(df["№ вопроса"], errors="coerce").fillna(0).astype(int).tolist()
+
+
+def build_inference_prompt(row: pd.Series) -> str:
+    question_num = int(row.get("№ вопроса", 0))
+    question_text = str(row.get("Текст вопроса", ""))
+    response = str(row.get("Транскрибация ответа", ""))
+    test_type = "описание картинки" if int(row.get("Тип теста", 0)) == 1 else "диалог"
+    max_score = max_score_for(question_num)
+
+    prompt = (
+        SCORING_PROMPT_PREFIX +
+        f"- № вопроса: {question_num}\n"
+        f"- Тип задания: {test_type}\n"
+    )
+
+    if int(row.get("Тип теста", 0)) == 1 and pd.notna(row.get("Схожесть описания картинки")):
+        similarity = float(row.get("Схожесть описания картинки"))
+        prompt += f"- Схожесть описания с изображением: {similarity:.2f}\n"
+
+    prompt += (
+        f"- Вопрос: {question_text}\n"
+        f"- Ответ кандидата: {response}\n\n"
+        f"Оценка (целое число от 0 до {max_score}):"
+    )
+    return prompt
+
+
+def build_inference_prompts(df: pd.DataFrame) -> List[str]:
+    """То же, что build_inference_prompt для каждой строки, но склейкой целых колонок."""
+    n = len(df)
+    if n == 0:
+        return []
+
+    def column(name: str, default: str) -> pd.Series:
+        if name in df.columns:
+            # map(str), а не astype(str): в pandas 3 astype(str) оставляет NaN, а build_inference_prompt дает "nan"
+            return df[name].map(str)
+        return pd.Series([default] * n, index=df.index)
+
+    qnums = pd.Series(question_numbers(df), index=df.index)
+    is_image = (df["Тип теста"].astype(int) == 1) if "Тип теста" in df.columns else pd.Series(False, index=df.index)
+    test_type = pd.Series(np.where(is_image, "описание картинки", "диалог"), index=df.index)
+    max_scores = qnums.map(MAX_SCORE_MAP).fillna(2).astype(int).astype(str)
+
+    similarity_line = pd.Series([""] * n, index=df.index, dtype=object)
+    if "Схожесть описания картинки" in df.columns:
+        similarity = pd.to_numeric(df["Схожесть описания картинки"], errors="coerce")
+        with_similarity = is_image & similarity.notna()
+        if with_similarity.any():
+            similarity_line[with_similarity] = (
+                "- Схожесть описания с изображением: " + similarity[with_similarity].map("{:.2f}".format) + "\n"
+            )
+
+    prompts = (
+        SCORING_PROMPT_PREFIX
+        + "- № вопроса: " + qnums.astype(str) + "\n"
+        + "- Тип задания: " + test_type + "\n"
+        + similarity_line
+        + "- Вопрос: " + column("Текст вопроса", "") + "\n"
+        + "- Ответ кандидата: " + column("Транскрибация ответа", "") + "\n\n"
+        + "Оценка (целое число от 0 до " + max_scores + "):"
+    )
+    return prompts.tolist()
@@ -0,0 +1,236 @@
+import os
+import gzip
+import logging
+import threading
+import weakref
+from typing import Any, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # без pyarrow колоночного файла нет, результат доступен только в CSV
+    pa = ds = pq = None
+
+logger = logging.getLogger(__name__)
+
+
+# Строк в группе Parquet: страница читает одну-две группы, статистики групп отсекают
+# лишнее при фильтрах
+RESULT_ROW_GROUP_SIZE = 10_000
+
+
+def parquet_available() -> bool:
+    return pq is not None
+
+
+class ResultWriter:
+    """
+    Пишет результат задачи в Parquet по частям (для потоковой обработки — по чанку за раз).
+    Файл появляется под итоговым именем только после close(); abort() удаляет недописанное.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._partial_path = path + ".part"
+        self._writer = None
+
+    def write(self, df: pd.DataFrame) -> None:
+        if self._writer is None:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            self._writer = pq.ParquetWriter(self._partial_path, table.schema, compression="zstd")
+        else:
+            # Схема первого чанка обязательна для всех: колонка, пустая в одном чанке, приводится к ней
+            table = pa.Table.from_pandas(df, schema=self._writer.schema, preserve_index=False)
+        self._writer.write_table(table, row_group_size=RESULT_ROW_GROUP_SIZE)
+
+    def close(self) -> str:
+        if self._writer is None:
+            raise ValueError("В результат не записано ни одной строки")
+        self._writer.close()
+        os.replace(self._partial_path, self.path)
+        return self.path
+
+    def abort(self) -> None:
+        if self._writer is not None:
+            try:
+                self._writer.close()
+            except Exception:
+                pass
+        try:
+            os.remove(self._partial_path)
+        except OSError:
+            pass
+
+
+def write_result_table(df: pd.DataFrame, path: str) -> str:
+    writer = ResultWriter(path)
+    try:
+        writer.write(df)
+        return writer.close()
+    except Exception:
+        writer.abort()
+        raise
+
+
+def result_columns(path: str) -> List[str]:
+    return pq.ParquetFile(path).schema_arrow.names
+
+
+def _typed_value(field_type, value: Any):
+    """Значение фильтра из query-строки в тип колонки; None — заведомо ничего не совпадет."""
+    try:
+        if pa.types.is_integer(field_type):
+            return int(value)
+        if pa.types.is_floating(field_type):
+            return float(value)
+    except (TypeError, ValueError):
+        return None
+    return str(value)
+
+
+def _empty(schema, columns: Optional[List[str]]) -> pd.DataFrame:
+    return schema.empty_table().select(columns or schema.names).to_pandas()
+
+
+def read_slice(
+    path: str,
+    offset: int,
+    limit: int,
+    columns: Optional[List[str]] = None,
+    filters: Optional[Dict[str, Any]] = None,
+) -> Tuple[pd.DataFrame, Optional[int], Optional[int]]:
+    """
+    Срез строк результата [offset, offset + limit) после фильтров равенства {колонка: значение}.
+    Читаются только нужные колонки и группы строк. Возвращает DataFrame, общее число строк
+    (без фильтров — из метаданных; с фильтрами — None) и offset следующей страницы.
+    """
+    parquet_file = pq.ParquetFile(path)
+    filters = {column: value for column, value in (filters or {}).items() if value is not None}
+
+    if not filters:
+        metadata = parquet_file.metadata
+        total = metadata.num_rows
+        end = min(offset + limit, total)
+        pieces = []
+        group_start = 0
+        for group in range(metadata.num_row_groups):
+            group_rows = metadata.row_group(group).num_rows
+            group_end = group_start + group_rows
+            if group_end > offset and group_start < end:
+                table = parquet_file.read_row_group(group, columns=columns)
+                lo = max(offset, group_start) - group_start
+                pieces.append(table.slice(lo, min(end, group_end) - group_start - lo))
+            if group_end >= end:
+                break
+            group_start = group_end
+        frame = pa.concat_tables(pieces).to_pandas() if pieces else _empty(parquet_file.schema_arrow, columns)
+        return frame, total, end if end < total else None
+
+    schema = parquet_file.schema_arrow
+    expression = None
+    for column, value in filters.items():
+        typed = _typed_value(schema.field(column).type, value)
+        if typed is None:
+            return _empty(schema, columns), None, None
+        condition = ds.field(column) == typed
+        expression = condition if expression is None else expression & condition
+
+    # Статистики групп строк Parquet отсекают группы, где совпадений быть не может
+    batches = []
+    skip, need = offset, limit + 1
+    for batch in ds.dataset(path, format="parquet").to_batches(columns=columns, filter=expression):
+        if skip >= batch.num_rows:
+            skip -= batch.num_rows
+            continue
+        batch = batch.slice(skip)
+        skip = 0
+        batches.append(batch.slice(0, need))
+        need -= min(need, batch.num_rows)
+        if need == 0:
+            break
+    if not batches:
+        return _empty(schema, columns), None, None
+    table = pa.Table.from_batches(batches)
+    has_more = table.num_rows > limit
+    return table.slice(0, limit).to_pandas(), None, offset + limit if has_more else None
+
+
+# Сжатые копии и экспорт в JSONL для скачивания: строятся один раз и лежат рядом с результатом
+COPY_CHUNK_BYTES = 1024 * 1024
+GZIP_LEVEL = 6
+JSONL_CHUNK_ROWS = 50_000
+_ENCODING_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+# Блокировка на каждый собираемый файл; запись исчезает, когда блокировку никто не держит и не ждет
+_build_locks: "weakref.WeakValueDictionary[str, threading.Lock]" = weakref.WeakValueDictionary()
+_build_locks_guard = threading.Lock()
+
+
+def zstd_available() -> bool:
+    return pa is not None and pa.Codec.is_available("zstd")
+
+
+def _is_fresh(path: str, source: str) -> bool:
+    """Производный файл есть и не старше исходного (после resume результат перезаписывается)."""
+    return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(source)
+
+
+def build_lock(path: str) -> threading.Lock:
+    """Блокировка сборки одного файла: одинаковые запросы ждут одну сборку, разные файлы собираются параллельно."""
+    with _build_locks_guard:
+        lock = _build_locks.get(path)
+        if lock is None:
+            lock = _build_locks[path] = threading.Lock()
+        return lock
+
+
+def _build_once(path: str, source: str, build) -> str:
+    if _is_fresh(path, source):
+        return path
+    with build_lock(path):
+        if not _is_fresh(path, source):
+            # Свой .part у каждого процесса: несколько API-процессов могут собирать один файл
+            partial_path = f"{path}.{os.getpid()}.part"
+            try:
+                build(partial_path)
+                os.replace(partial_path, path)
+            except BaseException:
+                try:
+                    os.remove(partial_path)
+                except OSError:
+                    pass
+                raise
+            logger.info(f"[result_store] Собран {path} ({os.path.getsize(path)} байт)")
+    return path
+
+
+def _copy_compressed(source: str, out) -> None:
+    with open(source, "rb") as src:
+        for block in iter(lambda: src.read(COPY_CHUNK_BYTES), b""):
+            out.write(block)
+
+
+def compressed_copy(source: str, encoding: str) -> str:
+    """Путь к копии source, сжатой gzip или zstd (zstd — кодеком pyarrow)."""
+    def build(partial_path: str) -> None:
+        if encoding == "gzip":
+            with gzip.open(partial_path, "wb", compresslevel=GZIP_LEVEL) as out:
+                _copy_compressed(source, out)
+        else:
+            with pa.CompressedOutputStream(partial_path, "zstd") as out:
+                _copy_compressed(source, out)
+
+    return _build_once(source + _ENCODING_SUFFIXES[encoding], source, build)
+
+
+def jsonl_export(csv_path: str, path: str) -> str:
+    """JSONL-версия результата (строка — запись), собирается из CSV чанками."""
+    def build(partial_path: str) -> None:
+        with open(partial_path, "w", encoding="utf-8") as out:
+            for chunk in pd.read_csv(csv_path, sep=";", encoding="utf-8", chunksize=JSONL_CHUNK_ROWS):
+                text = chunk.to_json(orient="records", lines=True, force_ascii=False)
+                out.write(text if text.endswith("\n") else text + "\n")
+
+    return _build_once(path, csv_path, build)
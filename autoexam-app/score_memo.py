@@ -0,0 +1,108 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCORE_MEMO_PATH = os.path.join(ROOT_DIR, "storage", "cache", "scores.sqlite")
+# Максимум записей; при превышении удаляются давно не использованные (LRU)
+SCORE_MEMO_MAX_ENTRIES = 2_000_000
+# SQLite ограничивает число параметров в одном запросе
+_QUERY_CHUNK = 500
+
+
+def row_key(version: str, question_num: int, question_text: str, transcription: str, link: str) -> str:
+    """Ключ строки: все входы, от которых зависит оценка, плюс версия модели, адаптера и промптов."""
+    parts = [str(part) for part in (version, question_num, question_text, transcription, link)]
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+class ScoreMemo:
+    """
+    Персистентная мемоизация результатов по строкам: ключ row_key -> итоговая оценка
+    и промежуточные признаки (сжатая транскрибация, схожесть, вероятности). Повторная
+    загрузка того же файла или тех же ответов не гоняет эти строки через модели.
+    """
+
+    def __init__(self, path: str = SCORE_MEMO_PATH, max_entries: int = SCORE_MEMO_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS scores (
+                key TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_scores_access ON scores(last_access);
+            """
+        )
+        self._conn.commit()
+
+    def get_many(self, keys: List[str]) -> Dict[str, Dict[str, Any]]:
+        unique_keys = list(dict.fromkeys(keys))
+        found: Dict[str, Dict[str, Any]] = {}
+        with self._lock:
+            for pos in range(0, len(unique_keys), _QUERY_CHUNK):
+                chunk = unique_keys[pos:pos + _QUERY_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, payload FROM scores WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                for key, payload in rows:
+                    found[key] = json.loads(payload)
+            if found:
+                now = time.time()
+                self._conn.executemany("UPDATE scores SET last_access = ? WHERE key = ?", [(now, k) for k in found])
+                self._conn.commit()
+        return found
+
+    def put_many(self, items: Dict[str, Dict[str, Any]]) -> None:
+        if not items:
+            return
+        now = time.time()
+        rows = [(key, json.dumps(payload, ensure_ascii=False), now) for key, payload in items.items()]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO scores (key, payload, last_access) VALUES (?, ?, ?)", rows)
+            self._conn.commit()
+
+    def evict(self) -> int:
+        """Удаляет давно не использованные записи сверх max_entries."""
+        with self._lock:
+            total = self._conn.execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+            excess = total - self.max_entries
+            if excess <= 0:
+                return 0
+            self._conn.execute(
+                "DELETE FROM scores WHERE rowid IN (SELECT rowid FROM scores ORDER BY last_access LIMIT ?)",
+                (excess,),
+            )
+            self._conn.commit()
+            return excess
+
+
+_memo_lock = threading.Lock()
+_memo: Optional[ScoreMemo] = None
+
+
+def get_score_memo() -> ScoreMemo:
+    global _memo
+    if _memo is not None:
+        return _memo
+    with _memo_lock:
+        if _memo is None:
+            _memo = ScoreMemo()
+            logger.info(f"[score_memo] Мемоизация оценок открыта: {_memo.path}")
+    return _memo
@@ -1,50 +1,70 @@
 import os
-import io
 import json
-import uuid
 import threading
 import logging
 import time
 import sys
-from datetime import datetime
-from typing import Dict, Any
+import hashlib
+import subprocess
+from contextlib import aclosing
+from typing import Dict, Any, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокировки нет, каждый процесс API запускает своего воркера
+    fcntl = None
 
 import pandas as pd
-from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse as FastAPIFileResponse
+from fastapi.responses import FileResponse as FastAPIFileResponse, JSONResponse, StreamingResponse
 from starlette.responses import Response
 from pydantic import BaseModel
 from fastapi.responses import FileResponse
+from starlette.concurrency import run_in_threadpool
 
 # Локальные модули инференса
-from inference import run_inference
+from versions import pipeline_version
+from job_queue import get_job_queue
+from history_store import HISTORY_PAGE_SIZE, get_history_store
+from result_store import (
+    build_lock, compressed_copy, jsonl_export, parquet_available, read_slice, result_columns, write_result_table, zstd_available,
+)
+from payload_cache import PayloadCache, etag_matches, make_etag
+from job_progress import PROGRESS_POLL_INTERVAL, TERMINAL_STATUSES, ProgressHub
+from job_runner import (
+    MAX_RECORDS_IN_RESPONSE, MAX_SAFE_PAYLOAD_SIZE, RESULTS_DIR, STORAGE_DIR, UPLOADS_DIR,
+    JobState, JobStore, columnar_path, frame_records, jobs, result_columns_of,
+)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Максимальный размер данных для безопасной сериализации (10MB)
-MAX_SAFE_PAYLOAD_SIZE = 10 * 1024 * 1024  # 10MB
-
 
 API_PREFIX = "/api"
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
-STORAGE_DIR = os.path.join(ROOT_DIR, "storage")
-UPLOADS_DIR = os.path.join(STORAGE_DIR, "uploads")
-RESULTS_DIR = os.path.join(STORAGE_DIR, "results")
 DATA_DIR = os.path.join(ROOT_DIR, "data")
-HISTORY_PATH = os.path.join(DATA_DIR, "history.json")
 DIST_DIR = os.path.join(ROOT_DIR, "dist")
 
-os.makedirs(UPLOADS_DIR, exist_ok=True)
-os.makedirs(RESULTS_DIR, exist_ok=True)
+# Кто разбирает очередь задач: spawn — сервер запускает процесс воркера (worker.py) сам,
+# inline — воркер в потоке процесса API, external — воркеры запускаются отдельно
+WORKER_MODE = os.environ.get("AUTOEXAM_WORKER", "spawn")
+
+# Предзагрузка и прогрев моделей при старте воркера (по умолчанию модели грузятся лениво при первой задаче)
+PRELOAD_MODELS = os.environ.get("AUTOEXAM_PRELOAD_MODELS", "0") == "1"
+
+# Предельный размер загружаемого CSV (0 — без ограничения) и размер куска при записи на диск
+MAX_UPLOAD_BYTES = int(float(os.environ.get("AUTOEXAM_MAX_UPLOAD_MB", "2048")) * 1024 * 1024)
+UPLOAD_CHUNK_BYTES = 1024 * 1024
 
 
 class UploadResponse(BaseModel):
     success: bool
     id: str
     message: str
+    # True — такой же файл уже обработан (или в работе) той же версией моделей, id — той задачи
+    duplicate: bool = False
 
 
 class ResultResponse(BaseModel):
@@ -55,52 +75,32 @@ class ResultResponse(BaseModel):
     averageScore: float | None = None
     distribution: Dict[str, int] | None = None
     records: list | None = None
+    queuePosition: int | None = None
+    # Для processing: шаг пайплайна, done/total, ETA шага (см. job_progress)
+    progress: Dict[str, Any] | None = None
 
 
-class JobState(BaseModel):
-    id: str
-    filename: str
-    status: str  # queued | processing | completed | failed
-    error: str | None = None
-    result_path: str | None = None
-    csv_path: str | None = None
-
-
-class JobStore:
-    def __init__(self):
-        self._jobs: Dict[str, JobState] = {}
-        self._lock = threading.Lock()
-
-    def create(self, filename: str) -> JobState:
-        job_id = f"result-{uuid.uuid4().hex[:12]}"
-        job = JobState(id=job_id, filename=filename, status="queued")
-        with self._lock:
-            self._jobs[job_id] = job
-        return job
-
-    def update(self, job_id: str, **kwargs):
-        with self._lock:
-            if job_id not in self._jobs:
-                return
-            job = self._jobs[job_id]
-            for k, v in kwargs.items():
-                setattr(job, k, v)
-            self._jobs[job_id] = job
-
-    def get(self, job_id: str) -> JobState | None:
-        with self._lock:
-            return self._jobs.get(job_id)
-
-
-jobs = JobStore()
-
 # Умное логирование для запросов статуса
 _last_status_log = {}  # {result_id: (last_log_time, last_status)}
+# Записи о задачах, которые давно не опрашивали, удаляются — словарь не растет бесконечно
+STATUS_LOG_TTL = 3600
+_status_log_pruned_at = 0.0
+
+
+def _prune_status_log(now: float) -> None:
+    global _status_log_pruned_at
+    if now - _status_log_pruned_at < 60:
+        return
+    _status_log_pruned_at = now
+    for result_id, (last_time, _) in list(_last_status_log.items()):
+        if now - last_time > STATUS_LOG_TTL:
+            _last_status_log.pop(result_id, None)
 
 
 def _should_log_status(result_id: str, current_status: str) -> bool:
     """Логируем статус каждую минуту или при изменении статуса"""
     now = time.time()
+    _prune_status_log(now)
     if result_id not in _last_status_log:
         _last_status_log[result_id] = (now, current_status)
         return True
@@ -116,475 +116,170 @@ def _should_log_status(result_id: str, current_status: str) -> bool:
     return should_log
 
 
-def _detect_delimiter(sample: str) -> str:
-    """Улучшенное определение разделителя CSV файла"""
-    if not sample:
-        return ';'
-    
-    lines = sample.splitlines()
-    if not lines:
-        return ';'
-    
-    # Проверяем первую строку (заголовок)
-    first_line = lines[0]
-    
-    # Если в первой строке есть ';', используем его
-    if ';' in first_line:
-        # Проверяем что это действительно разделитель, а не часть данных
-        # Считаем количество ';' в первой строке
-        semicolon_count = first_line.count(';')
-        # Если ';' встречается несколько раз, это скорее всего разделитель
-        if semicolon_count >= 2:
-            return ';'
-    
-    # Проверяем запятые
-    if ',' in first_line:
-        comma_count = first_line.count(',')
-        if comma_count >= 2:
-            return ','
-    
-    # Проверяем табуляцию
-    if '\t' in first_line:
-        return '\t'
-    
-    # По умолчанию ';' для русских CSV файлов
-    return ';'
-
+app = FastAPI(title="AutoExam API")
 
-def _load_history() -> Dict[str, Any]:
-    if not os.path.exists(HISTORY_PATH):
-        return {"history": []}
-    try:
-        with open(HISTORY_PATH, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return {"history": []}
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=False,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
 
 
-def _save_history(history: Dict[str, Any]) -> None:
-    os.makedirs(DATA_DIR, exist_ok=True)
-    with open(HISTORY_PATH, "w", encoding="utf-8") as f:
-        json.dump(history, f, ensure_ascii=False, indent=2)
+_worker_process: subprocess.Popen | None = None
+_spawn_lock_file = None
 
 
-def _estimate_payload_size(payload: Dict[str, Any]) -> int:
-    """Оценивает размер payload в байтах"""
+def _acquire_spawn_lock() -> bool:
+    """При uvicorn --workers N воркер инференса запускает только один процесс API."""
+    global _spawn_lock_file
+    if fcntl is None:
+        return True
+    lock_file = open(os.path.join(STORAGE_DIR, "worker-spawn.lock"), "a+")
     try:
-        json_str = json.dumps(payload, ensure_ascii=False)
-        return len(json_str.encode('utf-8'))
-    except Exception:
-        # Если не удалось сериализовать, возвращаем большое значение
-        return sys.maxsize
-
-
-def _summarize_results(df: pd.DataFrame) -> Dict[str, Any]:
-    # Ожидаемые колонки входа: Id экзамена / ID экзамена, Id вопроса / ID вопроса, Транскрибация ответа, Оценка экзаменатора
-    def _find_col(cands: list[str]) -> str | None:
-        cols_lower = {c.lower(): c for c in df.columns}
-        for c in cands:
-            if c.lower() in cols_lower:
-                return cols_lower[c.lower()]
-        return None
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    # Блокировка держится, пока жив процесс
+    _spawn_lock_file = lock_file
+    return True
+
+
+@app.on_event("startup")
+def _start_worker():
+    global _worker_process
+    if WORKER_MODE == "spawn":
+        if not _acquire_spawn_lock():
+            logger.info("[server] Воркер уже запущен другим процессом API")
+            return
+        _worker_process = subprocess.Popen([sys.executable, os.path.join(ROOT_DIR, "worker.py")], cwd=ROOT_DIR)
+        logger.info(f"[server] Запущен процесс воркера, pid {_worker_process.pid}")
+    elif WORKER_MODE == "inline":
+        from worker import run_worker
+        threading.Thread(target=run_worker, name="worker", daemon=True).start()
+        logger.info("[server] Воркер запущен в процессе API")
+    else:
+        logger.info("[server] Воркеры запускаются отдельно (AUTOEXAM_WORKER=external)")
 
-    exam_col = _find_col(["Id экзамена", "ID экзамена"])
-    q_col = _find_col(["Id вопроса", "ID вопроса"])
-    trans_col = _find_col(["Транскрибация ответа"])
-    score_col = _find_col(["Оценка экзаменатора"])  # обязательно после инференса
 
-    if not all([exam_col, q_col, score_col]):
-        raise ValueError("Не найдены необходимые колонки для сборки ответа")
+@app.on_event("shutdown")
+def _stop_worker():
+    if _worker_process is not None and _worker_process.poll() is None:
+        # Прерванная задача вернется в очередь при следующем старте воркера
+        _worker_process.terminate()
+        try:
+            _worker_process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            _worker_process.kill()
 
-    total = int(len(df))
-    avg = float(df[score_col].astype(float).mean()) if total > 0 else 0.0
-    # Для совместимости с UI отдаем только score1 и score2
-    distr = {
-        "score1": int((df[score_col] == 1).sum()),
-        "score2": int((df[score_col] == 2).sum()),
-    }
 
-    # МНОЖЕСТВЕННЫЕ ЗАЩИТЫ от ошибки "header too large"
-    # 1. По количеству записей
-    MAX_RECORDS_IN_RESPONSE = 1000
-    
-    # 2. По размеру транскрибаций (если они очень длинные)
-    avg_transcription_length = 0
-    if trans_col and total > 0:
-        try:
-            avg_transcription_length = df[trans_col].astype(str).str.len().mean()
-        except:
-            avg_transcription_length = 0
-    
-    # Решаем: возвращать ли records
-    should_include_records = (
-        total <= MAX_RECORDS_IN_RESPONSE and 
-        avg_transcription_length < 5000  # Если средняя транскрибация меньше 5KB
+@app.get(f"{API_PREFIX}/health/ready")
+def health_ready():
+    """
+    Готовность инстанса: есть живой воркер, а при AUTOEXAM_PRELOAD_MODELS=1 — воркер,
+    у которого все модели загружены и прогреты.
+    """
+    workers = get_job_queue().live_workers()
+    models_status = {worker["id"]: worker["info"].get("models", {}) for worker in workers}
+    if PRELOAD_MODELS:
+        ready = any(
+            bool(status) and all(m.get("state") == "ready" for m in status.values())
+            for status in models_status.values()
+        )
+    else:
+        ready = bool(workers)
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"ready": ready, "preload": PRELOAD_MODELS, "workers": len(workers), "models": models_status},
     )
-    
-    if should_include_records:
-        # Для маленьких файлов возвращаем records, но с проверкой размера
-        records = []
-        for _, row in df.iterrows():
-            records.append({
-                "examId": str(row[exam_col]),
-                "questionId": str(row[q_col]),
-                "score": int(row[score_col]),
-                "transcription": str(row[trans_col]) if trans_col and pd.notna(row.get(trans_col)) else ""
-            })
-        
-        # Проверяем размер payload перед возвратом
-        test_payload = {
-            "totalRecords": total,
-            "averageScore": avg,
-            "distribution": distr,
-            "records": records,
-        }
-        payload_size = _estimate_payload_size(test_payload)
-        
-        if payload_size > MAX_SAFE_PAYLOAD_SIZE:
-            # Если payload слишком большой, не возвращаем records
-            logger.warning(f"[server] Payload слишком большой ({payload_size} байт), records не включены")
-            should_include_records = False
-            records = None
-    
-    if not should_include_records:
-        # Для больших файлов не возвращаем records - они доступны в CSV
-        logger.info(f"[server] Файл большой ({total} записей, avg_transcription={avg_transcription_length:.0f} символов), records не включены в ответ (доступны в CSV)")
-        records = None
-    
-    return {
-        "totalRecords": total,
-        "averageScore": avg,
-        "distribution": distr,
-        "records": records,  # None для больших файлов
-    }
 
 
-def _save_intermediate_result(job_id: str, stage: str, data: Dict[str, Any]) -> None:
-    """Сохраняет промежуточные результаты для возможности восстановления"""
-    intermediate_dir = os.path.join(RESULTS_DIR, "intermediate")
-    os.makedirs(intermediate_dir, exist_ok=True)
-    intermediate_path = os.path.join(intermediate_dir, f"{job_id}_{stage}.json")
+def _write_upload_chunk(out, digest, chunk: bytes) -> None:
+    digest.update(chunk)
+    out.write(chunk)
+
+
+def _discard_upload(out, partial_path: str) -> None:
+    out.close()
     try:
-        with open(intermediate_path, "w", encoding="utf-8") as f:
-            json.dump({
-                "job_id": job_id,
-                "stage": stage,
-                "timestamp": datetime.utcnow().isoformat() + "Z",
-                "data": data
-            }, f, ensure_ascii=False, indent=2)
-        logger.debug(f"[server] Промежуточный результат сохранен: {stage}")
-    except Exception as e:
-        logger.warning(f"[server] Не удалось сохранить промежуточный результат {stage}: {e}")
+        os.remove(partial_path)
+    except OSError:
+        pass
 
 
-def _background_process(job_id: str, upload_path: str, filename: str) -> None:
+def _finalize_upload(partial_path: str, upload_path: str, job_id: str, filename: str,
+                     content_key: str) -> tuple[JobState, bool]:
     """
-    Фоновая обработка задачи. ВАЖНО: функция должна быть полностью изолирована,
-    не передавать большие объекты через исключения или возвращаемые значения.
+    Ставит загруженный файл в очередь, если тот же файл той же версией моделей еще не обработан
+    и не в работе; иначе удаляет его и возвращает ту задачу. Файл переносится на место до вставки:
+    воркер может взять задачу сразу после нее.
     """
-    # Внешний try-except для перехвата ВСЕХ ошибок, включая ошибки сериализации
+    os.replace(partial_path, upload_path)
     try:
-        try:
-            logger.info(f"[server] Начало обработки задачи {job_id}: {filename}")
-            jobs.update(job_id, status="processing")
-        except Exception as init_error:
-            # Если даже обновление статуса не удалось - логируем но продолжаем
-            logger.error(f"[server] Ошибка при инициализации задачи {job_id}: {init_error}")
-            # Не падаем, продолжаем обработку
-
-        # Читаем CSV с авто-детектом разделителя
-        logger.info(f"[server] Чтение CSV {filename}")
-        with open(upload_path, "r", encoding="utf-8", errors="ignore") as f:
-            sample = f.read(2048)
-        sep = _detect_delimiter(sample) if sample else ';'
-        logger.info(f"[server] Разделитель CSV: '{sep}'")
-
-        # Читаем CSV с обработкой ошибок
-        try:
-            df = pd.read_csv(upload_path, sep=sep, encoding='utf-8', on_bad_lines='skip', engine='python')
-            
-            # КРИТИЧЕСКАЯ ПРОВЕРКА: убеждаемся что CSV правильно распарсен
-            if len(df.columns) == 1 and ';' in str(df.columns[0]):
-                logger.warning(f"[server] CSV не распарсен правильно (1 колонка), пробуем разделитель ';'")
-                # Пробуем принудительно с ';'
-                df = pd.read_csv(upload_path, sep=';', encoding='utf-8', on_bad_lines='skip', engine='python')
-                sep = ';'
-            
-            # Проверяем что есть необходимые колонки
-            expected_cols_lower = ['id экзамена', 'id вопроса', '№ вопроса', 'транскрибация ответа']
-            df_cols_lower = [col.lower() for col in df.columns]
-            found_cols = [col for col in expected_cols_lower if any(col in df_col for df_col in df_cols_lower)]
-            
-            if len(found_cols) < 2:
-                logger.error(f"[server] КРИТИЧЕСКАЯ ОШИБКА: CSV файл не содержит необходимые колонки!")
-                logger.error(f"[server] Найдены колонки: {list(df.columns)}")
-                logger.error(f"[server] Ожидались колонки содержащие: {expected_cols_lower}")
-                raise ValueError(f"CSV файл не содержит необходимые колонки. Найдено колонок: {len(df.columns)}, колонки: {list(df.columns)}")
-            
-            logger.info(f"[server] Загружено {len(df)} строк из CSV, колонок: {len(df.columns)}")
-            logger.info(f"[server] Колонки: {list(df.columns)}")
-            
-        except Exception as csv_error:
-            error_msg = str(csv_error)
-            if len(error_msg) > 200:
-                error_msg = error_msg[:200] + "... [обрезано]"
-            logger.error(f"[server] Ошибка чтения CSV файла: {error_msg}")
-            # Пробуем другие разделители
-            for alt_sep in [';', ',', '\t']:
-                if alt_sep != sep:
-                    try:
-                        logger.info(f"[server] Пробуем разделитель '{alt_sep}'...")
-                        df = pd.read_csv(upload_path, sep=alt_sep, encoding='utf-8', on_bad_lines='skip', engine='python')
-                        if len(df.columns) > 1:
-                            logger.info(f"[server] Успешно загружено с разделителем '{alt_sep}', колонок: {len(df.columns)}")
-                            sep = alt_sep
-                            break
-                    except Exception:
-                        continue
-            else:
-                # Если ничего не помогло - пробрасываем ошибку дальше
-                raise ValueError(f"Не удалось прочитать CSV файл. Ошибка: {error_msg}")
-        
-        # Сохраняем исходный CSV сразу после загрузки для восстановления
-        original_csv_path = os.path.join(RESULTS_DIR, f"{job_id}_original.csv")
-        try:
-            df.to_csv(original_csv_path, index=False, sep=sep, encoding='utf-8')
-            logger.info(f"[server] Исходный CSV сохранен: {original_csv_path}")
-        except Exception as e:
-            logger.warning(f"[server] Не удалось сохранить исходный CSV: {e}")
-        
-        # Сохраняем промежуточный результат после загрузки CSV
-        _save_intermediate_result(job_id, "csv_loaded", {
-            "rows_count": len(df),
-            "columns": list(df.columns)
-        })
-
-        # Запускаем инференс в отдельном try-except для изоляции ошибок
-        try:
-            logger.info(f"[server] Запуск ML-инференса")
-            result_df = run_inference(df)
-            logger.info(f"[server] Инференс завершен")
-        except Exception as inference_error:
-            # Обрабатываем ошибки инференса отдельно
-            error_msg = str(inference_error)
-            if len(error_msg) > 500:
-                error_msg = error_msg[:500] + "... [обрезано]"
-            logger.error(f"[server] Ошибка инференса для {job_id}: {error_msg}")
-            # Освобождаем память от DataFrame
-            del df
-            import gc
-            gc.collect()
-            # Пробуем сохранить CSV если он был создан до ошибки
-            csv_path = None
-            try:
-                # Пробуем сохранить хотя бы исходный CSV
-                original_csv_path = os.path.join(RESULTS_DIR, f"{job_id}_original.csv")
-                if os.path.exists(original_csv_path):
-                    csv_path = original_csv_path
-            except:
-                pass
-            # Обновляем статус с коротким сообщением
-            try:
-                jobs.update(job_id, status="failed", error=error_msg)
-            except:
-                try:
-                    jobs.update(job_id, status="failed", error="Ошибка инференса")
-                except:
-                    pass
-            return  # Выходим из функции
-        
-        # Сохраняем промежуточный результат после инференса
-        _save_intermediate_result(job_id, "inference_completed", {
-            "rows_count": len(result_df),
-            "has_score_column": "Оценка экзаменатора" in result_df.columns
-        })
-
-        # ВАЖНО: Сначала сохраняем CSV файл (критически важно - он должен быть на сервере)
-        # Сохраняем ПОЛНЫЙ файл со ВСЕМИ колонками и данными
-        csv_path = os.path.join(RESULTS_DIR, f"{job_id}.csv")
-        try:
-            logger.info(f"[server] Сохранение ПОЛНОГО CSV файла со всеми данными: {csv_path}")
-            # Сохраняем ВЕСЬ DataFrame со всеми колонками и данными
-            # Используем тот же разделитель что и в исходном файле
-            result_df.to_csv(csv_path, index=False, sep=';', encoding='utf-8')
-            logger.info(f"[server] ✅ ПОЛНЫЙ CSV файл успешно сохранен на сервере: {csv_path} ({len(result_df)} записей, {len(result_df.columns)} колонок)")
-        except Exception as e:
-            logger.error(f"[server] КРИТИЧЕСКАЯ ОШИБКА: Не удалось сохранить CSV файл: {e}")
-            csv_path = None
-            # Продолжаем выполнение, но CSV не будет доступен для скачивания
-
-        # Сводка + упаковка результата для API (без records для больших файлов)
-        logger.info(f"[server] Формирование результатов для API")
-        summary = _summarize_results(result_df)
-        result_payload = {
-            "id": job_id,
-            "filename": filename,
-            "status": "completed",
-            **summary,
-        }
-        logger.info(f"[server] Средняя оценка: {summary['averageScore']:.2f}, всего записей: {summary['totalRecords']}")
-
-        # Сохраняем результат (JSON) - для больших файлов сохраняем без records
-        result_path = os.path.join(RESULTS_DIR, f"{job_id}.json")
-        try:
-            # ГАРАНТИРУЕМ что records не будут в JSON для больших файлов
-            json_payload = result_payload.copy()
-            
-            # Множественные проверки перед сохранением
-            total_records = json_payload.get("totalRecords", 0)
-            records = json_payload.get("records")
-            
-            # Если records есть и файл большой - удаляем их
-            if records is not None and total_records > 1000:
-                json_payload["records"] = None
-                json_payload["_note"] = "Records доступны в CSV файле из-за большого размера"
-            
-            # Дополнительная проверка размера перед сохранением
-            payload_size = _estimate_payload_size(json_payload)
-            if payload_size > MAX_SAFE_PAYLOAD_SIZE and records is not None:
-                logger.warning(f"[server] JSON payload слишком большой ({payload_size} байт), удаляем records")
-                json_payload["records"] = None
-                json_payload["_note"] = "Records доступны в CSV файле из-за большого размера"
-            
-            # Сохраняем JSON
-            with open(result_path, "w", encoding="utf-8") as f:
-                json.dump(json_payload, f, ensure_ascii=False, indent=2)
-            logger.info(f"[server] JSON сохранен: {result_path} (размер: {payload_size} байт)")
-        except Exception as e:
-            logger.error(f"[server] Ошибка сохранения JSON: {e}")
-            # Пробуем сохранить минимальную версию без records
-            try:
-                minimal_payload = {
-                    "id": job_id,
-                    "filename": filename,
-                    "status": "completed",
-                    "totalRecords": result_payload.get("totalRecords"),
-                    "averageScore": result_payload.get("averageScore"),
-                    "distribution": result_payload.get("distribution"),
-                    "records": None,
-                    "_note": "Records доступны в CSV файле",
-                    "_error": f"Ошибка сохранения полного JSON: {str(e)}"
-                }
-                with open(result_path, "w", encoding="utf-8") as f:
-                    json.dump(minimal_payload, f, ensure_ascii=False, indent=2)
-                logger.info(f"[server] Сохранен минимальный JSON: {result_path}")
-            except Exception as e2:
-                logger.error(f"[server] Не удалось сохранить даже минимальный JSON: {e2}")
-                result_path = None
-
-        # Обновляем историю
-        history = _load_history()
-        history_entry = {
-            "id": job_id,
-            "userId": 0,
-            "filename": filename,
-            "uploadedAt": datetime.utcnow().isoformat() + "Z",
-            "status": "completed",
-            "totalRecords": result_payload["totalRecords"],
-            "averageScore": result_payload["averageScore"],
-            "resultsUrl": f"/results/{job_id}",
-        }
-        history.setdefault("history", []).insert(0, history_entry)
-        _save_history(history)
-
-        jobs.update(job_id, status="completed", result_path=result_path, csv_path=csv_path)
-        logger.info(f"[server] Задача {job_id} выполнена успешно")
-        
-        # КРИТИЧЕСКИ ВАЖНО: очищаем большие объекты перед выходом из функции
-        # чтобы они не попали в сериализацию при обработке исключений
-        try:
-            del result_df, df, summary, result_payload, json_payload
-            import gc
-            gc.collect()
-        except:
-            pass
-            
-    except Exception as e:
-        # КРИТИЧЕСКИ ВАЖНО: очищаем все большие объекты ПЕРЕД обработкой ошибки
-        # чтобы они не попали в сериализацию исключения
-        try:
-            if 'df' in locals():
-                del df
-            if 'result_df' in locals():
-                del result_df
-            if 'summary' in locals():
-                del summary
-            if 'result_payload' in locals():
-                del result_payload
-            import gc
-            gc.collect()
-        except:
-            pass
-        
-        # КРИТИЧЕСКИ ВАЖНО: обрезаем сообщение об ошибке чтобы избежать "header too large"
-        error_msg = str(e)
-        # Ограничиваем длину сообщения об ошибке (макс 200 символов для безопасности)
-        if len(error_msg) > 200:
-            error_msg = error_msg[:200] + "... [обрезано]"
-        
-        # Убираем большие объекты из traceback если они есть
-        error_type = type(e).__name__
-        
-        # Логируем только тип ошибки и короткое сообщение
-        logger.error(f"[server] Ошибка в задаче {job_id}: {error_type}: {error_msg}")
-        
-        # Сохраняем информацию об ошибке как промежуточный результат
-        try:
-            _save_intermediate_result(job_id, "error", {
-                "error": error_msg,
-                "error_type": error_type
-            })
-        except Exception as save_error:
-            # Если даже сохранение не удалось - просто логируем
-            logger.error(f"[server] Не удалось сохранить информацию об ошибке: {save_error}")
-        
-        # Обновляем статус с обрезанным сообщением об ошибке
-        # Используем несколько уровней fallback
-        update_success = False
-        for attempt_msg in [error_msg, "Ошибка обработки", "Ошибка"]:
-            try:
-                jobs.update(job_id, status="failed", error=attempt_msg)
-                update_success = True
-                break
-            except Exception as update_error:
-                # Пробуем следующий вариант
-                continue
-        
-        if not update_success:
-            # Если даже обновление не удалось - логируем но не падаем
-            logger.error(f"[server] КРИТИЧЕСКАЯ ОШИБКА: Не удалось обновить статус задачи {job_id}")
-            # Не делаем ничего больше - функция завершается без исключения
-
-
-app = FastAPI(title="AutoExam API")
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=False,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+        job, created = jobs.create_unique(job_id, filename, upload_path, content_key)
+    except BaseException:
+        os.remove(upload_path)
+        raise
+    if not created:
+        os.remove(upload_path)
+    return job, created
 
 
 @app.post(f"{API_PREFIX}/upload", response_model=UploadResponse)
-async def upload(file: UploadFile = File(...), background_tasks: BackgroundTasks = None):
+async def upload(file: UploadFile = File(...)):
     if not file.filename.endswith(".csv"):
         raise HTTPException(status_code=400, detail="Поддерживается только формат CSV")
 
-    job = jobs.create(filename=file.filename)
-    upload_path = os.path.join(UPLOADS_DIR, f"{job.id}.csv")
-
-    content = await file.read()
-    with open(upload_path, "wb") as f:
-        f.write(content)
+    job_id = JobStore.new_id()
+    upload_path = os.path.join(UPLOADS_DIR, f"{job_id}.csv")
+    partial_path = upload_path + ".part"
 
-    # Старт фоновой обработки
-    if background_tasks is None:
-        raise HTTPException(status_code=500, detail="Background tasks недоступны")
-    background_tasks.add_task(_background_process, job.id, upload_path, file.filename)
+    # Файл пишется кусками в пуле потоков: в памяти не больше куска, цикл событий не блокируется
+    digest = hashlib.sha256()
+    size = 0
+    out = await run_in_threadpool(open, partial_path, "wb")
+    try:
+        while chunk := await file.read(UPLOAD_CHUNK_BYTES):
+            size += len(chunk)
+            if MAX_UPLOAD_BYTES and size > MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=413,
+                                    detail=f"Файл больше {MAX_UPLOAD_BYTES // (1024 * 1024)} МБ")
+            await run_in_threadpool(_write_upload_chunk, out, digest, chunk)
+    except BaseException:
+        await run_in_threadpool(_discard_upload, out, partial_path)
+        raise
+    await run_in_threadpool(out.close)
+
+    # Тот же файл той же версией моделей уже обработан или в работе — отдаем ту задачу
+    content_key = f"{digest.hexdigest()}|{await run_in_threadpool(pipeline_version)}"
+    job, created = await run_in_threadpool(_finalize_upload, partial_path, upload_path, job_id,
+                                           file.filename, content_key)
+    if not created:
+        logger.info(f"[server] Файл {file.filename} совпадает с задачей {job.id} ({job.status}), повтор не ставим")
+        return UploadResponse(success=True, id=job.id, duplicate=True,
+                              message="Такой файл уже загружался, возвращен его результат")
+    logger.info(f"[server] Загружен {file.filename}: {size} байт, задача {job.id}")
+
+    return UploadResponse(success=True, id=job.id, message="Файл принят, задача поставлена в очередь")
+
+
+@app.post(f"{API_PREFIX}/results/{{result_id}}/resume", response_model=UploadResponse)
+def resume_result(result_id: str):
+    """Повторный запуск упавшей задачи: шаги, сохраненные в чекпоинтах, не пересчитываются."""
+    job = jobs.get(result_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Результат не найден")
+    if job.status != "failed":
+        raise HTTPException(status_code=409, detail=f"Возобновить можно только упавшую задачу, статус: {job.status}")
+    if not os.path.exists(os.path.join(UPLOADS_DIR, f"{result_id}.csv")):
+        raise HTTPException(status_code=410, detail="Исходный файл задачи не сохранился")
 
-    return UploadResponse(success=True, id=job.id, message="Файл принят, обработка запущена")
+    jobs.requeue(result_id)
+    result_payloads.discard(result_id)
+    logger.info(f"[server] Задача {result_id} поставлена на возобновление")
+    return UploadResponse(success=True, id=result_id, message="Обработка возобновлена")
 
 
 @app.options(f"{API_PREFIX}/upload")
@@ -593,46 +288,60 @@ def upload_options():
     return Response(status_code=204)
 
 
-@app.get(f"{API_PREFIX}/results/{{result_id}}", response_model=ResultResponse)
-def get_results(result_id: str):
-    job = jobs.get(result_id)
-    if job is None:
-        logger.warning(f"[server] Результат {result_id} не найден")
-        raise HTTPException(status_code=404, detail="Результат не найден")
+# Готовые ответы GET /api/results/{id} для завершенных задач: JSON читается и сериализуется один раз
+result_payloads = PayloadCache()
 
-    # Умное логирование - только если прошло время или статус изменился
-    if _should_log_status(result_id, job.status):
-        logger.info(f"[server] GET /api/results/{result_id} - статус: {job.status}")
+# Ответы для задач в работе: PROGRESS_POLL_INTERVAL после чтения реестра (опросом или потоком событий)
+# опросы отвечаются из памяти, в том числе 304 по ETag, без запроса к реестру
+_progress_responses: Dict[str, Tuple[float, str, bytes, str]] = {}  # {result_id: (время, статус, тело, ETag)}
+_progress_responses_lock = threading.Lock()
 
-    if job.status in ("queued", "processing"):
-        return ResultResponse(id=job.id, filename=job.filename, status=job.status, totalRecords=None,
-                              averageScore=None, distribution=None, records=None)
 
-    if job.status == "failed":
-        logger.error(f"[server] Задача {result_id} завершилась с ошибкой: {job.error}")
-        raise HTTPException(status_code=500, detail=f"Обработка завершилась с ошибкой: {job.error}")
+def _remember_progress(job: JobState, position: int | None) -> Tuple[bytes, str]:
+    body = ResultResponse(id=job.id, filename=job.filename, status=job.status, totalRecords=None,
+                          averageScore=None, distribution=None, records=None,
+                          queuePosition=position, progress=job.progress).model_dump_json().encode("utf-8")
+    etag = make_etag(body)
+    now = time.monotonic()
+    with _progress_responses_lock:
+        for result_id in [k for k, entry in _progress_responses.items() if now - entry[0] > PROGRESS_POLL_INTERVAL]:
+            del _progress_responses[result_id]
+        _progress_responses[job.id] = (now, job.status, body, etag)
+    return body, etag
+
+
+def _recent_progress(result_id: str) -> Tuple[str, bytes, str] | None:
+    with _progress_responses_lock:
+        entry = _progress_responses.get(result_id)
+    if entry is None or time.monotonic() - entry[0] > PROGRESS_POLL_INTERVAL:
+        return None
+    return entry[1:]
+
+
+def _json_response(body: bytes, etag: str, request: Request) -> Response:
+    # no-cache: браузер хранит ответ, но каждый опрос перепроверяет его по ETag
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
-    # completed
+
+def _completed_payload(job: JobState) -> bytes:
+    """Собирает и сериализует ответ для завершенной задачи (вызывается при промахе кэша)."""
+    result_id = job.id
     if job.result_path and os.path.exists(job.result_path):
         logger.info(f"[server] Задача {result_id} завершена, возвращаем результаты")
         try:
             with open(job.result_path, "r", encoding="utf-8") as f:
                 payload = json.load(f)
-            
-            # ДОПОЛНИТЕЛЬНАЯ ЗАЩИТА: проверяем размер payload перед возвратом
-            payload_size = _estimate_payload_size(payload)
-            if payload_size > MAX_SAFE_PAYLOAD_SIZE:
-                logger.warning(f"[server] Payload слишком большой ({payload_size} байт), удаляем records из ответа")
-                payload["records"] = None
-                payload["_note"] = "Records доступны в CSV файле из-за большого размера"
-            
+
             # ГАРАНТИРУЕМ что для больших файлов records = None
             total_records = payload.get("totalRecords", 0)
             if total_records > 1000 and payload.get("records") is not None:
                 logger.warning(f"[server] Принудительно удаляем records для большого файла ({total_records} записей)")
                 payload["records"] = None
                 payload["_note"] = "Records доступны в CSV файле из-за большого размера"
-                
+
         except Exception as e:
             logger.error(f"[server] Ошибка чтения JSON для {result_id}: {e}")
             # Создаем минимальный payload
@@ -657,44 +366,260 @@ def get_results(result_id: str):
             "distribution": None,
             "records": None,
         }
-    
+
     # ВСЕГДА добавляем ссылку на скачивание если CSV есть (это главное!)
     if job.csv_path and os.path.exists(job.csv_path):
         payload["downloadUrl"] = f"/api/results/{result_id}/download"
         logger.info(f"[server] CSV файл доступен для скачивания: {job.csv_path}")
     else:
         logger.warning(f"[server] CSV файл не найден для {result_id}")
-    
+
     # ФИНАЛЬНАЯ ПРОВЕРКА перед возвратом
     try:
         response = ResultResponse(**payload)
-        return response
     except Exception as e:
         logger.error(f"[server] Ошибка создания ResultResponse для {result_id}: {e}")
         # Возвращаем минимальный ответ без records
-        safe_payload = {
-            "id": payload.get("id", result_id),
-            "filename": payload.get("filename", "unknown"),
-            "status": "completed",
-            "totalRecords": payload.get("totalRecords"),
-            "averageScore": payload.get("averageScore"),
-            "distribution": payload.get("distribution"),
-            "records": None,  # Гарантированно None
-        }
-        if job.csv_path and os.path.exists(job.csv_path):
-            safe_payload["downloadUrl"] = f"/api/results/{result_id}/download"
-        return ResultResponse(**safe_payload)
+        response = ResultResponse(
+            id=payload.get("id", result_id),
+            filename=payload.get("filename", "unknown"),
+            status="completed",
+            totalRecords=payload.get("totalRecords"),
+            averageScore=payload.get("averageScore"),
+            distribution=payload.get("distribution"),
+            records=None,  # Гарантированно None
+        )
+
+    body = response.model_dump_json().encode("utf-8")
+    # ДОПОЛНИТЕЛЬНАЯ ЗАЩИТА: размер меряем по готовым байтам, без отдельной сериализации
+    if len(body) > MAX_SAFE_PAYLOAD_SIZE and response.records is not None:
+        logger.warning(f"[server] Payload слишком большой ({len(body)} байт), удаляем records из ответа")
+        response.records = None
+        body = response.model_dump_json().encode("utf-8")
+    return body
+
+
+@app.get(f"{API_PREFIX}/results/{{result_id}}", response_model=ResultResponse)
+def get_results(result_id: str, request: Request):
+    recent = _recent_progress(result_id)
+    if recent is not None:
+        status, body, etag = recent
+        if _should_log_status(result_id, status):
+            logger.info(f"[server] GET /api/results/{result_id} - статус: {status}")
+        return _json_response(body, etag, request)
+
+    job = jobs.get(result_id)
+    if job is None:
+        logger.warning(f"[server] Результат {result_id} не найден")
+        raise HTTPException(status_code=404, detail="Результат не найден")
+
+    # Умное логирование - только если прошло время или статус изменился
+    if _should_log_status(result_id, job.status):
+        logger.info(f"[server] GET /api/results/{result_id} - статус: {job.status}")
+
+    if job.status in ("queued", "processing"):
+        # Только состояние из реестра задач, без чтения файлов результата
+        position = jobs.position(result_id) if job.status == "queued" else None
+        body, etag = _remember_progress(job, position)
+        return _json_response(body, etag, request)
+
+    if job.status == "failed":
+        logger.error(f"[server] Задача {result_id} завершилась с ошибкой: {job.error}")
+        raise HTTPException(status_code=500, detail=f"Обработка завершилась с ошибкой: {job.error}")
+
+    # completed: повторное завершение после resume меняет finished_at, а с ним и ключ
+    key = (result_id, job.finished_at)
+    cached = result_payloads.get(key)
+    if cached is None:
+        cached = result_payloads.put(key, _completed_payload(job))
+    body, etag = cached
+    return _json_response(body, etag, request)
+
+
+def _ensure_columnar(job: JobState) -> str | None:
+    """Путь к Parquet-копии результата; для задач, завершенных без нее, собирается из CSV один раз."""
+    path = columnar_path(job.id)
+    if os.path.exists(path):
+        return path
+    if not job.csv_path or not os.path.exists(job.csv_path):
+        return None
+    with build_lock(path):
+        if not os.path.exists(path):
+            logger.info(f"[server] Сборка колоночного результата из CSV для {job.id}")
+            write_result_table(pd.read_csv(job.csv_path, sep=';', encoding='utf-8'), path)
+    return path
+
+
+@app.get(f"{API_PREFIX}/results/{{result_id}}/records")
+def get_result_records(
+    result_id: str,
+    offset: int = 0,
+    limit: int = 100,
+    score: int | None = None,
+    examId: str | None = None,
+):
+    """
+    Страница записей результата любого размера. Читаются только нужные колонки и группы строк
+    Parquet-файла, фильтры score/examId проверяются по статистикам групп. total — только без фильтров.
+    """
+    job = jobs.get(result_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Результат не найден")
+    if job.status != "completed":
+        raise HTTPException(status_code=404, detail=f"Результат не готов, статус: {job.status}")
+    if not parquet_available():
+        raise HTTPException(status_code=501, detail="Постраничные записи недоступны: не установлен pyarrow")
+    if offset < 0 or limit < 1:
+        raise HTTPException(status_code=400, detail="Некорректные offset/limit")
+    limit = min(limit, MAX_RECORDS_IN_RESPONSE)
+
+    path = _ensure_columnar(job)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Файл результата не найден на сервере")
+    try:
+        exam_col, q_col, trans_col, score_col = result_columns_of(pd.DataFrame(columns=result_columns(path)))
+    except ValueError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    columns = [c for c in (exam_col, q_col, trans_col, score_col) if c]
+    df, total, next_offset = read_slice(path, offset, limit, columns=columns,
+                                        filters={score_col: score, exam_col: examId})
+    return {
+        "id": result_id,
+        "offset": offset,
+        "limit": limit,
+        "total": total,
+        "nextOffset": next_offset,
+        "records": frame_records(df, exam_col, q_col, trans_col, score_col),
+    }
+
+
+def _job_event_state(job_id: str) -> Dict[str, Any]:
+    """Состояние задачи для потока событий: только реестр, без файлов результата."""
+    job = jobs.get(job_id)
+    if job is None:
+        return {"id": job_id, "status": "missing"}
+    state = {"id": job.id, "status": job.status, "progress": job.progress}
+    if job.status == "queued":
+        state["queuePosition"] = jobs.position(job_id)
+    if job.status in ("queued", "processing"):
+        # Опросы GET /api/results/{id} той же задачи берут это состояние, а не идут в реестр
+        _remember_progress(job, state.get("queuePosition"))
+    elif job.status == "failed":
+        state["error"] = job.error
+    elif job.status == "completed":
+        state["resultsUrl"] = f"/api/results/{job_id}"
+    return state
+
+
+job_events = ProgressHub(_job_event_state)
+
+
+@app.get(f"{API_PREFIX}/results/{{result_id}}/events")
+async def result_events(result_id: str, request: Request):
+    """
+    Server-Sent Events с ходом задачи вместо опроса GET /results/{id}. События: progress
+    (queued/processing: позиция в очереди, шаг, done/total, ETA), затем одно из completed,
+    failed, missing — после него поток закрывается. Сервер опрашивает реестр один раз
+    на задачу для всех подписчиков; медленный клиент получает только последнее состояние.
+    """
+    if await run_in_threadpool(jobs.get, result_id) is None:
+        raise HTTPException(status_code=404, detail="Результат не найден")
+
+    async def stream():
+        async with aclosing(job_events.subscribe(result_id)) as states:
+            async for state in states:
+                if await request.is_disconnected():
+                    return
+                if state is None:
+                    yield ": keepalive\n\n"
+                    continue
+                event = state["status"] if state["status"] in TERMINAL_STATUSES else "progress"
+                yield f"event: {event}\ndata: {json.dumps(state, ensure_ascii=False)}\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @app.get(f"{API_PREFIX}/history")
-def get_history():
-    return _load_history()
+def get_history(
+    limit: int = HISTORY_PAGE_SIZE,
+    cursor: str | None = None,
+    status: str | None = None,
+    filename: str | None = None,
+    dateFrom: str | None = None,
+    dateTo: str | None = None,
+):
+    """Страница истории от новых к старым; следующая — с cursor=nextCursor."""
+    if cursor is not None and not cursor.isdigit():
+        raise HTTPException(status_code=400, detail="Некорректный cursor")
+    items, next_cursor = get_history_store().page(
+        limit=limit, cursor=cursor, status=status, filename=filename, date_from=dateFrom, date_to=dateTo,
+    )
+    return {"history": items, "nextCursor": next_cursor}
+
+
+# Форматы скачивания: media type и расширение имени файла
+DOWNLOAD_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "jsonl": ("application/x-ndjson", "jsonl"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+
+def _pick_encoding(accept_encoding: str | None) -> str | None:
+    """Лучшее из поддерживаемых сжатий по Accept-Encoding (при равном q — zstd)."""
+    if not accept_encoding:
+        return None
+    weights = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[name.strip().lower()] = q
+    supported = (["zstd"] if zstd_available() else []) + ["gzip"]
+    ranked = [(weights.get(name, weights.get("*", 0.0)), -i, name) for i, name in enumerate(supported)]
+    q, _, name = max(ranked)
+    return name if q > 0 else None
+
+
+def _download_file(job: JobState, format: str, encoding: str | None) -> str:
+    """Файл для скачивания; JSONL, Parquet и сжатые копии собираются здесь при первом запросе."""
+    if not job.csv_path:
+        logger.error(f"[server] CSV путь не указан для задачи {job.id}")
+        raise HTTPException(status_code=404, detail="CSV путь не указан")
+
+    if not os.path.exists(job.csv_path):
+        logger.error(f"[server] CSV файл не существует: {job.csv_path}")
+        raise HTTPException(status_code=404, detail="CSV файл не найден на сервере")
+
+    if format == "parquet":
+        path = _ensure_columnar(job)
+    elif format == "jsonl":
+        path = jsonl_export(job.csv_path, os.path.join(RESULTS_DIR, f"{job.id}.jsonl"))
+    else:
+        path = job.csv_path
+    if encoding is not None:
+        path = compressed_copy(path, encoding)
+    logger.info(f"[server] Возвращаем файл: {path} ({os.path.getsize(path)} байт)")
+    return path
 
 
 @app.get(f"{API_PREFIX}/results/{{result_id}}/download")
-def download_result(result_id: str):
-    logger.info(f"[server] GET /api/results/{result_id}/download - запрос на скачивание")
-    job = jobs.get(result_id)
+async def download_result(result_id: str, request: Request, format: str = "csv"):
+    """
+    Результат целиком: CSV (по умолчанию), JSONL или Parquet из того же сохраненного результата.
+    CSV и JSONL отдаются сжатыми по Accept-Encoding (gzip/zstd, сжатая копия собирается один раз
+    и лежит рядом), Range-запросы позволяют докачку. Сборка копий идет в пуле потоков.
+    """
+    logger.info(f"[server] GET /api/results/{result_id}/download?format={format} - запрос на скачивание")
+    if format not in DOWNLOAD_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Неизвестный формат: {format}, доступны: {', '.join(DOWNLOAD_FORMATS)}")
+    job = await run_in_threadpool(jobs.get, result_id)
     if job is None:
         logger.warning(f"[server] Результат {result_id} не найден для скачивания")
         raise HTTPException(status_code=404, detail="Результат не найден")
@@ -704,21 +629,26 @@ def download_result(result_id: str):
     if job.status != "completed":
         logger.warning(f"[server] Задача {result_id} не завершена (статус: {job.status})")
         raise HTTPException(status_code=404, detail=f"CSV не готов, статус: {job.status}")
-    
-    if not job.csv_path:
-        logger.error(f"[server] CSV путь не указан для задачи {result_id}")
-        raise HTTPException(status_code=404, detail="CSV путь не указан")
-    
-    if not os.path.exists(job.csv_path):
-        logger.error(f"[server] CSV файл не существует: {job.csv_path}")
-        raise HTTPException(status_code=404, detail="CSV файл не найден на сервере")
-    
-    logger.info(f"[server] Возвращаем CSV файл: {job.csv_path}")
+    if format == "parquet" and not parquet_available():
+        raise HTTPException(status_code=501, detail="Parquet недоступен: не установлен pyarrow")
+
+    media_type, extension = DOWNLOAD_FORMATS[format]
+    download_name = f"{result_id}.{extension}"
+    headers = {"Content-Disposition": f"attachment; filename={download_name}"}
+    # Parquet уже сжат внутри (zstd по колонкам), повторное сжатие ничего не дает
+    encoding = _pick_encoding(request.headers.get("accept-encoding")) if format != "parquet" else None
+    path = await run_in_threadpool(_download_file, job, format, encoding)
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    if format != "parquet":
+        headers["Vary"] = "Accept-Encoding"
+
+    # FileResponse сам отвечает на Range (206) и ставит ETag/Last-Modified своего файла
     return FileResponse(
-        job.csv_path, 
-        media_type='text/csv', 
-        filename=f"{result_id}.csv",
-        headers={"Content-Disposition": f"attachment; filename={result_id}.csv"}
+        path, 
+        media_type=media_type, 
+        filename=download_name,
+        headers=headers
     )
 
 
@@ -54,12 +54,23 @@ const APIDocsPage = () => {
     }
   ]
 }`,
+    },
+    {
+      method: 'GET',
+      path: '/api/results/:id/events',
+      description: 'Ход обработки в реальном времени (Server-Sent Events): события progress (шаг, done/total, ETA), затем completed, failed или missing',
+      request: `curl -N http://localhost:8000/api/results/result-1234567890/events`,
+      response: `event: progress
+data: {"id": "result-1234567890", "status": "processing", "progress": {"stage": "scoring", "step": 5, "steps": 5, "done": 512, "total": 1500, "eta": 42.0}}
+
+event: completed
+data: {"id": "result-1234567890", "status": "completed", "resultsUrl": "/api/results/result-1234567890"}`,
     },
     {
       method: 'GET',
       path: '/api/history',
-      description: 'Получение истории обработок',
-      request: `curl -X GET http://localhost:8000/api/history \\
+      description: 'Получение истории обработок: страницы от новых к старым (limit, cursor=nextCursor), фильтры status, filename, dateFrom, dateTo',
+      request: `curl -X GET "http://localhost:8000/api/history?limit=50&status=completed" \\
   -H "Authorization: Bearer YOUR_TOKEN"`,
       response: `{
   "history": [
@@ -71,7 +82,8 @@ const APIDocsPage = () => {
       "totalRecords": 150,
       "averageScore": 1.7
     }
-  ]
+  ],
+  "nextCursor": "42"
 }`,
     },
   ];
@@ -124,9 +124,11 @@ export const getResultsAPI = async (id, signal = null) => {
   }
 };
 
-export const getHistoryAPI = async () => {
+export const getHistoryAPI = async ({ limit, cursor, status, filename, dateFrom, dateTo } = {}) => {
   try {
-    const response = await apiClient.get('/history');
+    const response = await apiClient.get('/history', {
+      params: { limit, cursor, status, filename, dateFrom, dateTo },
+    });
     return response.data;
   } catch (error) {
     console.error('Error fetching history:', error);
@@ -137,6 +139,46 @@ export const getHistoryAPI = async () => {
 // Глобальный счетчик активных поллингов для предотвращения дублей
 const activePolling = new Map();
 
+// Прогресс задачи в процентах: 5% — очередь, 5–95% — шаги пайплайна с учетом done/total
+const progressPercent = (progress) => {
+  if (!progress || !progress.steps) {
+    return 20;
+  }
+  const stepShare = progress.total ? Math.min(1, progress.done / progress.total) : 0;
+  return Math.round(5 + 90 * ((progress.step - 1 + stepShare) / progress.steps));
+};
+
+// Ждет завершения задачи по SSE (/results/{id}/events): сервер сам присылает прогресс.
+// Возвращает 'completed' | 'failed' | 'missing' или null, если поток недоступен (тогда — опрос)
+const waitForResultEvents = (id, { onProgress, signal }) => new Promise((resolve, reject) => {
+  if (typeof EventSource === 'undefined') {
+    resolve(null);
+    return;
+  }
+  const source = new EventSource(`${BASE_URL}/results/${id}/events`);
+  const finish = (outcome) => {
+    source.close();
+    resolve(outcome);
+  };
+  source.addEventListener('progress', (event) => {
+    const state = JSON.parse(event.data);
+    if (onProgress) {
+      onProgress(state.status === 'queued' ? 5 : progressPercent(state.progress));
+    }
+  });
+  ['completed', 'failed', 'missing'].forEach((type) => {
+    source.addEventListener(type, () => finish(type));
+  });
+  // Обрыв потока: не переподключаемся, дальше работает обычный опрос
+  source.onerror = () => finish(null);
+  if (signal) {
+    signal.addEventListener('abort', () => {
+      source.close();
+      reject(new Error('Запрос был отменен'));
+    });
+  }
+});
+
 export const pollResultsAPI = async (id, { intervalMs = 3000, maxAttempts = 288000, onProgress, signal = null } = {}) => {
   // Проверяем, не запущен ли уже поллинг для этого ID
   if (activePolling.has(id)) {
@@ -161,6 +203,12 @@ export const pollResultsAPI = async (id, { intervalMs = 3000, maxAttempts = 2880
   }
   
   try {
+    // Сначала ждем по SSE; после completed цикл ниже заберет результат первым же запросом
+    const outcome = await waitForResultEvents(id, { onProgress, signal });
+    if (outcome === 'failed') {
+      throw new Error('Обработка завершилась с ошибкой');
+    }
+
     while (attempts < maxAttempts && !isAborted) {
       // Проверяем отмену перед каждой итерацией
       if (signal && signal.aborted) {
@@ -183,10 +231,9 @@ export const pollResultsAPI = async (id, { intervalMs = 3000, maxAttempts = 2880
           if (data.status === 'queued') {
             onProgress(5); // Файл загружен, очередь
           } else if (data.status === 'processing') {
-            // Если обрабатывается, предполагаем прогресс 20-90%
-            // Будем увеличивать постепенно
+            // Реальный прогресс шагов, если сервер его прислал; иначе постепенно 20-90%
             const baseProgress = 20 + Math.min(70, Math.floor(attempts / 10));
-            onProgress(baseProgress);
+            onProgress(data.progress ? progressPercent(data.progress) : baseProgress);
           } else if (data.status === 'completed') {
             onProgress(100);
           }
@@ -0,0 +1,102 @@
+"""
+Строки с пустыми ячейками: NaN, None и "" в "Транскрибация ответа" и "Текст вопроса"
+должны проходить run_inference целиком (ключи мемоизации, сжатие, схожесть, промпты скоринга),
+как в прежней построчной версии, где пустое значение превращалось в str() — "nan".
+
+Модели не загружаются: подписи, сжатие, эмбеддинги и скоринг заменены детерминированными
+заглушками, которые проверяют, что на вход им приходят только строки. Мемоизация —
+во временной базе, повторный прогон должен целиком взять оценки из нее.
+
+Запуск из директории autoexam-app:
+    python -m pytest tests
+"""
+import hashlib
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import inference
+from preprocessing import MAX_SCORE
+from score_memo import ScoreMemo
+
+
+def _require_strings(values, stage: str) -> None:
+    bad = [value for value in values if not isinstance(value, str)]
+    assert not bad, f"{stage}: на вход пришли не строки: {bad[:3]}"
+
+
+class _FakeProcessor:
+    def apply_chat_template(self, messages, add_generation_prompt=True, tokenize=False):
+        return repr(messages)
+
+    def tokenizer(self, texts, add_special_tokens=False):
+        return {"input_ids": [[0] * len(text) for text in texts]}
+
+
+def _fake_embed(texts, batch_size=inference.EMBED_BATCH_SIZE):
+    _require_strings(texts, "эмбеддинги")
+    rows = []
+    for text in texts:
+        digest = hashlib.sha256(text.encode("utf-8")).digest()
+        rows.append(np.frombuffer(digest, dtype=np.uint8)[:16].astype(np.float32) + 1.0)
+    return np.array(rows, dtype=np.float32).reshape(len(texts), 16)
+
+
+def _fake_summaries(chat_texts):
+    _require_strings(chat_texts, "сжатие транскрибаций")
+    return [f"краткое описание {len(text)}" for text in chat_texts]
+
+
+def _fake_scoring(items):
+    _require_strings([prompt for prompt, _ in items], "скоринг")
+    dist = np.zeros(MAX_SCORE + 1)
+    dist[1] = 1.0
+    return [(1, dist) for _ in items]
+
+
+def _no_model_expected(items):
+    raise AssertionError(f"повторный прогон пошел в модель для {len(items)} строк, а не в мемоизацию")
+
+
+@pytest.fixture
+def fake_models(tmp_path, monkeypatch):
+    memo = ScoreMemo(str(tmp_path / "memo.sqlite"))
+    monkeypatch.setattr(inference, "get_vl_model_and_processor", lambda: (None, _FakeProcessor()))
+    monkeypatch.setattr(inference, "_caption_images",
+                        lambda links, batch_size=inference.CAPTION_BATCH_SIZE: [f"подпись {link}" for link in links])
+    monkeypatch.setattr(inference, "_embed_texts", _fake_embed)
+    monkeypatch.setattr(inference._summary_coalescer, "run", _fake_summaries)
+    monkeypatch.setattr(inference._scoring_coalescer, "run", _fake_scoring)
+    monkeypatch.setattr(inference, "EMBEDDING_STORE_ENABLED", False)
+    monkeypatch.setattr(inference, "get_score_memo", lambda: memo)
+    return monkeypatch
+
+
+def make_frame() -> pd.DataFrame:
+    blanks = ["Ответ кандидата", np.nan, None, "", np.nan, "Другой ответ"]
+    return pd.DataFrame({
+        "Id экзамена": range(1, len(blanks) + 1),
+        "Id вопроса": range(101, 101 + len(blanks)),
+        "№ вопроса": [1, 2, 3, 4, 2, 1],
+        "Текст вопроса": ["<p>Опишите картинку</p>", np.nan, "Вопрос", "Вопрос", "Вопрос", np.nan],
+        "Картинка из вопроса": ["https://example.com/a.png", "https://example.com/a.png", None,
+                                "https://example.com/b.png", None, "https://example.com/b.png"],
+        "Транскрибация ответа": blanks,
+    })
+
+
+def test_blank_cells_go_through_run_inference(fake_models):
+    first = inference.run_inference(make_frame())
+    assert len(first) == 6 and first["Оценка экзаменатора"].tolist() == [1] * 6
+
+    # Схожесть посчитана для всех строк с картинками, включая пустые ответы
+    similarity = first["Схожесть описания картинки"].to_numpy(dtype=float)
+    assert np.isfinite(similarity[[0, 1, 3, 5]]).all(), similarity
+
+    # Повторный прогон: все строки, включая пустые, должны найтись в мемоизации
+    fake_models.setattr(inference._scoring_coalescer, "run", _no_model_expected)
+    second = inference.run_inference(make_frame())
+    pd.testing.assert_series_equal(first["Оценка экзаменатора"], second["Оценка экзаменатора"])
+    pd.testing.assert_series_equal(first["Схожесть описания картинки"], second["Схожесть описания картинки"],
+                                   check_dtype=False)
@@ -0,0 +1,44 @@
+"""
+Версии моделей, адаптера и промптов пайплайна. Без torch и transformers: процесс API
+считает по ним ключ дедупликации загрузок, не загружая модели.
+"""
+import os
+import hashlib
+
+from preprocessing import SCORING_PROMPT_VERSION
+
+
+MODEL_NAME = "Qwen/Qwen2.5-VL-3B-Instruct"
+ADAPTER_PATH = "qwen_sft_exam"
+
+# "logits" — один forward и распределение по цифрам 0..max_score; "generate" — прежний generate + regex
+SCORING_MODE = "logits"
+# Версии промптов подписей и сжатия; повышаем при любом изменении текста запроса к модели
+CAPTION_PROMPT_VERSION = "v1"
+SUMMARY_PROMPT_VERSION = "v1"
+
+_adapter_fingerprint = None
+
+
+def adapter_fingerprint() -> str:
+    """Короткий хеш файлов LoRA-адаптера: ключи кешей результатов меняются вместе с адаптером."""
+    global _adapter_fingerprint
+    if _adapter_fingerprint is not None:
+        return _adapter_fingerprint
+    digest = hashlib.sha256()
+    for name in ("adapter_config.json", "adapter_model.safetensors"):
+        path = os.path.join(ADAPTER_PATH, name)
+        try:
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+        except OSError:
+            digest.update(name.encode("utf-8"))
+    _adapter_fingerprint = f"{ADAPTER_PATH}@{digest.hexdigest()[:16]}"
+    return _adapter_fingerprint
+
+
+def pipeline_version() -> str:
+    """Версия моделей, адаптера и промптов: тот же файл при той же версии дает тот же результат."""
+    return (f"{MODEL_NAME}|{adapter_fingerprint()}|{SCORING_MODE}|scoring-{SCORING_PROMPT_VERSION}"
+            f"|caption-{CAPTION_PROMPT_VERSION}|summary-{SUMMARY_PROMPT_VERSION}")
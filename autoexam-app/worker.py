@@ -0,0 +1,94 @@
+"""
+Воркер инференса: отдельный процесс, который владеет моделями и разбирает очередь задач
+(job_queue). Процесс API только ставит задачи в очередь и отдает статусы.
+
+Запуск из директории autoexam-app (если сервер не запускает воркер сам, см. AUTOEXAM_WORKER):
+    python worker.py
+"""
+import os
+import time
+import socket
+import logging
+import threading
+
+from job_queue import get_job_queue
+from job_runner import process_job
+from models import preload_models, get_models_status
+
+logger = logging.getLogger(__name__)
+
+
+# Сколько задач воркер обрабатывает одновременно. Модели общие, вызовы GPU сериализуются,
+# а строки скоринга и сжатия параллельных задач объединяются в общие батчи
+WORKER_CONCURRENCY = int(os.environ.get("AUTOEXAM_WORKER_CONCURRENCY", "4"))
+# Пауза между опросами пустой очереди, сек
+WORKER_POLL_INTERVAL = float(os.environ.get("AUTOEXAM_WORKER_POLL_INTERVAL", "1.0"))
+WORKER_HEARTBEAT_INTERVAL = 10.0
+# Как часто чистить реестр от задач старше AUTOEXAM_JOB_TTL_DAYS, сек
+WORKER_EVICT_INTERVAL = 3600.0
+PRELOAD_MODELS = os.environ.get("AUTOEXAM_PRELOAD_MODELS", "0") == "1"
+
+
+def _heartbeat_loop(worker_id: str, stop: threading.Event) -> None:
+    queue = get_job_queue()
+    last_evict = 0.0
+    while not stop.is_set():
+        try:
+            queue.heartbeat(worker_id, {"models": get_models_status(), "concurrency": WORKER_CONCURRENCY})
+            queue.requeue_orphaned()
+            if time.time() - last_evict > WORKER_EVICT_INTERVAL:
+                queue.evict_expired()
+                last_evict = time.time()
+        except Exception as e:
+            logger.warning(f"[worker] Не удалось обновить heartbeat: {e}")
+        stop.wait(WORKER_HEARTBEAT_INTERVAL)
+
+
+def _drain_loop(worker_id: str, stop: threading.Event) -> None:
+    queue = get_job_queue()
+    while not stop.is_set():
+        try:
+            job = queue.claim(worker_id)
+        except Exception as e:
+            logger.error(f"[worker] Ошибка чтения очереди: {e}")
+            job = None
+        if job is None:
+            stop.wait(WORKER_POLL_INTERVAL)
+            continue
+        logger.info(f"[worker] {worker_id} взял задачу {job['id']} (попытка {job['attempts']})")
+        process_job(job["id"], job["upload_path"], job["filename"])
+
+
+def run_worker(concurrency: int = WORKER_CONCURRENCY, stop: threading.Event | None = None) -> None:
+    """Разбирает очередь в concurrency потоках, пока не выставлен stop."""
+    stop = stop or threading.Event()
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    queue = get_job_queue()
+    # Первый heartbeat до requeue_orphaned: свои задачи не считаются брошенными
+    queue.heartbeat(worker_id, {"models": get_models_status(), "concurrency": concurrency})
+    queue.requeue_orphaned()
+    threading.Thread(target=_heartbeat_loop, args=(worker_id, stop), name="worker-heartbeat", daemon=True).start()
+    if PRELOAD_MODELS:
+        threading.Thread(target=preload_models, name="model-preload", daemon=True).start()
+
+    logger.info(f"[worker] Воркер {worker_id} запущен, параллельных задач: {concurrency}")
+    threads = [
+        threading.Thread(target=_drain_loop, args=(worker_id, stop), name=f"worker-{n}", daemon=True)
+        for n in range(max(1, concurrency))
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(timeout=1.0)
+    except KeyboardInterrupt:
+        stop.set()
+    finally:
+        queue.remove_worker(worker_id)
+        logger.info(f"[worker] Воркер {worker_id} остановлен")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    run_worker()